@@ -0,0 +1,104 @@
+import argparse
+import os
+import time
+
+from prettytable import PrettyTable
+
+# Runs the full encryption flow of encryption.main() against simulated fleets and reports
+# throughput, simulated downtime per instance and API calls per volume. Arguments after
+# '--' are passed to encryption.py, e.g. '-- --workers 16 --snapshot-mode overlap'.
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the EBS encryption workflow against a simulated EC2.')
+    parser.add_argument('--volumes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='Fleet sizes to run, in volumes.')
+    parser.add_argument('--time-scale', type=float, default=1000, help='Simulated seconds per real second (default: 1000).')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of API calls answered with RequestLimitExceeded.')
+    parser.add_argument('--api-failure-rate', type=float, default=0.0, help='Fraction of mutating API calls failing with InternalError.')
+    parser.add_argument('--snapshot-failure-rate', type=float, default=0.0, help='Fraction of snapshots ending in the error state.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic fleet and the injected failures.')
+    parser.add_argument('--work-dir', default='benchmark_runs', help='Directory receiving the logs, journals and reports of the runs.')
+    parser.add_argument('encryption_args', nargs=argparse.REMAINDER, help="Options passed to encryption.py after '--'.")
+    args = parser.parse_args(argv)
+    if args.encryption_args[:1] == ['--']:
+        args.encryption_args = args.encryption_args[1:]
+    return args
+
+
+def count_volumes(region):
+    encrypted = unencrypted = 0
+    for entry in region.volumes.values():
+        volume = entry['resource']
+        if volume['State'] == 'in-use':
+            if volume['Encrypted']:
+                encrypted += 1
+            else:
+                unencrypted += 1
+    return encrypted, unencrypted
+
+
+def run_benchmark(volume_count, args):
+    # Imported here so its log file is created inside the work directory.
+    import encryption
+    import metrics
+    import simulation
+    from ratelimit import throttle_summary
+
+    cloud = simulation.SimulatedCloud(args.time_scale, args.throttle_rate, args.api_failure_rate, args.snapshot_failure_rate, seed=args.seed)
+    region = cloud.generate_fleet(volume_count)
+    encryption.use_simulation(cloud)
+    run_name = f"{volume_count}_volumes"
+    # The synthetic fleet has volumes of up to 1,000 GB, so the 250 GB exclusion is lifted
+    # to measure the whole fleet; options after '--' come later and still override it.
+    argv = ['--regions', region.region_name, '--state-file', f"{run_name}.db", '--metrics-file', f"{run_name}.jsonl",
+            '--max-volume-size', '0'] + args.encryption_args
+
+    start_time = time.monotonic()
+    encryption.main(argv)
+    wall_clock = time.monotonic() - start_time
+
+    throttle_counts, api_call_counts = throttle_summary()
+    downtime = metrics.step_statistics().get(('instance_downtime', '-'))
+    encrypted, unencrypted = count_volumes(region)
+    return {
+        'volumes': volume_count,
+        'instances': len(region.instances),
+        'wall_clock': wall_clock,
+        'simulated_hours': wall_clock * args.time_scale / 3600,
+        'downtime': {key: downtime[key] * args.time_scale / 60 for key in ('p50', 'p95', 'max')} if downtime else None,
+        'api_calls_per_volume': sum(api_call_counts.values()) / volume_count,
+        'throttled': sum(throttle_counts.values()),
+        'encrypted': encrypted,
+        'unencrypted': unencrypted,
+    }
+
+
+def results_table(results):
+    table = PrettyTable()
+    table.field_names = ["Volumes", "Instances", "Wall Clock (s)", "Simulated (h)", "Downtime p50 (min)", "Downtime p95 (min)",
+                         "Downtime Max (min)", "API Calls / Volume", "Throttled", "Encrypted", "Left Unencrypted"]
+    for result in results:
+        downtime = result['downtime'] or {'p50': 0, 'p95': 0, 'max': 0}
+        table.add_row([result['volumes'], result['instances'], f"{result['wall_clock']:.1f}", f"{result['simulated_hours']:.2f}",
+                       f"{downtime['p50']:.1f}", f"{downtime['p95']:.1f}", f"{downtime['max']:.1f}",
+                       f"{result['api_calls_per_volume']:.1f}", result['throttled'], result['encrypted'], result['unencrypted']])
+    return table
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.chdir(args.work_dir)
+
+    import simulation
+    simulation.compress_time(args.time_scale)
+
+    results = []
+    for volume_count in args.volumes:
+        print(f"Running {volume_count} volumes...", flush=True)
+        results.append(run_benchmark(volume_count, args))
+    print(results_table(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import botocore
+
+import report
+from encryption import create_session, get_account_id, get_client
+from waiters import DESCRIBE_BATCH_SIZE, describe_resources
+
+logger = logging.getLogger()
+
+# Runs after encryption.py: deletes the unencrypted volumes it detached and the snapshots it
+# took, as recorded in its reports, once they are older than the retention delay.
+DEFAULT_RETENTION_HOURS = 72
+CLEANUP_WORKERS = 16
+SNAPSHOT_COLUMNS = ['snapshot_id', 'baseline_snapshot_id', 'encrypted_snapshot_id', 'baseline_encrypted_snapshot_id']
+CLEANUP_LOG_FIELDS = {
+    'account_id': 'Account ID',
+    'region': 'Region',
+    'resource_type': 'Resource Type',
+    'resource_id': 'Resource ID',
+    'size_gb': 'Size (GB)',
+    'action': 'Action',
+    'reason': 'Reason',
+    'at': 'At',
+}
+
+
+def cleanup_candidates(report_paths, retention_hours):
+    # (account ID, region) -> volume and snapshot IDs of every row finished before the
+    # retention delay. Rows without a completion time count as old as their report file.
+    # A rolled back row gives its kept encrypted volume instead of the original, which is
+    # in use again.
+    cutoff = datetime.now() - timedelta(hours=retention_hours)
+    candidates = defaultdict(lambda: {'volume': set(), 'encrypted_volume': set(), 'snapshot': set()})
+    held_back = 0
+    for path in report_paths:
+        file_time = datetime.fromtimestamp(os.path.getmtime(path))
+        for row in report.read_report(path):
+            completed_at = datetime.fromisoformat(row['completed_at']) if row.get('completed_at') else file_time
+            if completed_at > cutoff:
+                held_back += 1
+                continue
+            resources = candidates[(row.get('account_id') or None, row.get('region') or None)]
+            if row.get('status') == 'rolled_back':
+                if row.get('new_volume_id'):
+                    resources['encrypted_volume'].add(row['new_volume_id'])
+            elif row.get('old_volume_id'):
+                resources['volume'].add(row['old_volume_id'])
+            resources['snapshot'].update(row[column] for column in SNAPSHOT_COLUMNS if row.get(column))
+    if held_back:
+        logger.info(f"{held_back} volumes were swapped less than {retention_hours} hours ago. Keeping their resources for now.")
+    return candidates
+
+
+def target_sessions(keys, role_arns):
+    # A session for every account and region of the reports, found by assuming each role in
+    # turn. Rows without an account ID use the configured credentials.
+    sessions = {}
+    for account_id, region in keys:
+        if account_id is None:
+            sessions[(account_id, region)] = create_session(region)
+            continue
+        for role_arn in role_arns or [None]:
+            session = create_session(region, role_arn)
+            if get_account_id(session) == account_id:
+                sessions[(account_id, region)] = session
+                break
+        else:
+            logger.error(f"None of the given roles reaches account {account_id}. Skipping its resources in {region}.")
+    return sessions
+
+
+def describe_by_id(ec2_client, kind, resource_ids):
+    resource_ids = sorted(resource_ids)
+    resources = {}
+    id_key = 'VolumeId' if kind == 'volume' else 'SnapshotId'
+    for i in range(0, len(resource_ids), DESCRIBE_BATCH_SIZE):
+        for resource in describe_resources(ec2_client, kind, resource_ids[i:i + DESCRIBE_BATCH_SIZE]):
+            resources[resource[id_key]] = resource
+    return resources
+
+
+class Cleanup:
+    def __init__(self, log, dry_run=False, workers=CLEANUP_WORKERS):
+        self.log = log
+        self.dry_run = dry_run
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.reclaimed_gb = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    def record(self, session, kind, resource_id, size_gb, action, reason=None):
+        self.log.write({
+            'account_id': get_account_id(session),
+            'region': session.region_name,
+            'resource_type': kind,
+            'resource_id': resource_id,
+            'size_gb': size_gb,
+            'action': action,
+            'reason': reason,
+            'at': datetime.now().isoformat(timespec='seconds'),
+        })
+        with self.lock:
+            self.counts[(kind, action)] += 1
+            if action in ('deleted', 'would delete'):
+                self.reclaimed_gb[kind] += size_gb or 0
+
+    def deletable(self, session, kind, resource_ids, encrypted=False):
+        # Only detached volumes are deleted, and only unencrypted ones unless they are the
+        # encrypted volumes kept by a rollback: an original volume that is in use again was
+        # rolled back and still holds the instance's data, and a kept encrypted volume that is
+        # in use was swapped in by a later --resume.
+        resources = describe_by_id(get_client(session, 'ec2'), kind, resource_ids)
+        for resource_id in sorted(resource_ids):
+            resource = resources.get(resource_id)
+            if resource is None:
+                self.record(session, kind, resource_id, None, 'skipped', 'not found, already deleted')
+            elif kind == 'volume' and (resource['State'] != 'available' or resource['Encrypted'] != encrypted):
+                reason = f"state is {resource['State']}" if resource['State'] != 'available' else ('encrypted' if resource['Encrypted'] else 'not encrypted')
+                self.record(session, kind, resource_id, resource['Size'], 'skipped', reason)
+            else:
+                yield resource_id, resource['Size'] if kind == 'volume' else resource['VolumeSize']
+
+    def delete(self, session, kind, resource_id, size_gb):
+        if self.dry_run:
+            self.record(session, kind, resource_id, size_gb, 'would delete')
+            return
+        ec2_client = get_client(session, 'ec2')
+        try:
+            if kind == 'volume':
+                ec2_client.delete_volume(VolumeId=resource_id)
+            else:
+                ec2_client.delete_snapshot(SnapshotId=resource_id)
+        except botocore.exceptions.ClientError as e:
+            # Snapshots still backing an AMI, for one, cannot be deleted.
+            logger.error(f"Could not delete {kind} {resource_id}. Error: {str(e)}")
+            self.record(session, kind, resource_id, size_gb, 'failed', e.response['Error']['Code'])
+            return
+        self.record(session, kind, resource_id, size_gb, 'deleted')
+
+    def run(self, sessions, candidates):
+        # The deletes of every account and region share one pool; each client's rate
+        # limiter keeps them within the EC2 request limits.
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cleanup') as executor:
+            futures = []
+            for key, resources in candidates.items():
+                if key not in sessions:
+                    continue
+                session = sessions[key]
+                for kind, candidate_ids, encrypted in (('volume', resources['volume'], False), ('volume', resources['encrypted_volume'], True),
+                                                       ('snapshot', resources['snapshot'], False)):
+                    for resource_id, size_gb in self.deletable(session, kind, candidate_ids, encrypted):
+                        futures.append(executor.submit(self.delete, session, kind, resource_id, size_gb))
+            for future in futures:
+                future.result()
+
+    def summary(self):
+        action = 'Would delete' if self.dry_run else 'Deleted'
+        deleted = 'would delete' if self.dry_run else 'deleted'
+        # A snapshot only stores the blocks it changed, so its volume size is an upper bound.
+        return (f"{action} {self.counts[('volume', deleted)]} volumes ({self.reclaimed_gb['volume']} GB) and "
+                f"{self.counts[('snapshot', deleted)]} snapshots (up to {self.reclaimed_gb['snapshot']} GB); "
+                f"{self.counts[('volume', 'skipped')] + self.counts[('snapshot', 'skipped')]} skipped, "
+                f"{self.counts[('volume', 'failed')] + self.counts[('snapshot', 'failed')]} failed")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Delete the snapshots and unencrypted volumes left behind by encryption.py.')
+    parser.add_argument('reports', nargs='+', help='Volume reports written by encryption.py (CSV, JSON lines or Parquet).')
+    parser.add_argument('--retention-hours', type=float, default=DEFAULT_RETENTION_HOURS,
+                        help=f'Only clean up volumes swapped at least this long ago (default: {DEFAULT_RETENTION_HOURS}).')
+    parser.add_argument('--dry-run', action='store_true', help='Only log what would be deleted.')
+    parser.add_argument('--workers', type=int, default=CLEANUP_WORKERS, help=f'Concurrent delete calls (default: {CLEANUP_WORKERS}).')
+    parser.add_argument('--role-arns', nargs='+', default=None, help='IAM roles to assume for the accounts of the reports.')
+    parser.add_argument('--cleanup-log', default=None, help='Report of every deleted or skipped resource (default: cleanup_<timestamp>.csv).')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start_time = datetime.now()
+    candidates = cleanup_candidates(args.reports, args.retention_hours)
+    sessions = target_sessions(list(candidates), args.role_arns)
+
+    log_path = args.cleanup_log or f'cleanup_{start_time.strftime("%Y%m%d%H%M%S")}.csv'
+    log = report.open_report(log_path, fields=CLEANUP_LOG_FIELDS)
+    cleanup = Cleanup(log, args.dry_run, args.workers)
+    try:
+        cleanup.run(sessions, candidates)
+    finally:
+        log.close()
+    logger.info(cleanup.summary())
+    logger.info(f"Cleanup log written to {log_path}. Cleanup completed in {datetime.now() - start_time}")
+    print(cleanup.summary())
+    return cleanup
+
+
+if __name__ == '__main__':
+    main()
@@ -1,242 +1,1257 @@
-import boto3
-import os
-from datetime import datetime
-from collections import defaultdict
-import botocore
-import logging
-from prettytable import PrettyTable
-
-VOLUME_DETAILS_LIST = []
-PENDING_SNAPSHOTS = []
-FAILED_SNAPSHOTS = []
-
-logging.basicConfig(filename='script_logs.log', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
-logger = logging.getLogger()
-
-MAX_RETRIES = 5
-
-def create_session():
-    return boto3.Session(
-        region_name=os.environ.get('AWS_DEFAULT_REGION'),
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        aws_session_token=os.environ.get('AWS_SESSION_TOKEN'),
-    )
-
-def robust_waiter(waiter, **kwargs):
-    try:
-        waiter.wait(
-            **kwargs,
-            WaiterConfig={
-                'Delay': 120,
-                'MaxAttempts': 60
-            }
-        )
-    except botocore.exceptions.WaiterError as e:
-        logger.error(f"Waiter failed for parameters: {kwargs}. Error: {str(e)}")
-        raise
-
-def get_instance_name(session, instance_id):
-    ec2_client = session.client("ec2")
-    response = ec2_client.describe_instances(InstanceIds=[instance_id])
-    for tag in response['Reservations'][0]['Instances'][0].get('Tags', []):
-        if tag['Key'] == 'Name':
-            return tag['Value']
-    return None
-
-def get_kms_key_arn(session, alias_name='alias/aws/ebs'):
-    kms_client = session.client('kms')
-    try:
-        response = kms_client.describe_key(KeyId=alias_name)
-        return response['KeyMetadata']['Arn']
-    except kms_client.exceptions.NotFoundException:
-        logger.error(f"KMS key with alias {alias_name} not found.")
-        return None
-
-def get_volume_info(session):
-    ec2_client = session.client("ec2")
-    response = ec2_client.describe_volumes()
-    return response['Volumes']
-
-def create_snapshot(session, volume_id):
-    ec2_client = session.client("ec2")
-    response = ec2_client.create_snapshot(VolumeId=volume_id)
-    snapshot_id = response['SnapshotId']
-    waiter = ec2_client.get_waiter('snapshot_completed')
-    robust_waiter(waiter, SnapshotIds=[snapshot_id])
-    return snapshot_id
-
-def create_encrypted_volume(session, snapshot_id, availability_zone, size, volume_type, kms_key):
-    ec2_client = session.client("ec2")
-    response = ec2_client.create_volume(
-        SnapshotId=snapshot_id,
-        AvailabilityZone=availability_zone,
-        Size=size,
-        VolumeType=volume_type,
-        Encrypted=True,
-        KmsKeyId=kms_key,
-    )
-    volume_id = response['VolumeId']
-    waiter = ec2_client.get_waiter('volume_available')
-    robust_waiter(waiter, VolumeIds=[volume_id])
-    return volume_id
-
-def attach_encrypted_volume(session, encrypted_volume_id, instance_id, device_name):
-    ec2_client = session.client("ec2")
-    ec2_client.attach_volume(
-        VolumeId=encrypted_volume_id,
-        InstanceId=instance_id,
-        Device=device_name
-    )
-
-def detach_volume(session, volume_id):
-    ec2_client = session.client("ec2")
-    start_time = datetime.now()
-    ec2_client.detach_volume(VolumeId=volume_id)
-    waiter = ec2_client.get_waiter('volume_available')
-    robust_waiter(waiter, VolumeIds=[volume_id])
-    elapsed_time = datetime.now() - start_time
-    logger.info(f"Volume {volume_id} detached in {elapsed_time}")
-
-def stop_instance(session, instance_id):
-    ec2_client = session.client("ec2")
-    start_time = datetime.now()
-    ec2_client.stop_instances(InstanceIds=[instance_id])
-    waiter = ec2_client.get_waiter('instance_stopped')
-    robust_waiter(waiter, InstanceIds=[instance_id])
-    elapsed_time = datetime.now() - start_time
-    logger.info(f"Instance {instance_id} stopped in {elapsed_time}")
-
-def start_instance(session, instance_id):
-    ec2_client = session.client("ec2")
-    start_time = datetime.now()
-    ec2_client.start_instances(InstanceIds=[instance_id])
-    waiter = ec2_client.get_waiter('instance_running')
-    robust_waiter(waiter, InstanceIds=[instance_id])
-    elapsed_time = datetime.now() - start_time
-    logger.info(f"Instance {instance_id} started in {elapsed_time}")
-
-def log_volume_details(details):
-    VOLUME_DETAILS_LIST.append(details)
-
-def write_volume_details_to_file():
-    table = PrettyTable()
-    table.field_names = ["Old Volume ID", "New Volume ID", "Instance ID", "Instance Name", "Device Name", "Disk Size", "Snapshot ID", "Availability Zone"]
-
-    for detail in VOLUME_DETAILS_LIST:
-        table.add_row([detail["old_volume_id"], detail["new_volume_id"], detail["instance_id"], detail["instance_name"], detail["device_name"], detail["disk_size"], detail["snapshot_id"], detail["availability_zone"]])
-
-    with open(f'volume_changes_{datetime.now().strftime("%Y%m%d%H%M%S")}.csv', 'w') as file:
-        file.write(table.get_string())
-
-def process_volumes_for_instance(session, volumes, kms_key):
-    instance_id = volumes[0]['Attachments'][0]['InstanceId']
-    stop_instance(session, instance_id)
-
-    for volume in volumes:
-        volume_id = volume['VolumeId']
-        try:
-            snapshot_id = create_snapshot(session, volume_id)
-            encrypted_volume_id = create_encrypted_volume(session, snapshot_id, volume['AvailabilityZone'], volume['Size'], volume['VolumeType'], kms_key)
-            detach_volume(session, volume_id)
-            attach_encrypted_volume(session, encrypted_volume_id, instance_id, volume['Attachments'][0]['Device'])
-
-            instance_name = get_instance_name(session, instance_id)
-            details = {
-                'old_volume_id': volume_id,
-                'new_volume_id': encrypted_volume_id,
-                'instance_id': instance_id,
-                'instance_name': instance_name,
-                'device_name': volume['Attachments'][0]['Device'],
-                'disk_size': volume['Size'],
-                'snapshot_id': snapshot_id,
-                'availability_zone': volume['AvailabilityZone']
-            }
-            log_volume_details(details)
-        except botocore.exceptions.WaiterError:
-            PENDING_SNAPSHOTS.append({
-                'volume_id': volume_id,
-                'instance_id': instance_id,
-                'availability_zone': volume['AvailabilityZone'],
-                'size': volume['Size'],
-                'volume_type': volume['VolumeType'],
-                'kms_key': kms_key
-            })
-            logger.error(f"Snapshot creation for volume {volume_id} took too long. Adding to pending snapshots list.")
-
-    start_instance(session, instance_id)
-
-def process_pending_snapshots(session):
-    ec2_client = session.client("ec2")
-    retry_count = 0
-
-    while PENDING_SNAPSHOTS and retry_count < MAX_RETRIES:
-        completed_snapshots = []
-
-        for pending_snapshot in PENDING_SNAPSHOTS:
-            volume_id = pending_snapshot['volume_id']
-            response = ec2_client.describe_volumes(VolumeIds=[volume_id])
-            volume_status = response['Volumes'][0]['State']
-
-            if volume_status == 'completed':
-                completed_snapshots.append(pending_snapshot)
-                snapshot_id = create_snapshot(session, volume_id)
-                encrypted_volume_id = create_encrypted_volume(session, snapshot_id, pending_snapshot['availability_zone'], pending_snapshot['size'], pending_snapshot['volume_type'], pending_snapshot['kms_key'])
-                detach_volume(session, volume_id)
-                attach_encrypted_volume(session, encrypted_volume_id, pending_snapshot['instance_id'], pending_snapshot['device_name'])
-            else:
-                FAILED_SNAPSHOTS.append(pending_snapshot)
-
-        for completed_snapshot in completed_snapshots:
-            PENDING_SNAPSHOTS.remove(completed_snapshot)
-
-        if PENDING_SNAPSHOTS:
-            logger.info(f"Retrying processing of pending snapshots. Attempt {retry_count + 1} of {MAX_RETRIES}...")
-            retry_count += 1
-
-    if PENDING_SNAPSHOTS:
-        logger.error(f"Failed to process some snapshots even after {MAX_RETRIES} retries.")
-        for failed in PENDING_SNAPSHOTS:
-            logger.error(f"Failed snapshot details: {failed}")
-
-def main():
-    start_time = datetime.now()
-
-    session = create_session()
-    kms_key = get_kms_key_arn(session)
-    if not kms_key:
-        logger.error("Error: Could not retrieve the KMS key ARN. Exiting.")
-        return
-
-    volume_info = get_volume_info(session)
-
-    zone_to_instance_to_volumes_map = defaultdict(lambda: defaultdict(list))
-    encountered_zones = set()
-
-    for volume in volume_info:
-        if volume['State'] == 'in-use' and not volume['Encrypted']:
-            instance_id = volume['Attachments'][0]['InstanceId']
-            availability_zone = volume['AvailabilityZone']
-            encountered_zones.add(availability_zone)
-            zone_to_instance_to_volumes_map[availability_zone][instance_id].append(volume)
-
-    zones_order = list(encountered_zones)
-
-    for zone in zones_order:
-        logger.info(f"Processing volumes in availability zone: {zone}")
-        instance_to_volumes_map = zone_to_instance_to_volumes_map[zone]
-
-        for instance_id, volumes in instance_to_volumes_map.items():
-            process_volumes_for_instance(session, volumes, kms_key)
-
-    if PENDING_SNAPSHOTS:
-        logger.info("Processing pending snapshots...")
-        process_pending_snapshots(session)
-
-    write_volume_details_to_file()
-
-    elapsed_time = datetime.now() - start_time
-    logger.info(f"Script completed in {elapsed_time}")
-
-if __name__ == '__main__':
+import boto3
+import os
+import argparse
+import queue
+import threading
+import time
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import botocore
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
+import logging
+from waiters import DESCRIBE_BATCH_SIZE, ResourcePoller, ResourcesNotDescribed, describe_resources
+from journal import Journal, step_reached
+import planner
+import report
+from scheduler import JobQueue, JOB_ORDERS, DEFAULT_CRITICALITY
+from exclusions import load_rules
+from listofinstances import build_eks_node_index
+from ratelimit import RateLimiter, reset_counts, throttle_summary
+import metrics
+from metrics import timed_step, record_step
+import progress
+
+# Report sink receiving one row per encrypted volume (see report.py), opened by main.
+REPORT = None
+PENDING_SNAPSHOTS = []
+FAILED_SNAPSHOTS = []
+JOURNAL = None
+# (account ID, region) -> {'session', 'account_id', 'region', 'kms_key'} for every target of the run.
+TARGETS = {}
+
+logging.basicConfig(filename='script_logs.log', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger()
+
+MAX_RETRIES = 5
+# Snapshots that outlast their waiter are polled again with a delay doubling from
+# PENDING_POLL_DELAY up to PENDING_MAX_DELAY seconds, and given up after PENDING_TIMEOUT.
+PENDING_POLL_DELAY = 60
+PENDING_MAX_DELAY = 15 * 60
+PENDING_TIMEOUT = 6 * 60 * 60
+
+# Creating clients from a shared session is not thread safe, but the clients themselves are,
+# so every session gets exactly one client per service, created under a lock.
+CLIENT_POOL = {}
+POLLERS = {}
+RATE_LIMITERS = {}
+POOL_LOCK = threading.Lock()
+INSTANCE_CACHE = {}
+STOPPED_AT = {}
+# 'volume' encrypts while creating the new volume from the plain snapshot; 'copy' first
+# copies the snapshot to an encrypted one and creates the volume from the copy.
+ENCRYPTION_ENGINES = ['volume', 'copy']
+ENCRYPTION_ENGINE = 'volume'
+# EC2 runs at most 20 concurrent snapshot copies per destination region and account.
+MAX_CONCURRENT_COPIES = 20
+COPY_SLOTS = {}
+# A swap is rolled back when the encrypted volumes are not in use within ATTACH_TIMEOUT
+# seconds, or the restarted instance has not passed its status checks within
+# STATUS_CHECK_TIMEOUT seconds (0 skips the status checks).
+ATTACH_TIMEOUT = 10 * 60
+STATUS_CHECK_TIMEOUT = 15 * 60
+VERIFY_WORKERS = 16
+PROMETHEUS_TEXTFILE_INTERVAL = 15
+VOLUME_PAGE_SIZE = 500
+DISCOVERY_POLL_INTERVAL = 1
+DISCOVERY_WORKERS = 16
+ROLE_SESSION_NAME = 'volume-encryption'
+ACCOUNT_IDS = {}
+# A simulation.SimulatedCloud replaces AWS for every session when set (see use_simulation).
+SIMULATED_CLOUD = None
+
+def create_session(region_name=None, role_arn=None):
+    if SIMULATED_CLOUD:
+        return SIMULATED_CLOUD.session(region_name or os.environ.get('AWS_DEFAULT_REGION'), role_arn)
+    session = boto3.Session(
+        region_name=region_name or os.environ.get('AWS_DEFAULT_REGION'),
+        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+        aws_session_token=os.environ.get('AWS_SESSION_TOKEN'),
+    )
+    if role_arn:
+        return assume_role_session(session, role_arn)
+    return session
+
+def use_simulation(cloud):
+    # Points every new session at the simulated cloud (or back at AWS when None) and drops
+    # the clients and caches of earlier runs.
+    global SIMULATED_CLOUD
+    SIMULATED_CLOUD = cloud
+    with POOL_LOCK:
+        CLIENT_POOL.clear()
+        POLLERS.clear()
+        RATE_LIMITERS.clear()
+    INSTANCE_CACHE.clear()
+    ACCOUNT_IDS.clear()
+    PENDING_SNAPSHOTS.clear()
+    FAILED_SNAPSHOTS.clear()
+
+def assume_role_session(session, role_arn):
+    # Runs outlast the one hour lifetime of assumed role credentials, so they are
+    # refreshed automatically whenever they are about to expire.
+    sts_client = session.client('sts')
+
+    def refresh():
+        credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    botocore_session = get_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(metadata=refresh(), refresh_using=refresh, method='sts-assume-role')
+    botocore_session.set_config_variable('region', session.region_name)
+    return boto3.Session(botocore_session=botocore_session)
+
+def get_client(session, service):
+    # Every client of a session shares its region and account's rate limiter.
+    with POOL_LOCK:
+        if (session, service) not in CLIENT_POOL:
+            if session not in RATE_LIMITERS:
+                RATE_LIMITERS[session] = RateLimiter(session.region_name)
+            client = session.client(service)
+            RATE_LIMITERS[session].install(client)
+            CLIENT_POOL[(session, service)] = client
+        return CLIENT_POOL[(session, service)]
+
+def get_account_id(session):
+    if session not in ACCOUNT_IDS:
+        ACCOUNT_IDS[session] = get_client(session, 'sts').get_caller_identity()['Account']
+    return ACCOUNT_IDS[session]
+
+def get_poller(session):
+    # A single poller per session batches the waits of every worker thread.
+    ec2_client = get_client(session, "ec2")
+    with POOL_LOCK:
+        if session not in POLLERS:
+            POLLERS[session] = ResourcePoller(ec2_client)
+        return POLLERS[session]
+
+def snapshot_progress(snapshot_id):
+    # The Progress the pollers last saw for a snapshot, None before its first poll.
+    with POOL_LOCK:
+        pollers = list(POLLERS.values())
+    for poller in pollers:
+        if snapshot_id in poller.snapshot_progress:
+            return poller.snapshot_progress[snapshot_id]
+    return None
+
+def prefetch_instances(session, instance_ids):
+    # Loads name, tags and state of the whole fleet with a handful of paginated calls.
+    ec2_client = get_client(session, "ec2")
+    paginator = ec2_client.get_paginator('describe_instances')
+    instance_ids = sorted(set(instance_ids) - set(INSTANCE_CACHE))
+    for i in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE):
+        batch = instance_ids[i:i + DESCRIBE_BATCH_SIZE]
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': batch}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    INSTANCE_CACHE[instance['InstanceId']] = instance
+
+def get_instance(session, instance_id):
+    if instance_id not in INSTANCE_CACHE:
+        prefetch_instances(session, [instance_id])
+    return INSTANCE_CACHE.get(instance_id)
+
+def get_instance_name(session, instance_id):
+    instance = get_instance(session, instance_id) or {}
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == 'Name':
+            return tag['Value']
+    return None
+
+def get_kms_key_arn(session, alias_name='alias/aws/ebs'):
+    kms_client = get_client(session, 'kms')
+    try:
+        response = kms_client.describe_key(KeyId=alias_name)
+        return response['KeyMetadata']['Arn']
+    except kms_client.exceptions.NotFoundException:
+        logger.error(f"KMS key with alias {alias_name} not found.")
+        return None
+
+def volume_filters(availability_zones=None, tags=None, volume_ids=None):
+    filters = [
+        {'Name': 'encrypted', 'Values': ['false']},
+        {'Name': 'status', 'Values': ['in-use']},
+    ]
+    if availability_zones:
+        filters.append({'Name': 'availability-zone', 'Values': list(availability_zones)})
+    for key, value in (tags or {}).items():
+        filters.append({'Name': f'tag:{key}', 'Values': [value]})
+    if volume_ids:
+        filters.append({'Name': 'volume-id', 'Values': list(volume_ids)})
+    return filters
+
+def iter_volume_pages(session, availability_zones=None, tags=None, volume_ids=None):
+    # Unencrypted in-use volumes, filtered server side and streamed page by page.
+    ec2_client = get_client(session, "ec2")
+    paginator = ec2_client.get_paginator('describe_volumes')
+    page_size = None if volume_ids else VOLUME_PAGE_SIZE
+    for page in paginator.paginate(Filters=volume_filters(availability_zones, tags, volume_ids), PaginationConfig={'PageSize': page_size}):
+        yield page['Volumes']
+
+def iter_instance_jobs(session, account_id, availability_zones=None, tags=None):
+    # Yields one job per instance as soon as the page holding its volumes has been read.
+    # An instance's volumes can be split across pages, so the ones not on the current page
+    # are looked up through its block device mappings in one batched call.
+    handled_instances = set()
+    for page in iter_volume_pages(session, availability_zones, tags):
+        volumes_by_instance = defaultdict(dict)
+        for volume in page:
+            instance_id = volume['Attachments'][0]['InstanceId']
+            if instance_id not in handled_instances:
+                volumes_by_instance[instance_id][volume['VolumeId']] = volume
+        prefetch_instances(session, list(volumes_by_instance))
+
+        missing_volume_ids = []
+        for instance_id, volumes in volumes_by_instance.items():
+            instance = INSTANCE_CACHE.get(instance_id, {})
+            for mapping in instance.get('BlockDeviceMappings', []):
+                if 'Ebs' in mapping and mapping['Ebs']['VolumeId'] not in volumes:
+                    missing_volume_ids.append(mapping['Ebs']['VolumeId'])
+        for i in range(0, len(missing_volume_ids), DESCRIBE_BATCH_SIZE):
+            for extra_page in iter_volume_pages(session, availability_zones, tags, missing_volume_ids[i:i + DESCRIBE_BATCH_SIZE]):
+                for volume in extra_page:
+                    volumes_by_instance[volume['Attachments'][0]['InstanceId']][volume['VolumeId']] = volume
+
+        for instance_id, volumes in volumes_by_instance.items():
+            handled_instances.add(instance_id)
+            volumes = list(volumes.values())
+            yield {
+                'instance_id': instance_id,
+                'availability_zone': volumes[0]['AvailabilityZone'],
+                'account_id': account_id,
+                'region': session.region_name,
+                'volumes': volumes
+            }
+
+def start_snapshot(session, volume_id, description=''):
+    ec2_client = get_client(session, "ec2")
+    response = ec2_client.create_snapshot(VolumeId=volume_id, Description=description)
+    return response['SnapshotId']
+
+def wait_for_snapshots(session, snapshot_ids):
+    # Yields each snapshot ID as soon as it completes.
+    return get_poller(session).wait_each('snapshot', snapshot_ids, 'completed')
+
+def start_encrypted_volume(session, snapshot_id, availability_zone, size, volume_type, kms_key):
+    ec2_client = get_client(session, "ec2")
+    response = ec2_client.create_volume(
+        SnapshotId=snapshot_id,
+        AvailabilityZone=availability_zone,
+        Size=size,
+        VolumeType=volume_type,
+        Encrypted=True,
+        KmsKeyId=kms_key,
+    )
+    return response['VolumeId']
+
+def copy_slots(session):
+    with POOL_LOCK:
+        if session not in COPY_SLOTS:
+            COPY_SLOTS[session] = threading.BoundedSemaphore(MAX_CONCURRENT_COPIES)
+        return COPY_SLOTS[session]
+
+def release_copy_slot(session, copy_id, slots):
+    try:
+        get_poller(session).wait('snapshot', [copy_id], 'completed')
+    except botocore.exceptions.WaiterError:
+        pass
+    finally:
+        slots.release()
+
+def start_encrypted_copy(session, snapshot_id, kms_key, description=''):
+    # Blocks while the region already runs its maximum of copies. The slot is given back by
+    # a watcher thread once the copy completes, so a worker never waits on its own copies.
+    ec2_client = get_client(session, "ec2")
+    slots = copy_slots(session)
+    slots.acquire()
+    try:
+        response = ec2_client.copy_snapshot(
+            SourceSnapshotId=snapshot_id,
+            SourceRegion=session.region_name,
+            Encrypted=True,
+            KmsKeyId=kms_key,
+            Description=description,
+        )
+    except Exception:
+        slots.release()
+        raise
+    copy_id = response['SnapshotId']
+    threading.Thread(target=release_copy_slot, args=(session, copy_id, slots), name='copy-slot', daemon=True).start()
+    return copy_id
+
+def attach_encrypted_volume(session, encrypted_volume_id, instance_id, device_name):
+    ec2_client = get_client(session, "ec2")
+    ec2_client.attach_volume(
+        VolumeId=encrypted_volume_id,
+        InstanceId=instance_id,
+        Device=device_name
+    )
+
+def detach_volume(session, volume_id, volume_type=None):
+    ec2_client = get_client(session, "ec2")
+    with timed_step('detach_volume', volume_type, volume_id=volume_id, region=session.region_name) as step:
+        ec2_client.detach_volume(VolumeId=volume_id)
+        get_poller(session).wait('volume', [volume_id], 'available')
+    logger.info(f"Volume {volume_id} detached in {step.elapsed}")
+
+class SwapRolledBack(Exception):
+    pass
+
+def detach_volumes(session, instance_id, volumes):
+    volume_ids = [volume['VolumeId'] for volume in volumes]
+    if len(volumes) == 1:
+        detach_volume(session, volume_ids[0], volumes[0]['VolumeType'])
+        return
+    ec2_client = get_client(session, "ec2")
+    with timed_step('detach_volumes', instance_id=instance_id, volume_count=len(volume_ids), region=session.region_name) as step:
+        for volume_id in volume_ids:
+            ec2_client.detach_volume(VolumeId=volume_id)
+        get_poller(session).wait('volume', volume_ids, 'available')
+    logger.info(f"Volumes {volume_ids} detached in {step.elapsed}")
+
+def swap_volumes(session, instance_id, swaps):
+    # Replaces the original volumes of a stopped instance by their encrypted copies as one
+    # unit. Each swap holds the original 'volume', with its attachment, and the
+    # 'new_volume_id'. When a detach or attach fails, or the encrypted volumes are not in use
+    # in time, the original volumes are put back before SwapRolledBack is raised.
+    try:
+        attached_volumes = [swap['volume'] for swap in swaps if not volume_step_reached(swap['volume']['VolumeId'], 'detached')]
+        in_use_volume_ids = set()
+        if len(attached_volumes) < len(swaps):
+            # A resumed swap may have attached some encrypted volumes already.
+            new_volumes = describe_resources(get_client(session, "ec2"), 'volume', [swap['new_volume_id'] for swap in swaps])
+            in_use_volume_ids = {volume['VolumeId'] for volume in new_volumes if volume['State'] == 'in-use'}
+        if attached_volumes:
+            detach_volumes(session, instance_id, attached_volumes)
+        for volume in attached_volumes:
+            journal_record_volume(volume['VolumeId'], 'detached')
+        for swap in swaps:
+            if swap['new_volume_id'] in in_use_volume_ids:
+                continue
+            volume = swap['volume']
+            with timed_step('attach_volume', volume['VolumeType'], volume_id=volume['VolumeId'], region=session.region_name):
+                attach_encrypted_volume(session, swap['new_volume_id'], instance_id, volume['Attachments'][0]['Device'])
+        get_poller(session).wait('volume', [swap['new_volume_id'] for swap in swaps], 'in-use', ATTACH_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Swapping the volumes of instance {instance_id} failed. Rolling back. Error: {str(e)}")
+        roll_back_swap(session, instance_id, swaps)
+        raise SwapRolledBack(f"Volumes of instance {instance_id} were rolled back after: {str(e)}") from e
+    for swap in swaps:
+        journal_record_volume(swap['volume']['VolumeId'], 'attached')
+
+def attachment_state(volume, instance_id):
+    # 'attaching', 'attached' or 'detaching' while the volume is attached to the instance;
+    # None once it is detached from it. A detaching volume still reports State 'in-use'.
+    for attachment in volume.get('Attachments', []):
+        if attachment['InstanceId'] == instance_id:
+            return attachment['State']
+    return None
+
+def roll_back_swap(session, instance_id, swaps):
+    # Detaches whichever encrypted volumes got attached and reattaches the original volumes
+    # to their devices, from whatever step the swap had reached. Volumes still detaching are
+    # waited on first, so no original is left out. The encrypted volumes are kept, and the
+    # journal moves the volumes back so --resume tries the swap again.
+    ec2_client = get_client(session, "ec2")
+    poller = get_poller(session)
+    volume_ids = [swap['new_volume_id'] for swap in swaps] + [swap['volume']['VolumeId'] for swap in swaps]
+    attachments = {volume['VolumeId']: attachment_state(volume, instance_id) for volume in describe_resources(ec2_client, 'volume', volume_ids)}
+
+    new_volume_ids = [swap['new_volume_id'] for swap in swaps if attachments.get(swap['new_volume_id'])]
+    for volume_id in new_volume_ids:
+        if attachments[volume_id] != 'detaching':
+            ec2_client.detach_volume(VolumeId=volume_id)
+    detaching_volume_ids = [swap['volume']['VolumeId'] for swap in swaps if attachments.get(swap['volume']['VolumeId']) == 'detaching']
+    poller.wait('volume', new_volume_ids + detaching_volume_ids, 'available', ATTACH_TIMEOUT)
+
+    detached_swaps = [swap for swap in swaps if attachments.get(swap['volume']['VolumeId']) in (None, 'detaching')]
+    for swap in detached_swaps:
+        volume = swap['volume']
+        ec2_client.attach_volume(VolumeId=volume['VolumeId'], InstanceId=instance_id, Device=volume['Attachments'][0]['Device'])
+    poller.wait('volume', [swap['volume']['VolumeId'] for swap in swaps], 'in-use', ATTACH_TIMEOUT)
+
+    for swap in swaps:
+        progress.volume_step(swap['volume']['VolumeId'], 'rolled_back')
+        if JOURNAL:
+            JOURNAL.reset_volume(swap['volume']['VolumeId'], 'volume_created')
+    journal_record_instance(instance_id, 'rolled_back')
+    report_swaps(swaps, 'rolled_back')
+    logger.warning(f"Instance {instance_id} has its original volumes {[swap['volume']['VolumeId'] for swap in swaps]} back. "
+                   f"Encrypted volumes {[swap['new_volume_id'] for swap in swaps]} were kept.")
+
+def missing_devices(session, instance_id, volumes):
+    # Devices of the instance that have neither their original nor their encrypted volume
+    # attached.
+    new_volume_ids = {volume['VolumeId']: journal_volume(volume['VolumeId']).get('new_volume_id') for volume in volumes}
+    volume_ids = list(new_volume_ids) + [volume_id for volume_id in new_volume_ids.values() if volume_id]
+    attached = {volume['VolumeId'] for volume in describe_resources(get_client(session, "ec2"), 'volume', volume_ids)
+                if attachment_state(volume, instance_id) in ('attaching', 'attached')}
+    return [volume['Attachments'][0]['Device'] for volume in volumes
+            if volume['VolumeId'] not in attached and new_volume_ids[volume['VolumeId']] not in attached]
+
+def restart_after_failure(session, instance_id, volumes):
+    # Called on any failure while the instance is stopped. It is started again when every
+    # device still has a volume; otherwise it is left stopped for someone to fix by hand.
+    # Returns whether the instance is running again.
+    try:
+        missing = missing_devices(session, instance_id, volumes)
+        if missing:
+            logger.critical(f"Instance {instance_id} is left STOPPED: devices {missing} have no volume attached. "
+                            f"Reattach the original or encrypted volumes by hand before starting it.")
+            return False
+        start_instance(session, instance_id)
+        return True
+    except Exception as e:
+        logger.critical(f"Instance {instance_id} is left STOPPED and could not be started again after a failure. "
+                        f"Check its volumes and start it by hand. Error: {str(e)}")
+        return False
+
+def verify_instance(job, swaps):
+    # Runs on the verification pool once the instance has been restarted, so the worker is
+    # free for the next instance; the status checks of every instance being verified are
+    # read by the same batched describe_instance_status calls. An instance failing its checks
+    # is stopped, given its original volumes back and started again; one whose checks could
+    # not be read keeps its encrypted volumes.
+    session = TARGETS[(job['account_id'], job['region'])]['session']
+    instance_id = job['instance_id']
+    try:
+        with timed_step('status_checks', instance_id=instance_id, region=job['region']) as step:
+            get_poller(session).wait('instance_status', [instance_id], 'ok', STATUS_CHECK_TIMEOUT)
+    except ResourcesNotDescribed as e:
+        logger.warning(f"Could not read the status checks of instance {instance_id}; keeping its encrypted volumes. "
+                       f"Check the instance by hand. Error: {str(e)}")
+        report_swaps(swaps)
+        return
+    except botocore.exceptions.WaiterError as e:
+        logger.error(f"Instance {instance_id} did not pass its status checks after the swap. Rolling back. Error: {str(e)}")
+        stop_instance(session, instance_id)
+        try:
+            roll_back_swap(session, instance_id, swaps)
+        except Exception:
+            restart_after_failure(session, instance_id, [swap['volume'] for swap in swaps])
+            raise
+        start_instance(session, instance_id)
+        raise SwapRolledBack(f"Volumes of instance {instance_id} were rolled back after failed status checks") from e
+    logger.info(f"Instance {instance_id} passed its status checks in {step.elapsed}")
+    report_swaps(swaps)
+
+def stop_instance(session, instance_id):
+    ec2_client = get_client(session, "ec2")
+    STOPPED_AT[instance_id] = time.monotonic()
+    with timed_step('stop_instance', instance_id=instance_id, region=session.region_name) as step:
+        ec2_client.stop_instances(InstanceIds=[instance_id])
+        get_poller(session).wait('instance', [instance_id], 'stopped')
+    logger.info(f"Instance {instance_id} stopped in {step.elapsed}")
+    journal_record_instance(instance_id, 'stopped')
+
+def start_instance(session, instance_id):
+    ec2_client = get_client(session, "ec2")
+    with timed_step('start_instance', instance_id=instance_id, region=session.region_name) as step:
+        ec2_client.start_instances(InstanceIds=[instance_id])
+        get_poller(session).wait('instance', [instance_id], 'running')
+    logger.info(f"Instance {instance_id} started in {step.elapsed}")
+    journal_record_instance(instance_id, 'restarted')
+    if instance_id in STOPPED_AT:
+        record_step('instance_downtime', time.monotonic() - STOPPED_AT.pop(instance_id), instance_id=instance_id, region=session.region_name)
+
+def volume_details(session, instance_id, volume, encrypted_volume_id, snapshot_id, baseline_snapshot_id=None):
+    return {
+        'old_volume_id': volume['VolumeId'],
+        'new_volume_id': encrypted_volume_id,
+        'instance_id': instance_id,
+        'instance_name': get_instance_name(session, instance_id),
+        'device_name': volume['Attachments'][0]['Device'],
+        'disk_size': volume['Size'],
+        'snapshot_id': snapshot_id,
+        'baseline_snapshot_id': baseline_snapshot_id,
+        'encrypted_snapshot_id': journal_volume(volume['VolumeId']).get('copy_id'),
+        'baseline_encrypted_snapshot_id': journal_volume(volume['VolumeId']).get('baseline_copy_id'),
+        'availability_zone': volume['AvailabilityZone'],
+        'region': session.region_name,
+        'account_id': get_account_id(session),
+        'completed_at': datetime.now().isoformat(timespec='seconds')
+    }
+
+def log_volume_details(details):
+    if REPORT:
+        REPORT.write(details)
+
+def report_swaps(swaps, status='swapped'):
+    # Rows are only written once a swap is final: after the instance passed its status
+    # checks, or as a 'rolled_back' row, whose kept encrypted volume cleanup.py deletes.
+    completed_at = datetime.now().isoformat(timespec='seconds')
+    for swap in swaps:
+        log_volume_details({**swap['details'], 'status': status, 'completed_at': completed_at})
+
+def write_volume_details_table(report_path, report_format=None):
+    # Rendered from the report file, not from memory, so it also works after a crash.
+    table_path = f"{os.path.splitext(report_path)[0]}.txt"
+    with open(table_path, 'w') as file:
+        file.write(report.render_table(report_path, report_format).get_string())
+    logger.info(f"Volume table written to {table_path}")
+
+def stalled_snapshot_id(volume_id):
+    # The snapshot or encrypted copy the volume was still waiting on, from the journal; None
+    # when it stalled later, on the encrypted volume.
+    journaled = journal_volume(volume_id)
+    if journaled.get('copy_id') and not step_reached(journaled['step'], 'copied'):
+        return journaled['copy_id']
+    if journaled.get('snapshot_id') and not step_reached(journaled['step'], 'snapshotted'):
+        return journaled['snapshot_id']
+    return None
+
+def add_pending_snapshot(session, volume, instance_id, kms_key):
+    PENDING_SNAPSHOTS.append({
+        'account_id': get_account_id(session),
+        'region': session.region_name,
+        'volume_id': volume['VolumeId'],
+        'instance_id': instance_id,
+        'availability_zone': volume['AvailabilityZone'],
+        'device_name': volume['Attachments'][0]['Device'],
+        'size': volume['Size'],
+        'volume_type': volume['VolumeType'],
+        'kms_key': kms_key,
+        'snapshot_id': stalled_snapshot_id(volume['VolumeId']),
+        'step': journal_volume(volume['VolumeId']).get('step'),
+        'volume': volume,
+    })
+    logger.error(f"Snapshot creation for volume {volume['VolumeId']} took too long. Adding to pending snapshots list.")
+
+def journal_volume(volume_id):
+    return JOURNAL.get_volume(volume_id) if JOURNAL else {}
+
+def journal_record_volume(volume_id, step, **resource_ids):
+    progress.volume_step(volume_id, step, **resource_ids)
+    if JOURNAL:
+        JOURNAL.record_volume(volume_id, step, **resource_ids)
+
+def journal_record_instance(instance_id, step):
+    progress.instance_step(instance_id, step)
+    if JOURNAL:
+        JOURNAL.record_instance(instance_id, step)
+
+def start_snapshot_once(session, volume_id):
+    # A snapshot started before an interruption is waited on again instead of being retaken.
+    snapshot_id = journal_volume(volume_id).get('snapshot_id')
+    if not snapshot_id:
+        snapshot_id = start_snapshot(session, volume_id)
+        journal_record_volume(volume_id, 'snapshot_started', snapshot_id=snapshot_id)
+    return snapshot_id
+
+def start_encrypted_volume_once(session, volume, snapshot_id, kms_key):
+    encrypted_volume_id = journal_volume(volume['VolumeId']).get('new_volume_id')
+    if not encrypted_volume_id:
+        encrypted_volume_id = start_encrypted_volume(session, snapshot_id, volume['AvailabilityZone'], volume['Size'], volume['VolumeType'], kms_key)
+        journal_record_volume(volume['VolumeId'], 'volume_created', new_volume_id=encrypted_volume_id)
+    return encrypted_volume_id
+
+def start_encrypted_copy_once(session, volume_id, snapshot_id, kms_key, baseline=False):
+    id_key, step = ('baseline_copy_id', 'baseline_copy_started') if baseline else ('copy_id', 'copy_started')
+    copy_id = journal_volume(volume_id).get(id_key)
+    if not copy_id:
+        copy_id = start_encrypted_copy(session, snapshot_id, kms_key, f"Encrypted copy of {snapshot_id} for {volume_id}")
+        journal_record_volume(volume_id, step, **{id_key: copy_id})
+    return copy_id
+
+def volume_step_reached(volume_id, step):
+    return step_reached(journal_volume(volume_id).get('step'), step)
+
+def process_volumes_for_instance(session, volumes, kms_key):
+    instance_id = volumes[0]['Attachments'][0]['InstanceId']
+    stop_instance(session, instance_id)
+
+    swaps = []
+    try:
+        for volume in volumes:
+            volume_id = volume['VolumeId']
+            if volume_step_reached(volume_id, 'attached'):
+                continue
+            labels = {'volume_type': volume['VolumeType'], 'volume_id': volume_id, 'region': session.region_name}
+            try:
+                with timed_step('snapshot', size_gb=volume['Size'], **labels):
+                    snapshot_id = start_snapshot_once(session, volume_id)
+                    get_poller(session).wait('snapshot', [snapshot_id], 'completed')
+                journal_record_volume(volume_id, 'snapshotted')
+                source_snapshot_id = snapshot_id
+                if ENCRYPTION_ENGINE == 'copy':
+                    with timed_step('copy_snapshot', size_gb=volume['Size'], **labels):
+                        source_snapshot_id = start_encrypted_copy_once(session, volume_id, snapshot_id, kms_key)
+                        get_poller(session).wait('snapshot', [source_snapshot_id], 'completed')
+                    journal_record_volume(volume_id, 'copied')
+                with timed_step('create_volume', size_gb=volume['Size'], **labels):
+                    encrypted_volume_id = start_encrypted_volume_once(session, volume, source_snapshot_id, kms_key)
+                    if not volume_step_reached(volume_id, 'detached'):
+                        # Otherwise a resumed swap may have attached it already.
+                        get_poller(session).wait('volume', [encrypted_volume_id], 'available')
+            except botocore.exceptions.WaiterError:
+                add_pending_snapshot(session, volume, instance_id, kms_key)
+                continue
+
+            swap = {'volume': volume, 'new_volume_id': encrypted_volume_id,
+                    'details': volume_details(session, instance_id, volume, encrypted_volume_id, snapshot_id)}
+            swap_volumes(session, instance_id, [swap])
+            swaps.append(swap)
+        start_instance(session, instance_id)
+    except Exception as e:
+        e.restarted = restart_after_failure(session, instance_id, volumes)
+        # The volumes swapped before the failure are still verified and reported.
+        e.completed_swaps = swaps
+        raise
+    return swaps
+
+def wait_for_timed_snapshots(session, volumes_by_snapshot, started_at, step='snapshot'):
+    # Yields each snapshot as it completes and records how long it took for its volume.
+    for snapshot_id in wait_for_snapshots(session, list(volumes_by_snapshot)):
+        volume = volumes_by_snapshot[snapshot_id]
+        record_step(step, time.monotonic() - started_at, volume['VolumeType'], volume['Size'], volume_id=volume['VolumeId'], region=session.region_name)
+        yield snapshot_id
+
+def encrypt_volumes_of_stopped_instance(session, instance_id, volumes, kms_key, baseline_snapshot_ids=None):
+    baseline_snapshot_ids = baseline_snapshot_ids or {}
+
+    snapshots_started_at = time.monotonic()
+    volumes_by_snapshot = {}
+    for volume in volumes:
+        if not volume_step_reached(volume['VolumeId'], 'attached'):
+            volumes_by_snapshot[start_snapshot_once(session, volume['VolumeId'])] = volume
+
+    # Build each encrypted volume as soon as its snapshot is ready instead of waiting for the slowest one.
+    encrypted_volume_ids = {}
+    volume_started_at = {}
+    copies = {}
+    try:
+        # Snapshots taken after a baseline only copy the changed blocks, so they are timed separately.
+        snapshot_step, copy_step = ('incremental_snapshot', 'incremental_copy') if baseline_snapshot_ids else ('snapshot', 'copy_snapshot')
+        for snapshot_id in wait_for_timed_snapshots(session, volumes_by_snapshot, snapshots_started_at, snapshot_step):
+            volume = volumes_by_snapshot[snapshot_id]
+            journal_record_volume(volume['VolumeId'], 'snapshotted')
+            if ENCRYPTION_ENGINE == 'copy':
+                copies[start_encrypted_copy_once(session, volume['VolumeId'], snapshot_id, kms_key)] = snapshot_id
+                continue
+            volume_started_at[snapshot_id] = time.monotonic()
+            encrypted_volume_ids[snapshot_id] = start_encrypted_volume_once(session, volume, snapshot_id, kms_key)
+
+        # Copies started as their snapshots completed; volumes are created as each copy completes.
+        copies_started_at = time.monotonic()
+        volumes_by_copy = {copy_id: volumes_by_snapshot[snapshot_id] for copy_id, snapshot_id in copies.items()}
+        for copy_id in wait_for_timed_snapshots(session, volumes_by_copy, copies_started_at, copy_step):
+            snapshot_id = copies[copy_id]
+            volume = volumes_by_snapshot[snapshot_id]
+            journal_record_volume(volume['VolumeId'], 'copied')
+            volume_started_at[snapshot_id] = time.monotonic()
+            encrypted_volume_ids[snapshot_id] = start_encrypted_volume_once(session, volume, copy_id, kms_key)
+    except botocore.exceptions.WaiterError:
+        for snapshot_id, volume in volumes_by_snapshot.items():
+            if snapshot_id not in encrypted_volume_ids:
+                add_pending_snapshot(session, volume, instance_id, kms_key)
+
+    if encrypted_volume_ids:
+        # Encrypted volumes of a resumed swap were available before it started and may be attached by now.
+        snapshots_by_volume = {encrypted_volume_id: snapshot_id for snapshot_id, encrypted_volume_id in encrypted_volume_ids.items()
+                               if not volume_step_reached(volumes_by_snapshot[snapshot_id]['VolumeId'], 'detached')}
+        for encrypted_volume_id in get_poller(session).wait_each('volume', list(snapshots_by_volume), 'available'):
+            snapshot_id = snapshots_by_volume[encrypted_volume_id]
+            volume = volumes_by_snapshot[snapshot_id]
+            record_step('create_volume', time.monotonic() - volume_started_at[snapshot_id], volume['VolumeType'], volume['Size'],
+                        volume_id=volume['VolumeId'], region=session.region_name)
+
+        # Swap every volume of the instance in one batch.
+        swaps = []
+        for snapshot_id, encrypted_volume_id in encrypted_volume_ids.items():
+            volume = volumes_by_snapshot[snapshot_id]
+            baseline_snapshot_id = baseline_snapshot_ids.get(volume['VolumeId']) or journal_volume(volume['VolumeId']).get('baseline_snapshot_id')
+            swaps.append({'volume': volume, 'new_volume_id': encrypted_volume_id,
+                          'details': volume_details(session, instance_id, volume, encrypted_volume_id, snapshot_id, baseline_snapshot_id)})
+        swap_volumes(session, instance_id, swaps)
+        return swaps
+    return []
+
+def encrypt_and_restart(session, instance_id, volumes, kms_key, baseline_snapshot_ids=None):
+    swaps = []
+    try:
+        swaps = encrypt_volumes_of_stopped_instance(session, instance_id, volumes, kms_key, baseline_snapshot_ids)
+        start_instance(session, instance_id)
+    except Exception as e:
+        e.restarted = restart_after_failure(session, instance_id, volumes)
+        e.completed_swaps = swaps
+        raise
+    return swaps
+
+def process_volumes_for_instance_overlapped(session, volumes, kms_key):
+    instance_id = volumes[0]['Attachments'][0]['InstanceId']
+    stop_instance(session, instance_id)
+    return encrypt_and_restart(session, instance_id, volumes, kms_key)
+
+def take_baseline_snapshots(session, volumes, kms_key=None):
+    # Full snapshots taken while the instance is still running, so the snapshots taken
+    # after the stop only have to copy the blocks changed since. With the copy engine the
+    # baselines are also copied encrypted, which makes the later copies incremental too.
+    start_time = datetime.now()
+    baseline_snapshot_ids = {}
+    volumes_by_snapshot = {}
+    for volume in volumes:
+        record = journal_volume(volume['VolumeId'])
+        if step_reached(record.get('step'), 'snapshot_started'):
+            continue
+        baseline_snapshot_id = record.get('baseline_snapshot_id')
+        if not baseline_snapshot_id:
+            baseline_snapshot_id = start_snapshot(session, volume['VolumeId'], f"Baseline for encryption of {volume['VolumeId']}")
+            journal_record_volume(volume['VolumeId'], 'baseline_snapshotted', baseline_snapshot_id=baseline_snapshot_id)
+        baseline_snapshot_ids[volume['VolumeId']] = baseline_snapshot_id
+        volumes_by_snapshot[baseline_snapshot_id] = volume
+    try:
+        copies = {}
+        for snapshot_id in wait_for_timed_snapshots(session, volumes_by_snapshot, time.monotonic(), 'baseline_snapshot'):
+            if ENCRYPTION_ENGINE == 'copy':
+                volume = volumes_by_snapshot[snapshot_id]
+                copies[start_encrypted_copy_once(session, volume['VolumeId'], snapshot_id, kms_key, baseline=True)] = volume
+        for _ in wait_for_timed_snapshots(session, copies, time.monotonic(), 'baseline_copy'):
+            pass
+    except botocore.exceptions.WaiterError:
+        logger.error(f"Baseline snapshots {list(baseline_snapshot_ids.values())} did not complete. The final snapshots will be full copies.")
+    logger.info(f"Baseline snapshots {list(baseline_snapshot_ids.values())} created in {datetime.now() - start_time}")
+    return baseline_snapshot_ids
+
+def process_volumes_for_instance_pre_stop(session, volumes, kms_key):
+    instance_id = volumes[0]['Attachments'][0]['InstanceId']
+    baseline_snapshot_ids = take_baseline_snapshots(session, volumes, kms_key)
+    stop_instance(session, instance_id)
+    return encrypt_and_restart(session, instance_id, volumes, kms_key, baseline_snapshot_ids)
+
+def process_volumes_for_instance_baseline_only(session, volumes, kms_key):
+    # Prepares the downtime window without touching the instance; a later run with
+    # --resume in pre-stop mode stops it and only has to take incremental snapshots.
+    take_baseline_snapshots(session, volumes, kms_key)
+    return []
+
+SNAPSHOT_MODES = {
+    'serial': process_volumes_for_instance,
+    'overlap': process_volumes_for_instance_overlapped,
+    'pre-stop': process_volumes_for_instance_pre_stop,
+    'baseline-only': process_volumes_for_instance_baseline_only,
+}
+
+def process_instance_job(job, snapshot_mode='serial'):
+    target = TARGETS[(job['account_id'], job['region'])]
+    if JOURNAL:
+        JOURNAL.record_job(job)
+    progress.job_started(job)
+    with timed_step('instance', instance_id=job['instance_id'], volume_count=len(job['volumes']), snapshot_mode=snapshot_mode, region=job['region']) as step:
+        swaps = SNAPSHOT_MODES[snapshot_mode](target['session'], job['volumes'], target['kms_key'])
+    logger.info(f"Instance {job['instance_id']} in {job['availability_zone']} ({job['account_id']}) processed in {step.elapsed}")
+    return swaps
+
+def job_fits(job, az_in_flight, account_in_flight, max_per_az, max_per_account):
+    if max_per_az and az_in_flight[(job['account_id'], job['availability_zone'])] >= max_per_az:
+        return False
+    if max_per_account and account_in_flight[job['account_id']] >= max_per_account:
+        return False
+    return True
+
+def stream_in_background(job_sources):
+    # Every source (one per region and account) is drained on its own discovery thread
+    # into a single queue; None marks the end of all of them.
+    items = queue.Queue()
+
+    def produce(source):
+        try:
+            for item in source:
+                items.put(item)
+        except Exception as e:
+            logger.error(f"Discovery failed. Error: {str(e)}")
+
+    def produce_all():
+        with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS, thread_name_prefix='discovery') as executor:
+            for source in job_sources:
+                executor.submit(produce, source)
+        items.put(None)
+
+    threading.Thread(target=produce_all, name='discovery', daemon=True).start()
+    return items
+
+def skip_instances(jobs, instance_ids):
+    for job in jobs:
+        if job['instance_id'] not in instance_ids:
+            yield job
+
+def exclusion_rules(args):
+    rules = load_rules(args.exclusions)
+    if args.max_volume_size is not None:
+        rules.max_volume_size_gb = args.max_volume_size
+    if args.include_eks_nodes:
+        rules.eks_clusters.clear()
+    elif args.discover_eks_nodes:
+        for target in TARGETS.values():
+            session = target['session']
+            node_index = build_eks_node_index(get_client(session, 'eks'), get_client(session, 'ec2'))
+            rules.eks_nodes.update({instance_id: entry['cluster'] for instance_id, entry in node_index.items()})
+        logger.info(f"Found {len(rules.eks_nodes)} EKS nodes through their clusters and node groups")
+    return rules
+
+def apply_exclusions(jobs, rules, excluded=None):
+    # Instances come from the cache discovery has just filled, so this costs no API calls.
+    for job in jobs:
+        instance = None
+        if rules.needs_instance:
+            instance = get_instance(TARGETS[(job['account_id'], job['region'])]['session'], job['instance_id'])
+        reason = rules.reason(job['instance_id'], job['volumes'], instance)
+        if reason is None:
+            yield job
+            continue
+        logger.info(f"Skipping instance {job['instance_id']}: {reason}")
+        if excluded is not None:
+            excluded.append({'instance_id': job['instance_id'], 'account_id': job['account_id'], 'region': job['region'],
+                             'availability_zone': job['availability_zone'], 'reason': reason})
+
+def planned_job_sources(plan, targets):
+    # Jobs of a saved plan, without discovery. The planned volumes are described again by ID
+    # in batches, so volumes encrypted or detached since the plan was made are dropped.
+    jobs_by_target = defaultdict(list)
+    for job in planner.plan_jobs(plan):
+        jobs_by_target[(job['account_id'], job['region'])].append(job)
+    sources = []
+    for target in targets:
+        jobs = jobs_by_target.pop((target['account_id'], target['region']), [])
+        if jobs:
+            sources.append(refresh_planned_jobs(target['session'], jobs))
+    for account_id, region in jobs_by_target:
+        logger.error(f"Plan covers region {region} of account {account_id}, which could not be set up. Skipping its instances.")
+    return sources
+
+def refresh_planned_jobs(session, jobs):
+    volume_ids = [volume['VolumeId'] for job in jobs for volume in job['volumes']]
+    current_volumes = {}
+    for i in range(0, len(volume_ids), DESCRIBE_BATCH_SIZE):
+        for page in iter_volume_pages(session, volume_ids=volume_ids[i:i + DESCRIBE_BATCH_SIZE]):
+            for volume in page:
+                current_volumes[volume['VolumeId']] = volume
+    for job in jobs:
+        volumes = [current_volumes[volume['VolumeId']] for volume in job['volumes'] if volume['VolumeId'] in current_volumes]
+        if len(volumes) < len(job['volumes']):
+            logger.warning(f"{len(job['volumes']) - len(volumes)} planned volumes of instance {job['instance_id']} are no longer unencrypted and in use.")
+        if volumes:
+            yield {**job, 'volumes': volumes}
+
+def write_change_plan(args, targets, job_sources):
+    excluded = []
+    rules = exclusion_rules(args)
+    jobs = collect_jobs([apply_exclusions(source, rules, excluded) for source in job_sources])
+    estimator = planner.DurationEstimator(planner.load_history(args.metrics_file), encryption_engine=args.encryption_engine)
+    plan = planner.build_change_plan(jobs, excluded, estimator, args.snapshot_mode, sorted({target['region'] for target in targets}), args.role_arns)
+    planner.write_plan(plan, args.plan)
+    planner.log_change_plan(plan)
+    logger.info(f"Plan written to {args.plan}")
+    return plan
+
+def only_instances(jobs, instance_ids):
+    for job in jobs:
+        if job['instance_id'] in instance_ids:
+            yield job
+
+def collect_jobs(job_sources):
+    job_queue = stream_in_background(job_sources)
+    jobs = []
+    for job in iter(job_queue.get, None):
+        jobs.append(job)
+    return jobs
+
+def plan_schedule(args, job_sources):
+    # Collects every instance without changing anything and packs them into windows.
+    rules = exclusion_rules(args)
+    jobs = collect_jobs([apply_exclusions(source, rules) for source in job_sources])
+    estimator = planner.DurationEstimator(planner.load_history(args.metrics_file), encryption_engine=args.encryption_engine)
+    schedule = planner.plan_windows(jobs, estimator, args.window_minutes, args.workers, args.max_per_az, args.max_per_account,
+                                    args.max_windows, args.snapshot_mode)
+    planner.write_schedule(schedule, args.schedule_out)
+    planner.log_schedule(schedule)
+    logger.info(f"Schedule of {len(jobs)} instances written to {args.schedule_out}")
+    return schedule
+
+def resumed_job_sources(job_sources):
+    # Unfinished instances of the interrupted run, then everything the run had not
+    # reached yet.
+    resumed_jobs = [job for job in JOURNAL.incomplete_jobs() if (job['account_id'], job['region']) in TARGETS]
+    logger.info(f"Resuming {len(resumed_jobs)} unfinished instances")
+    resumed_instance_ids = {job['instance_id'] for job in resumed_jobs}
+    return [[{**job, 'resumed': True} for job in resumed_jobs]] + [skip_instances(source, resumed_instance_ids) for source in job_sources]
+
+def job_criticality(job, tag_key):
+    # Read from the instance cache discovery has filled; lower values are processed first.
+    instance = get_instance(TARGETS[(job['account_id'], job['region'])]['session'], job['instance_id']) or {}
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == tag_key:
+            try:
+                return int(tag['Value'])
+            except ValueError:
+                logger.warning(f"Instance {job['instance_id']} has a non-numeric {tag_key} tag {tag['Value']!r}. Using {DEFAULT_CRITICALITY}.")
+    return DEFAULT_CRITICALITY
+
+def build_job_queue(args):
+    estimator = planner.DurationEstimator(planner.load_history(args.metrics_file), encryption_engine=args.encryption_engine)
+
+    def estimate(job):
+        return estimator.lead_time(job['volumes'], args.snapshot_mode) + estimator.downtime(job['volumes'], args.snapshot_mode)
+
+    criticality = (lambda job: job_criticality(job, args.priority_tag)) if args.priority_tag else None
+    return JobQueue(args.job_order, estimate, criticality)
+
+def run_instance_jobs(job_sources, max_workers=1, max_per_az=None, max_per_account=None, snapshot_mode='serial', pending=None):
+    # Jobs are consumed while discovery is still producing them, so the first instances
+    # start before the last page of volumes has been fetched. Queued jobs wait in the
+    # priority queue until a worker and a slot in their AZ and account are free.
+    job_queue = stream_in_background(job_sources)
+    discovering = True
+    pending = pending if pending is not None else JobQueue('discovery')
+    futures = {}
+    # Restarted instances whose status checks are still being verified.
+    verifications = {}
+    az_in_flight = defaultdict(int)
+    account_in_flight = defaultdict(int)
+    failed_instances = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix='verify') as verifier:
+        while discovering or pending or futures or verifications:
+            block = not pending and not futures and not verifications
+            while discovering:
+                try:
+                    job = job_queue.get(block=block)
+                except queue.Empty:
+                    break
+                block = False
+                if job is None:
+                    discovering = False
+                    progress.discovery_finished()
+                else:
+                    pending.push(job)
+                    progress.job_queued(job)
+
+            # Fill every free worker with the most urgent job whose AZ and account have room.
+            while len(futures) < max_workers:
+                job = pending.pop(lambda job: job_fits(job, az_in_flight, account_in_flight, max_per_az, max_per_account), az_in_flight)
+                if job is None:
+                    break
+                az_in_flight[(job['account_id'], job['availability_zone'])] += 1
+                account_in_flight[job['account_id']] += 1
+                futures[executor.submit(process_instance_job, job, snapshot_mode)] = job
+
+            if not futures and not verifications:
+                continue
+            done, _ = wait([*futures, *verifications], timeout=DISCOVERY_POLL_INTERVAL if discovering else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in verifications:
+                    job, failed = verifications.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if not failed:
+                            failed_instances.append(job['instance_id'])
+                        failed = True
+                        logger.error(f"Verification of instance {job['instance_id']} failed. Error: {str(e)}")
+                    progress.job_finished(job, failed)
+                    continue
+                job = futures.pop(future)
+                az_in_flight[(job['account_id'], job['availability_zone'])] -= 1
+                account_in_flight[job['account_id']] -= 1
+                failed = False
+                restarted = True
+                try:
+                    swaps = future.result()
+                except Exception as e:
+                    failed = True
+                    failed_instances.append(job['instance_id'])
+                    logger.error(f"Processing of instance {job['instance_id']} failed. Error: {str(e)}")
+                    # Volumes swapped before the failure (completed_swaps, set by the snapshot
+                    # modes) are verified and reported like any others. An instance left stopped
+                    # (restarted, set by restart_after_failure) cannot pass status checks, so its
+                    # swaps are only reported.
+                    swaps = getattr(e, 'completed_swaps', [])
+                    restarted = getattr(e, 'restarted', True)
+                if swaps and STATUS_CHECK_TIMEOUT and restarted:
+                    # The instance stays in the progress view until its status checks pass.
+                    progress.instance_step(job['instance_id'], 'status_checks')
+                    verifications[verifier.submit(verify_instance, job, swaps)] = (job, failed)
+                else:
+                    report_swaps(swaps)
+                    progress.job_finished(job, failed)
+
+    if failed_instances:
+        logger.error(f"Failed to process instances: {failed_instances}")
+    return failed_instances
+
+def setup_target(region_name, role_arn):
+    session = create_session(region_name, role_arn)
+    kms_key = get_kms_key_arn(session)
+    if not kms_key:
+        logger.error(f"Error: Could not retrieve the KMS key ARN in {session.region_name} for {role_arn or 'the default credentials'}. Skipping.")
+        return None
+    return {'session': session, 'account_id': get_account_id(session), 'region': session.region_name, 'kms_key': kms_key}
+
+def setup_targets(regions, role_arns):
+    combinations = [(region_name, role_arn) for role_arn in role_arns or [None] for region_name in regions or [None]]
+    with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+        futures = [executor.submit(setup_target, region_name, role_arn) for region_name, role_arn in combinations]
+    targets = []
+    TARGETS.clear()
+    for (region_name, role_arn), future in zip(combinations, futures):
+        try:
+            target = future.result()
+        except Exception as e:
+            logger.error(f"Could not set up {region_name or 'the default region'} for {role_arn or 'the default credentials'}. Error: {str(e)}")
+            continue
+        if target and (target['account_id'], target['region']) in TARGETS:
+            logger.warning(f"Region {target['region']} of account {target['account_id']} was given more than once. Skipping the duplicate.")
+        elif target:
+            TARGETS[(target['account_id'], target['region'])] = target
+            targets.append(target)
+    return targets
+
+def give_up_pending_snapshot(pending_snapshot, reason):
+    FAILED_SNAPSHOTS.append(pending_snapshot)
+    details = {key: value for key, value in pending_snapshot.items() if key != 'volume'}
+    logger.error(f"Giving up on volume {pending_snapshot['volume_id']} of instance {pending_snapshot['instance_id']}: {reason}. "
+                 f"It keeps its unencrypted volume. Failed snapshot details: {details}")
+
+def pending_snapshot_jobs(pending_snapshots):
+    # Polls the stalled snapshots of every pending volume with one batched describe_snapshots
+    # call per region and account, backing off between rounds, and yields each instance as
+    # a resumed job once all its stalled snapshots have completed. The job picks the volume
+    # up at the step it stalled in, so no snapshot is taken again.
+    by_instance = defaultdict(list)
+    for pending_snapshot in pending_snapshots:
+        by_instance[(pending_snapshot['account_id'], pending_snapshot['region'], pending_snapshot['instance_id'])].append(pending_snapshot)
+    stalled = {pending_snapshot['snapshot_id']: pending_snapshot for pending_snapshot in pending_snapshots if pending_snapshot['snapshot_id']}
+    deadline = time.monotonic() + PENDING_TIMEOUT
+    delay = PENDING_POLL_DELAY
+
+    while True:
+        snapshot_ids_by_target = defaultdict(list)
+        for snapshot_id, pending_snapshot in stalled.items():
+            snapshot_ids_by_target[(pending_snapshot['account_id'], pending_snapshot['region'])].append(snapshot_id)
+        for key, snapshot_ids in snapshot_ids_by_target.items():
+            ec2_client = get_client(TARGETS[key]['session'], 'ec2')
+            snapshot_ids = sorted(snapshot_ids)
+            try:
+                snapshots = {}
+                for i in range(0, len(snapshot_ids), DESCRIBE_BATCH_SIZE):
+                    for snapshot in describe_resources(ec2_client, 'snapshot', snapshot_ids[i:i + DESCRIBE_BATCH_SIZE]):
+                        snapshots[snapshot['SnapshotId']] = snapshot
+            except botocore.exceptions.ClientError as e:
+                logger.error(f"Could not describe the pending snapshots in {key[1]} of account {key[0]}. Error: {str(e)}")
+                continue
+            for snapshot_id in snapshot_ids:
+                snapshot = snapshots.get(snapshot_id)
+                if snapshot is not None and snapshot['State'] == 'pending':
+                    continue
+                pending_snapshot = stalled.pop(snapshot_id)
+                if snapshot is None or snapshot['State'] == 'error':
+                    by_instance[(pending_snapshot['account_id'], pending_snapshot['region'], pending_snapshot['instance_id'])].remove(pending_snapshot)
+                    give_up_pending_snapshot(pending_snapshot, f"snapshot {snapshot_id} is {'gone' if snapshot is None else 'in state error'}")
+
+        waiting_instances = {(pending_snapshot['account_id'], pending_snapshot['region'], pending_snapshot['instance_id']) for pending_snapshot in stalled.values()}
+        for key in [key for key in by_instance if key not in waiting_instances]:
+            instance_pending = by_instance.pop(key)
+            if instance_pending:
+                account_id, region, instance_id = key
+                logger.info(f"Resuming {len(instance_pending)} volumes of instance {instance_id} after their snapshots completed")
+                yield {'account_id': account_id, 'region': region, 'instance_id': instance_id,
+                       'availability_zone': instance_pending[0]['availability_zone'],
+                       'volumes': [pending_snapshot['volume'] for pending_snapshot in instance_pending], 'resumed': True}
+
+        if not stalled:
+            return
+        if time.monotonic() >= deadline:
+            for snapshot_id, pending_snapshot in stalled.items():
+                give_up_pending_snapshot(pending_snapshot, f"snapshot {snapshot_id} did not complete within {PENDING_TIMEOUT} seconds")
+            return
+        logger.info(f"{len(stalled)} pending snapshots still in progress. Polling again in {delay} seconds.")
+        time.sleep(delay)
+        delay = min(delay * 2, PENDING_MAX_DELAY)
+
+def process_pending_snapshots(args):
+    # Every round resumes the volumes whose snapshots completed in the meantime, on the same
+    # workers and AZ limits as the main run. Volumes that stall again go to the next round.
+    failed_instances = []
+    for attempt in range(1, MAX_RETRIES + 1):
+        if not PENDING_SNAPSHOTS:
+            break
+        pending_snapshots = list(PENDING_SNAPSHOTS)
+        PENDING_SNAPSHOTS.clear()
+        logger.info(f"Retrying {len(pending_snapshots)} volumes with pending snapshots. Attempt {attempt} of {MAX_RETRIES}...")
+        failed_instances += run_instance_jobs([pending_snapshot_jobs(pending_snapshots)], args.workers, args.max_per_az, args.max_per_account,
+                                              args.snapshot_mode, build_job_queue(args))
+
+    if PENDING_SNAPSHOTS:
+        logger.error(f"Failed to process some snapshots even after {MAX_RETRIES} retries.")
+        for pending_snapshot in list(PENDING_SNAPSHOTS):
+            give_up_pending_snapshot(pending_snapshot, f"still stalled after {MAX_RETRIES} retries")
+        PENDING_SNAPSHOTS.clear()
+    return failed_instances
+
+def parse_tag(value):
+    key, separator, tag_value = value.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f"Tag {value} must be given as KEY=VALUE")
+    return key, tag_value
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Encrypt the unencrypted EBS volumes attached to EC2 instances.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of instances processed concurrently (default: 1, serial).')
+    parser.add_argument('--max-per-az', type=int, default=None, help='Maximum instances in flight per availability zone.')
+    parser.add_argument('--max-per-account', type=int, default=None, help='Maximum instances in flight per AWS account.')
+    parser.add_argument('--job-order', choices=JOB_ORDERS, default='largest-first',
+                        help="Order of the queued instances within each AZ: 'largest-first' (by estimated duration) shortens the run, "
+                             "'smallest-first' finishes the most instances early, 'discovery' keeps the order they were found in.")
+    parser.add_argument('--priority-tag', default=None, metavar='KEY',
+                        help='Numeric instance tag ordering instances before size does; lower values run first and untagged instances count as 0.')
+    parser.add_argument('--snapshot-mode', choices=sorted(SNAPSHOT_MODES), default='serial',
+                        help="'serial' handles one volume at a time; 'overlap' snapshots every volume of an instance at once and swaps them in one batch; "
+                             "'pre-stop' additionally takes a baseline snapshot while the instance runs so only an incremental one is taken during downtime; "
+                             "'baseline-only' just takes the baselines ahead of the window, to be finished later with --resume in pre-stop mode.")
+    parser.add_argument('--encryption-engine', choices=ENCRYPTION_ENGINES, default='volume',
+                        help="'volume' encrypts while creating the new volume from the snapshot; 'copy' first copies every snapshot to an encrypted "
+                             "one with copy_snapshot, which together with pre-stop or baseline-only mode pre-stages the encrypted data before the stop.")
+    parser.add_argument('--status-check-timeout', type=int, default=15, metavar='MINUTES',
+                        help='Roll an instance back to its original volumes when it has not passed its status checks this long after the restart '
+                             '(default: 15; 0 skips the checks).')
+    parser.add_argument('--availability-zones', nargs='+', default=None, help='Only encrypt volumes in these availability zones.')
+    parser.add_argument('--volume-tag', dest='volume_tags', action='append', type=parse_tag, default=[], metavar='KEY=VALUE',
+                        help='Only encrypt volumes carrying this tag. Can be repeated.')
+    parser.add_argument('--regions', nargs='+', default=None, help='Regions to encrypt (default: AWS_DEFAULT_REGION).')
+    parser.add_argument('--role-arns', nargs='+', default=None, help='IAM roles to assume, one per target account (default: the configured credentials).')
+    parser.add_argument('--plan', default=None, metavar='FILE',
+                        help='Only plan: discover once, apply the exclusions and write the zone, instance and volume plan with its estimated cost to FILE.')
+    parser.add_argument('--apply', default=None, metavar='FILE', help='Process the instances of a plan written by --plan instead of discovering them again.')
+    parser.add_argument('--exclusions', default=None, metavar='FILE',
+                        help='JSON exclusion rules: instance IDs, tag selectors, volume size limit, EKS clusters and Auto Scaling groups (default: exclusions.json).')
+    parser.add_argument('--max-volume-size', type=int, default=None,
+                        help='Skip instances with a volume larger than this many GB, overriding the rules (default: 250; 0 disables the limit).')
+    parser.add_argument('--include-eks-nodes', action='store_true', help='Also process EKS worker nodes, which are skipped by default.')
+    parser.add_argument('--discover-eks-nodes', action='store_true',
+                        help='Also find EKS nodes through the node groups of every cluster, for nodes missing the cluster tags.')
+    parser.add_argument('--schedule-out', default=None, metavar='FILE',
+                        help='Only plan: estimate the downtime of every instance, pack them into maintenance windows and write the schedule to FILE.')
+    parser.add_argument('--window-minutes', type=int, default=240, help='Length of a maintenance window when planning (default: 240).')
+    parser.add_argument('--max-windows', type=int, default=None, help='Number of windows available before the deadline when planning.')
+    parser.add_argument('--schedule', default=None, metavar='FILE', help='Schedule written by --schedule-out; only the instances of --window-index are processed.')
+    parser.add_argument('--window-index', type=int, default=0, help='Window of --schedule to run (default: 0).')
+    parser.add_argument('--report', default=None, metavar='FILE',
+                        help='Report receiving a row per encrypted volume as soon as it is swapped (default: volume_changes_<timestamp>.csv).')
+    parser.add_argument('--report-format', choices=sorted(report.REPORT_SINKS), default=None,
+                        help='Report format; by default taken from the extension (.csv, .jsonl or .parquet, which needs pyarrow).')
+    parser.add_argument('--report-table', action='store_true', help='Also render the report as a table next to it at the end of the run.')
+    parser.add_argument('--metrics-file', default='metrics.jsonl', help='JSON lines file receiving step timings and throttle events.')
+    parser.add_argument('--prometheus-textfile', default=None, help='Prometheus textfile refreshed during the run with step timings and API counters.')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve the same metrics on http://127.0.0.1:PORT/metrics.')
+    parser.add_argument('--progress', action='store_true', help='Show a live view of the instances in flight, throughput and ETA on stderr.')
+    parser.add_argument('--status-file', default=None, help='JSON file refreshed during the run with the same progress, for other tools to read.')
+    parser.add_argument('--status-interval', type=float, default=progress.STATUS_INTERVAL,
+                        help=f'Seconds between refreshes of the progress view and status file (default: {progress.STATUS_INTERVAL}).')
+    parser.add_argument('--state-file', default='encryption_state.db', help='SQLite journal recording the progress of every volume.')
+    parser.add_argument('--resume', action='store_true', help='Continue the last run recorded in the state file without repeating completed steps.')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global JOURNAL, REPORT, ENCRYPTION_ENGINE, STATUS_CHECK_TIMEOUT
+    args = parse_args(argv)
+    ENCRYPTION_ENGINE = args.encryption_engine
+    STATUS_CHECK_TIMEOUT = args.status_check_timeout * 60
+    start_time = datetime.now()
+    reset_counts()
+
+    plan = planner.load_plan(args.apply) if args.apply else None
+    if plan:
+        # The plan decides which regions and accounts are touched.
+        args.regions, args.role_arns = plan['regions'], plan['role_arns']
+        if args.snapshot_mode != plan['snapshot_mode']:
+            logger.warning(f"Plan was made for {plan['snapshot_mode']} mode; its estimates do not hold in {args.snapshot_mode} mode.")
+    targets = setup_targets(args.regions, args.role_arns)
+    if not targets:
+        logger.error("Error: Could not set up any region or account. Exiting.")
+        return
+
+    tags = dict(args.volume_tags)
+    if plan:
+        job_sources = planned_job_sources(plan, targets)
+    else:
+        job_sources = [iter_instance_jobs(target['session'], target['account_id'], args.availability_zones, tags) for target in targets]
+    if args.plan:
+        write_change_plan(args, targets, job_sources)
+        return
+    if args.schedule_out:
+        plan_schedule(args, job_sources)
+        return
+    logger.info(f"Encrypting {len(targets)} region and account combinations")
+
+    report_path = args.report or f'volume_changes_{datetime.now().strftime("%Y%m%d%H%M%S")}.csv'
+    REPORT = report.open_report(report_path, args.report_format)
+    JOURNAL = Journal(args.state_file)
+    JOURNAL.start_run(resume=args.resume)
+    metrics.configure(args.metrics_file)
+    if args.metrics_port:
+        metrics.serve_prometheus(args.metrics_port)
+    if args.prometheus_textfile:
+        metrics.start_textfile_writer(args.prometheus_textfile, PROMETHEUS_TEXTFILE_INTERVAL)
+    progress.configure(snapshot_progress)
+    if args.progress or args.status_file:
+        progress.start(args.status_file, args.progress, args.status_interval)
+
+    if not plan:
+        # A plan was filtered when it was made.
+        rules = exclusion_rules(args)
+        job_sources = [apply_exclusions(source, rules) for source in job_sources]
+    if args.resume:
+        job_sources = resumed_job_sources(job_sources)
+    if args.schedule:
+        schedule = planner.load_schedule(args.schedule)
+        instance_ids = planner.window_instance_ids(schedule, args.window_index)
+        if args.workers != schedule['workers'] or args.snapshot_mode != schedule['snapshot_mode']:
+            logger.warning(f"Schedule was planned for {schedule['workers']} workers in {schedule['snapshot_mode']} mode; "
+                           f"running with {args.workers} workers in {args.snapshot_mode} mode may overrun the window.")
+        logger.info(f"Running window {args.window_index} of {args.schedule}: {len(instance_ids)} instances")
+        job_sources = [only_instances(source, instance_ids) for source in job_sources]
+    try:
+        run_instance_jobs(job_sources, args.workers, args.max_per_az, args.max_per_account, args.snapshot_mode, build_job_queue(args))
+
+        if PENDING_SNAPSHOTS:
+            logger.info("Processing pending snapshots...")
+            process_pending_snapshots(args)
+    finally:
+        # Rows already written survive an interrupted run.
+        REPORT.close()
+        REPORT = None
+        progress.stop()
+    logger.info(f"Report written to {report_path}")
+    if args.report_table:
+        write_volume_details_table(report_path, args.report_format)
+    JOURNAL.finish_run()
+
+    throttle_counts, api_call_counts = throttle_summary()
+    logger.info(f"API calls: {sum(api_call_counts.values())}, throttled: {sum(throttle_counts.values())}")
+    for (service, action), count in sorted(throttle_counts.items()):
+        logger.info(f"Throttled {service} {action}: {count}")
+    metrics.log_summary()
+    if args.prometheus_textfile:
+        metrics.write_prometheus_textfile(args.prometheus_textfile)
+    metrics.close()
+
+    elapsed_time = datetime.now() - start_time
+    logger.info(f"Script completed in {elapsed_time}")
+
+if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -4,11 +4,27 @@ from datetime import datetime
 from collections import defaultdict
 import botocore
 import logging
+from exclusions import load_rules
+import report
+from waiters import DESCRIBE_BATCH_SIZE
 
 VOLUME_DETAILS_LIST = []
 PENDING_SNAPSHOTS = []
 FAILED_SNAPSHOTS = []
-EXCLUDED_INSTANCES = ["i-0c9b0f3c9ef20844f","i-06614e6c32fdd91a4","i-0c040c4f7a132269b","i-03edef24bacf66c0e","i-0c99f03e0ce758a3f","i-084a5839268954c72","i-0c7a7804f2ee94fac","i-005da6ce8b73bad9b","i-03a5f91f8f2b99144","i-042c3ec4ce01d91ea","i-06a2f96f7b4696efc","i-0ae79b01a1edef960","i-09d47988275275e19","i-0a99fc64280ce6855","i-0d9ea070d2dd5cd13","i-0e6cbe5ecd5f92fa3","i-02402fa59c575b43f","i-0e54c9a4b7dfbf4bb","i-0176c49c07fd241df","i-0f75bec77eb76e2d1","i-0f655ee2cb3b86e32","i-024dadf0a0e130fbf","i-00ac08a74aa3c3e6b","i-0bbdcf3745257459b","i-0a23b1a941f26b90b","i-0cd082c492824b31a","i-067e83f83906c1f27","i-0187e7c24f64c3231","i-0feb7555ef36ccde9","i-04808f96962a4d58a","i-0d67c67ccc37df029","i-0c83e18d59f52617f","i-034c88f2f1a30177b"]  # Add your instance IDs here
+# Excluded instance IDs and the other exclusion rules live in exclusions.json.
+EXCLUSION_RULES = load_rules()
+REPORT_FIELDS = {
+    'old_volume_id': 'Old Volume ID',
+    'new_volume_id': 'New Volume ID',
+    'instance_id': 'Instance ID',
+    'instance_name': 'Instance Name',
+    'device_name': 'Device Name',
+    'disk_size': 'Disk Size',
+    'snapshot_id': 'Snapshot ID',
+    'availability_zone': 'Availability Zone',
+}
+# One buffered handle for the whole run instead of reopening the file for every row.
+REPORT = None
 
 logging.basicConfig(filename='script_logs.log', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger()
@@ -52,6 +68,18 @@ def get_kms_key_arn(session, alias_name='alias/aws/ebs'):
         logger.error(f"KMS key with alias {alias_name} not found.")
         return None
 
+def describe_instances_by_id(session, instance_ids):
+    ec2_client = session.client("ec2")
+    paginator = ec2_client.get_paginator('describe_instances')
+    instances = {}
+    instance_ids = sorted(instance_ids)
+    for i in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE):
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': instance_ids[i:i + DESCRIBE_BATCH_SIZE]}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+    return instances
+
 def get_volume_info(session):
     ec2_client = session.client("ec2")
     response = ec2_client.describe_volumes()
@@ -122,8 +150,7 @@ def start_instance(session, instance_id):
     logger.info(f"Instance {instance_id} started in {elapsed_time}")
 
 def log_volume_details(details):
-    with open('volume_changes.csv', 'a') as file:
-        file.write(f"{details['old_volume_id']},{details['new_volume_id']},{details['instance_id']},{details['instance_name']},{details['device_name']},{details['disk_size']},{details['snapshot_id']},{details['availability_zone']}\n")
+    REPORT.write(details)
 
 def process_volumes_for_instance(session, volumes, kms_key):
     instance_id = volumes[0]['Attachments'][0]['InstanceId']
@@ -183,45 +210,52 @@ def process_pending_snapshots(session):
             logger.error(f"Failed snapshot details: {failed}")
 
 def main():
+    global REPORT
     start_time = datetime.now()
 
-    # Only write the header if the file doesn't exist
-    if not os.path.exists('volume_changes.csv'):
-        with open('volume_changes.csv', 'w') as file:
-            file.write("Old Volume ID,New Volume ID,Instance ID,Instance Name,Device Name,Disk Size,Snapshot ID,Availability Zone\n")
-
-    session = create_session()
-    kms_key = get_kms_key_arn(session)
-    if not kms_key:
-        logger.error("Error: Could not retrieve the KMS key ARN. Exiting.")
-        return
-
-    volume_info = get_volume_info(session)
-    
-    zone_to_instance_to_volumes_map = defaultdict(lambda: defaultdict(list))
-    encountered_zones = set()
-    
-    for volume in volume_info:
-        if volume['State'] == 'in-use' and not volume['Encrypted']:
-            instance_id = volume['Attachments'][0]['InstanceId']
-            availability_zone = volume['AvailabilityZone']
-            encountered_zones.add(availability_zone)
-            zone_to_instance_to_volumes_map[availability_zone][instance_id].append(volume)
-
-    zones_order = list(encountered_zones)
-
-    for zone in zones_order:
-        instance_to_volumes_map = zone_to_instance_to_volumes_map[zone]
-
-        for instance_id, volumes in instance_to_volumes_map.items():
-            if instance_id in EXCLUDED_INSTANCES:
-                logger.info(f"Skipping encryption process for excluded instance: {instance_id}")
-                continue
-            process_volumes_for_instance(session, volumes, kms_key)
+    # Appends to volume_changes.csv; the header is only written to a new file
+    REPORT = report.open_report('volume_changes.csv', fields=REPORT_FIELDS)
+    try:
+        session = create_session()
+        kms_key = get_kms_key_arn(session)
+        if not kms_key:
+            logger.error("Error: Could not retrieve the KMS key ARN. Exiting.")
+            return
+
+        volume_info = get_volume_info(session)
 
-    if PENDING_SNAPSHOTS:
-        process_pending_snapshots(session)
+        zone_to_instance_to_volumes_map = defaultdict(lambda: defaultdict(list))
+        encountered_zones = set()
+
+        for volume in volume_info:
+            if volume['State'] == 'in-use' and not volume['Encrypted']:
+                instance_id = volume['Attachments'][0]['InstanceId']
+                availability_zone = volume['AvailabilityZone']
+                encountered_zones.add(availability_zone)
+                zone_to_instance_to_volumes_map[availability_zone][instance_id].append(volume)
 
+        zones_order = list(encountered_zones)
+
+        instances = {}
+        if EXCLUSION_RULES.needs_instance:
+            instance_ids = {instance_id for zone in zones_order for instance_id in zone_to_instance_to_volumes_map[zone]}
+            instances = describe_instances_by_id(session, instance_ids)
+
+        for zone in zones_order:
+            instance_to_volumes_map = zone_to_instance_to_volumes_map[zone]
+
+            for instance_id, volumes in instance_to_volumes_map.items():
+                reason = EXCLUSION_RULES.reason(instance_id, volumes, instances.get(instance_id))
+                if reason:
+                    logger.info(f"Skipping encryption process for excluded instance {instance_id}: {reason}")
+                    continue
+                process_volumes_for_instance(session, volumes, kms_key)
+
+        if PENDING_SNAPSHOTS:
+            process_pending_snapshots(session)
+    finally:
+        # Rows still buffered are written even when the run fails.
+        REPORT.close()
     elapsed_time = datetime.now() - start_time
     logger.info(f"Script completed in {elapsed_time}")
 
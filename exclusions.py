@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger()
+
+# Next to this module, not in the working directory, so the protected instance IDs are
+# found wherever the scripts are run from.
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exclusions.json')
+ANY = '*'
+
+# Applied for every key a rules file leaves out: instances with a volume over 250 GB and
+# EKS worker nodes are never swapped (see "Excluding Large Volumes and EKS Instances.txt").
+DEFAULT_RULES = {
+    'instance_ids': [],
+    'tags': [],
+    'max_volume_size_gb': 250,
+    'eks_clusters': [ANY],
+    'auto_scaling_groups': [],
+}
+
+# Tags identifying the EKS cluster and Auto Scaling group an instance belongs to. Managed
+# node groups and eksctl tag their nodes with the cluster name; self-managed nodes carry
+# the kubernetes.io/cluster/<name> tag key instead.
+EKS_CLUSTER_TAG_KEYS = ('eks:cluster-name', 'aws:eks:cluster-name')
+EKS_CLUSTER_TAG_PREFIX = 'kubernetes.io/cluster/'
+AUTO_SCALING_GROUP_TAG_KEY = 'aws:autoscaling:groupName'
+
+
+class ExclusionRules:
+    # Rules compiled into sets and dicts, so checking an instance costs a few lookups per
+    # tag it carries, however many IDs and selectors the rules list.
+    def __init__(self, instance_ids=(), tags=(), max_volume_size_gb=None, eks_clusters=(), auto_scaling_groups=()):
+        self.instance_ids = set(instance_ids)
+        # Tag key -> set of excluded values, or None when any value excludes.
+        self.tag_values = {}
+        for selector in tags:
+            values = selector.get('values', [selector['value']] if 'value' in selector else None)
+            if values is None or self.tag_values.get(selector['key'], set()) is None:
+                self.tag_values[selector['key']] = None
+            else:
+                self.tag_values.setdefault(selector['key'], set()).update(values)
+        self.max_volume_size_gb = max_volume_size_gb
+        self.eks_clusters = set(eks_clusters)
+        self.auto_scaling_groups = set(auto_scaling_groups)
+        # Instance ID -> EKS cluster, for nodes found through their node groups (see
+        # listofinstances.build_eks_node_index) rather than their tags.
+        self.eks_nodes = {}
+
+    @classmethod
+    def from_dict(cls, rules):
+        rules = {**DEFAULT_RULES, **rules}
+        return cls(rules['instance_ids'], rules['tags'], rules['max_volume_size_gb'], rules['eks_clusters'], rules['auto_scaling_groups'])
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            rules = cls.from_dict(json.load(file))
+        logger.info(f"Loaded exclusion rules from {path}: {rules.describe()}")
+        return rules
+
+    def describe(self):
+        return (f"{len(self.instance_ids)} instance IDs, {len(self.tag_values)} tag selectors, "
+                f"max volume size {self.max_volume_size_gb or 'unlimited'} GB, EKS clusters {sorted(self.eks_clusters) or 'none'}, "
+                f"Auto Scaling groups {sorted(self.auto_scaling_groups) or 'none'}")
+
+    @property
+    def needs_instance(self):
+        # Whether reason() has to see the instance description, not just its ID and volumes.
+        return bool(self.tag_values or self.eks_clusters or self.auto_scaling_groups)
+
+    def matches(self, names, name):
+        return ANY in names or name in names
+
+    def tag_reason(self, tags, owner):
+        for tag in tags:
+            if tag['Key'] in self.tag_values:
+                values = self.tag_values[tag['Key']]
+                if values is None or tag['Value'] in values:
+                    return f"{owner} tag {tag['Key']}={tag['Value']} is excluded"
+        return None
+
+    def reason(self, instance_id, volumes, instance=None):
+        # Why the instance must be left alone, or None to process it.
+        if instance_id in self.instance_ids:
+            return "instance ID is excluded"
+        cluster = self.eks_nodes.get(instance_id)
+        if cluster and self.eks_clusters and self.matches(self.eks_clusters, cluster):
+            return f"EKS node of cluster {cluster}; encrypt it through its node group's launch template"
+        if self.max_volume_size_gb:
+            large_volumes = [volume['VolumeId'] for volume in volumes if volume['Size'] > self.max_volume_size_gb]
+            if large_volumes:
+                return f"volumes {large_volumes} are larger than {self.max_volume_size_gb} GB"
+        for volume in volumes:
+            reason = self.tag_reason(volume.get('Tags', []), f"volume {volume['VolumeId']}")
+            if reason:
+                return reason
+        tags = (instance or {}).get('Tags', [])
+        reason = self.tag_reason(tags, 'instance')
+        if reason:
+            return reason
+        for tag in tags:
+            cluster = None
+            if tag['Key'] in EKS_CLUSTER_TAG_KEYS:
+                cluster = tag['Value']
+            elif tag['Key'].startswith(EKS_CLUSTER_TAG_PREFIX):
+                cluster = tag['Key'][len(EKS_CLUSTER_TAG_PREFIX):]
+            if cluster and self.eks_clusters and self.matches(self.eks_clusters, cluster):
+                return f"EKS node of cluster {cluster}; encrypt it through its node group's launch template"
+            if tag['Key'] == AUTO_SCALING_GROUP_TAG_KEY and self.auto_scaling_groups and self.matches(self.auto_scaling_groups, tag['Value']):
+                return f"member of Auto Scaling group {tag['Value']}; replace its instances from an encrypted launch template"
+        return None
+
+
+def load_rules(path=None):
+    # The rules file when given, else exclusions.json when present, else the defaults.
+    if path:
+        return ExclusionRules.load(path)
+    try:
+        return ExclusionRules.load(DEFAULT_RULES_FILE)
+    except FileNotFoundError:
+        logger.warning(f"Exclusion rules file {DEFAULT_RULES_FILE} not found. Using the default rules, which exclude no instance IDs.")
+        return ExclusionRules.from_dict({})
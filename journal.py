@@ -0,0 +1,162 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+logger = logging.getLogger()
+
+# Volume steps in the order they happen. A volume is done once it is 'attached',
+# an instance once it is 'restarted'.
+VOLUME_STEPS = ['queued', 'baseline_snapshotted', 'baseline_copy_started', 'snapshot_started', 'snapshotted', 'copy_started', 'copied',
+                'volume_created', 'detached', 'attached']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE TABLE IF NOT EXISTS instances (
+    run_id INTEGER NOT NULL,
+    instance_id TEXT NOT NULL,
+    availability_zone TEXT,
+    account_id TEXT,
+    region TEXT,
+    step TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (run_id, instance_id)
+);
+CREATE TABLE IF NOT EXISTS volumes (
+    run_id INTEGER NOT NULL,
+    volume_id TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    step TEXT NOT NULL,
+    baseline_snapshot_id TEXT,
+    snapshot_id TEXT,
+    baseline_copy_id TEXT,
+    copy_id TEXT,
+    new_volume_id TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (run_id, volume_id)
+);
+"""
+
+
+ADDED_VOLUME_COLUMNS = ['baseline_copy_id', 'copy_id']
+
+
+class Journal:
+    # Durable record of every step taken, so an interrupted run can resume without
+    # repeating AWS work. Every write is committed before the next step starts.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.add_missing_columns('volumes', ADDED_VOLUME_COLUMNS)
+        self.run_id = None
+
+    def add_missing_columns(self, table, columns):
+        # State files written by older versions lack the columns added since.
+        existing = {row['name'] for row in self.connection.execute(f'PRAGMA table_info({table})')}
+        with self.connection:
+            for column in columns:
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} TEXT')
+
+    def start_run(self, resume=False):
+        with self.lock:
+            last_run = self.connection.execute('SELECT run_id, finished_at FROM runs ORDER BY run_id DESC LIMIT 1').fetchone()
+            if resume and last_run:
+                self.run_id = last_run['run_id']
+                logger.info(f"Resuming run {self.run_id} from {self.path}")
+                return self.run_id
+            if resume:
+                logger.info(f"No previous run found in {self.path}. Starting a new run.")
+            elif last_run and not last_run['finished_at']:
+                logger.warning(f"Run {last_run['run_id']} in {self.path} did not finish. Use --resume to continue it.")
+            with self.connection:
+                cursor = self.connection.execute('INSERT INTO runs (started_at) VALUES (?)', (now(),))
+            self.run_id = cursor.lastrowid
+            return self.run_id
+
+    def finish_run(self):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE runs SET finished_at = ? WHERE run_id = ?', (now(), self.run_id))
+
+    def record_job(self, job):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO instances (run_id, instance_id, availability_zone, account_id, region, step, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.run_id, job['instance_id'], job['availability_zone'], job['account_id'], job['region'], 'queued', now()))
+            for volume in job['volumes']:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO volumes (run_id, volume_id, instance_id, volume, step, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.run_id, volume['VolumeId'], job['instance_id'], json.dumps(volume, default=str), 'queued', now()))
+
+    def record_instance(self, instance_id, step):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE instances SET step = ?, updated_at = ? WHERE run_id = ? AND instance_id = ?',
+                                    (step, now(), self.run_id, instance_id))
+
+    def reset_volume(self, volume_id, step):
+        # Moves a volume back to an earlier step, after its swap was rolled back.
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE volumes SET step = ?, updated_at = ? WHERE run_id = ? AND volume_id = ?',
+                                    (step, now(), self.run_id, volume_id))
+
+    def record_volume(self, volume_id, step, baseline_snapshot_id=None, snapshot_id=None, baseline_copy_id=None, copy_id=None, new_volume_id=None):
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT step FROM volumes WHERE run_id = ? AND volume_id = ?', (self.run_id, volume_id)).fetchone()
+            # Steps only move forward; waiting again on a finished step must not undo later progress.
+            if row and step_reached(row['step'], step):
+                step = row['step']
+            self.connection.execute(
+                'UPDATE volumes SET step = ?, updated_at = ?, '
+                'baseline_snapshot_id = COALESCE(?, baseline_snapshot_id), '
+                'snapshot_id = COALESCE(?, snapshot_id), '
+                'baseline_copy_id = COALESCE(?, baseline_copy_id), '
+                'copy_id = COALESCE(?, copy_id), '
+                'new_volume_id = COALESCE(?, new_volume_id) '
+                'WHERE run_id = ? AND volume_id = ?',
+                (step, now(), baseline_snapshot_id, snapshot_id, baseline_copy_id, copy_id, new_volume_id, self.run_id, volume_id))
+
+    def get_volume(self, volume_id):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM volumes WHERE run_id = ? AND volume_id = ?', (self.run_id, volume_id)).fetchone()
+        return dict(row) if row else {}
+
+    def incomplete_jobs(self):
+        # Every instance that was not restarted or still has unfinished volumes, with all of
+        # its volumes: finished ones are skipped and the others pick up at their last step.
+        with self.lock:
+            instances = self.connection.execute(
+                "SELECT * FROM instances WHERE run_id = ? AND (step != 'restarted' OR instance_id IN "
+                "(SELECT instance_id FROM volumes WHERE run_id = ? AND step != 'attached'))",
+                (self.run_id, self.run_id)).fetchall()
+            volumes = self.connection.execute('SELECT instance_id, volume FROM volumes WHERE run_id = ?', (self.run_id,)).fetchall()
+
+        volumes_by_instance = defaultdict(list)
+        for row in volumes:
+            volumes_by_instance[row['instance_id']].append(json.loads(row['volume']))
+
+        return [{
+            'instance_id': row['instance_id'],
+            'availability_zone': row['availability_zone'],
+            'account_id': row['account_id'],
+            'region': row['region'],
+            'volumes': volumes_by_instance[row['instance_id']]
+        } for row in instances]
+
+
+def now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def step_reached(step, target, steps=VOLUME_STEPS):
+    return step is not None and steps.index(step) >= steps.index(target)
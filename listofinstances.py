@@ -1,48 +1,101 @@
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from exclusions import AUTO_SCALING_GROUP_TAG_KEY, EKS_CLUSTER_TAG_KEYS, EKS_CLUSTER_TAG_PREFIX
+from waiters import DESCRIBE_BATCH_SIZE
 
-def get_eks_clusters():
-    eks_client = boto3.client('eks')
-    
+# EKS calls per cluster run on this many threads.
+MAX_WORKERS = 16
+
+def get_eks_clusters(eks_client):
     try:
-        # Retrieve the list of EKS clusters
-        response = eks_client.list_clusters()
-        
-        # Extract the cluster names from the response
-        cluster_names = response['clusters']
-        
+        cluster_names = []
+        for page in eks_client.get_paginator('list_clusters').paginate():
+            cluster_names.extend(page['clusters'])
         return cluster_names
-    
+
     except Exception as e:
         print(f"Error retrieving EKS clusters: {e}")
         return []
 
-def get_cluster_instances(cluster_name):
-    eks_client = boto3.client('eks')
-    ec2_client = boto3.client('ec2')
-    
+def get_cluster_node_groups(eks_client, cluster_name):
+    # Names of the Auto Scaling groups behind every managed node group of the cluster.
     try:
-        # Retrieve the cluster details
-        response = eks_client.describe_cluster(name=cluster_name)
-        
-        # Extract the worker node group names from the response
-        node_group_names = [group['nodegroupName'] for group in response['cluster']['nodegroups']]
-        
-        # Retrieve the instances for each worker node group
-        instances = []
+        node_group_names = []
+        for page in eks_client.get_paginator('list_nodegroups').paginate(clusterName=cluster_name):
+            node_group_names.extend(page['nodegroups'])
+
+        auto_scaling_groups = {}
         for node_group_name in node_group_names:
             response = eks_client.describe_nodegroup(clusterName=cluster_name, nodegroupName=node_group_name)
-            instance_ids = [instance['instanceId'] for instance in response['nodegroup']['instances']]
-            
-            # Retrieve the instance details using EC2 client
-            response = ec2_client.describe_instances(InstanceIds=instance_ids)
-            for reservation in response['Reservations']:
-                instances.extend(reservation['Instances'])
-        
-        return instances
-    
+            for group in response['nodegroup'].get('resources', {}).get('autoScalingGroups', []):
+                auto_scaling_groups[group['name']] = node_group_name
+        return auto_scaling_groups
+
     except Exception as e:
-        print(f"Error retrieving instances for cluster {cluster_name}: {e}")
-        return []
+        print(f"Error retrieving node groups for cluster {cluster_name}: {e}")
+        return {}
+
+def describe_instances(ec2_client, filter_name, values):
+    # Every instance matching any of the values, in batched and paginated calls.
+    instances = []
+    paginator = ec2_client.get_paginator('describe_instances')
+    filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]
+    for i in range(0, len(values), DESCRIBE_BATCH_SIZE):
+        batch_filters = filters + [{'Name': filter_name, 'Values': values[i:i + DESCRIBE_BATCH_SIZE]}]
+        for page in paginator.paginate(Filters=batch_filters):
+            for reservation in page['Reservations']:
+                instances.extend(reservation['Instances'])
+    return instances
+
+def tag_value(instance, key):
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+def build_eks_node_index(eks_client, ec2_client, cluster_names=None, max_workers=MAX_WORKERS):
+    # Instance ID -> {'cluster', 'node_group', 'instance'} for every EKS worker node. Clusters
+    # are enumerated concurrently; the nodes of all of them are then found with a few
+    # batched describe_instances calls by cluster tag and by Auto Scaling group.
+    if cluster_names is None:
+        cluster_names = get_eks_clusters(eks_client)
+    if not cluster_names:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        node_groups = dict(zip(cluster_names, executor.map(lambda name: get_cluster_node_groups(eks_client, name), cluster_names)))
+
+    cluster_of_group = {}
+    node_group_of_group = {}
+    for cluster_name, auto_scaling_groups in node_groups.items():
+        for group_name, node_group_name in auto_scaling_groups.items():
+            cluster_of_group[group_name] = cluster_name
+            node_group_of_group[group_name] = node_group_name
+
+    index = {}
+
+    def add(instance, cluster_name):
+        group_name = tag_value(instance, AUTO_SCALING_GROUP_TAG_KEY)
+        index.setdefault(instance['InstanceId'], {
+            'cluster': cluster_name,
+            'node_group': node_group_of_group.get(group_name),
+            'instance': instance,
+        })
+
+    if cluster_of_group:
+        for instance in describe_instances(ec2_client, f"tag:{AUTO_SCALING_GROUP_TAG_KEY}", list(cluster_of_group)):
+            add(instance, cluster_of_group[tag_value(instance, AUTO_SCALING_GROUP_TAG_KEY)])
+    for key in EKS_CLUSTER_TAG_KEYS:
+        for instance in describe_instances(ec2_client, f"tag:{key}", cluster_names):
+            add(instance, tag_value(instance, key))
+    for instance in describe_instances(ec2_client, 'tag-key', [f"{EKS_CLUSTER_TAG_PREFIX}{name}" for name in cluster_names]):
+        for tag in instance.get('Tags', []):
+            if tag['Key'].startswith(EKS_CLUSTER_TAG_PREFIX):
+                add(instance, tag['Key'][len(EKS_CLUSTER_TAG_PREFIX):])
+                break
+    return index
+
+def get_cluster_instances(node_index, cluster_name):
+    return [entry['instance'] for entry in node_index.values() if entry['cluster'] == cluster_name]
 
 def write_logs_to_file(logs, file_path):
     with open(file_path, 'w') as file:
@@ -52,29 +105,30 @@ def write_logs_to_file(logs, file_path):
 def main():
     logs = []  # List to store the logs
 
-    # Get the list of EKS clusters
-    clusters = get_eks_clusters()
-    
+    eks_client = boto3.client('eks')
+    ec2_client = boto3.client('ec2')
+    clusters = get_eks_clusters(eks_client)
+    node_index = build_eks_node_index(eks_client, ec2_client, clusters)
+
     if clusters:
         logs.append("EKS Clusters and Instances:")
         for cluster in clusters:
             logs.append(f"\nCluster: {cluster}")
-            
-            # Get the instances for the current cluster
-            instances = get_cluster_instances(cluster)
-            
+
+            instances = get_cluster_instances(node_index, cluster)
+
             if instances:
                 logs.append("Instances:")
                 for instance in instances:
                     logs.append(f"  - Instance ID: {instance['InstanceId']}")
                     logs.append(f"    Instance Type: {instance['InstanceType']}")
-                    logs.append(f"    Private IP: {instance['PrivateIpAddress']}")
+                    logs.append(f"    Private IP: {instance.get('PrivateIpAddress', 'N/A')}")
                     logs.append(f"    Public IP: {instance.get('PublicIpAddress', 'N/A')}")
             else:
                 logs.append("No instances found for the cluster.")
     else:
         logs.append("No EKS clusters found.")
-    
+
     # Write the logs to a file
     write_logs_to_file(logs, 'eks_cluster_logs.txt')
 
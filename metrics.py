@@ -0,0 +1,178 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prettytable import PrettyTable
+
+logger = logging.getLogger()
+
+METRICS_PREFIX = 'ebs_encryption'
+QUANTILES = [0.5, 0.95]
+
+# (step, volume type) -> list of durations in seconds, kept for the end-of-run summary.
+STEP_DURATIONS = defaultdict(list)
+METRICS_LOCK = threading.Lock()
+METRICS_FILE = None
+# Set by ratelimit so the exposition includes API call and throttle counters.
+COUNTER_SOURCES = {}
+
+
+def configure(path=None):
+    global METRICS_FILE
+    with METRICS_LOCK:
+        STEP_DURATIONS.clear()
+        if METRICS_FILE:
+            METRICS_FILE.close()
+        METRICS_FILE = open(path, 'a', buffering=1) if path else None
+
+
+def close():
+    global METRICS_FILE
+    with METRICS_LOCK:
+        if METRICS_FILE:
+            METRICS_FILE.close()
+        METRICS_FILE = None
+
+
+def record_event(event, **fields):
+    fields = {'timestamp': datetime.now().isoformat(), 'event': event, **fields}
+    line = json.dumps(fields, default=str)
+    with METRICS_LOCK:
+        if METRICS_FILE:
+            METRICS_FILE.write(line + '\n')
+
+
+def record_step(step, duration_seconds, volume_type=None, size_gb=None, status='ok', **labels):
+    fields = {'step': step, 'duration_seconds': round(duration_seconds, 3), 'volume_type': volume_type, 'status': status, **labels}
+    if size_gb:
+        fields['size_gb'] = size_gb
+        fields['seconds_per_gb'] = round(duration_seconds / size_gb, 3)
+    record_event('step', **fields)
+    if status == 'ok':
+        with METRICS_LOCK:
+            STEP_DURATIONS[(step, volume_type or '-')].append(duration_seconds)
+
+
+class StepTimer:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    @property
+    def elapsed(self):
+        return timedelta(seconds=self.seconds)
+
+
+@contextmanager
+def timed_step(step, volume_type=None, size_gb=None, **labels):
+    timer = StepTimer()
+    try:
+        yield timer
+    except BaseException:
+        timer.seconds = time.monotonic() - timer.started
+        record_step(step, timer.seconds, volume_type, size_gb, status='error', **labels)
+        raise
+    timer.seconds = time.monotonic() - timer.started
+    record_step(step, timer.seconds, volume_type, size_gb, **labels)
+
+
+def percentile(values, quantile):
+    # Nearest-rank percentile.
+    values = sorted(values)
+    return values[max(0, math.ceil(quantile * len(values)) - 1)]
+
+
+def step_statistics():
+    with METRICS_LOCK:
+        durations = {key: list(values) for key, values in STEP_DURATIONS.items()}
+    return {key: {
+        'count': len(values),
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'max': max(values),
+        'sum': sum(values),
+    } for key, values in sorted(durations.items())}
+
+
+def summary_table():
+    table = PrettyTable()
+    table.field_names = ["Step", "Volume Type", "Count", "p50 (s)", "p95 (s)", "Max (s)"]
+    for (step, volume_type), stats in step_statistics().items():
+        table.add_row([step, volume_type, stats['count'], f"{stats['p50']:.1f}", f"{stats['p95']:.1f}", f"{stats['max']:.1f}"])
+    return table
+
+
+def log_summary():
+    statistics = step_statistics()
+    logger.info(f"Step timings:\n{summary_table().get_string()}")
+    record_event('summary', steps=[{'step': step, 'volume_type': volume_type, **stats} for (step, volume_type), stats in statistics.items()])
+
+
+def prometheus_text():
+    lines = [
+        f"# HELP {METRICS_PREFIX}_step_duration_seconds Duration of each encryption step.",
+        f"# TYPE {METRICS_PREFIX}_step_duration_seconds summary",
+    ]
+    with METRICS_LOCK:
+        durations = {key: list(values) for key, values in STEP_DURATIONS.items()}
+    for (step, volume_type), values in sorted(durations.items()):
+        labels = f'step="{step}",volume_type="{volume_type}"'
+        for quantile in QUANTILES:
+            lines.append(f'{METRICS_PREFIX}_step_duration_seconds{{{labels},quantile="{quantile}"}} {percentile(values, quantile):.3f}')
+        lines.append(f'{METRICS_PREFIX}_step_duration_seconds_sum{{{labels}}} {sum(values):.3f}')
+        lines.append(f'{METRICS_PREFIX}_step_duration_seconds_count{{{labels}}} {len(values)}')
+    for name, source in sorted(COUNTER_SOURCES.items()):
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+        for (service, action), count in sorted(source().items()):
+            lines.append(f'{METRICS_PREFIX}_{name}{{service="{service}",action="{action}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(path):
+    # Written to a temporary file and renamed so the node exporter never reads a partial file.
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as file:
+        file.write(prometheus_text())
+    os.replace(temporary_path, path)
+
+
+def start_textfile_writer(path, interval):
+    def write_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                write_prometheus_textfile(path)
+            except OSError as e:
+                logger.error(f"Could not write metrics to {path}. Error: {str(e)}")
+
+    threading.Thread(target=write_periodically, name='metrics-textfile', daemon=True).start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,338 @@
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from prettytable import PrettyTable
+
+from metrics import percentile
+
+logger = logging.getLogger()
+
+# Estimates use a high percentile of past runs so that booked windows are rarely overrun.
+PLANNING_QUANTILE = 0.95
+
+# Steps whose duration grows with the volume size are estimated in seconds per GB,
+# the others in seconds. The defaults are used until a run has recorded real timings.
+SIZE_DEPENDENT_STEPS = {'snapshot', 'incremental_snapshot', 'baseline_snapshot', 'create_volume',
+                        'copy_snapshot', 'incremental_copy', 'baseline_copy'}
+DEFAULT_SECONDS_PER_GB = {
+    'snapshot': 6.0,
+    'incremental_snapshot': 6.0,
+    'baseline_snapshot': 6.0,
+    'create_volume': 0.2,
+    'copy_snapshot': 3.0,
+    'incremental_copy': 3.0,
+    'baseline_copy': 3.0,
+}
+# Share of a volume's blocks an incremental snapshot is assumed to copy.
+DEFAULT_INCREMENTAL_FRACTION = 0.1
+DEFAULT_STEP_SECONDS = {
+    'stop_instance': 60.0,
+    'start_instance': 60.0,
+    'detach_volume': 15.0,
+    'detach_volumes': 20.0,
+    'attach_volume': 10.0,
+}
+
+
+def load_history(path):
+    # Step timings of earlier runs from the metrics file, keyed by (step, volume type).
+    history = defaultdict(list)
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get('event') != 'step' or event.get('status') != 'ok':
+                    continue
+                step = event['step']
+                if step in SIZE_DEPENDENT_STEPS:
+                    if not event.get('size_gb'):
+                        continue
+                    value = event['seconds_per_gb']
+                else:
+                    value = event['duration_seconds']
+                history[(step, event.get('volume_type') or '-')].append(value)
+    except FileNotFoundError:
+        logger.warning(f"No timing history found in {path}. Using default step durations.")
+    return history
+
+
+class DurationEstimator:
+    def __init__(self, history=None, quantile=PLANNING_QUANTILE, encryption_engine='volume'):
+        self.encryption_engine = encryption_engine
+        self.estimates = {}
+        by_step = defaultdict(list)
+        for (step, volume_type), values in (history or {}).items():
+            self.estimates[(step, volume_type)] = percentile(values, quantile)
+            by_step[step].extend(values)
+        # Volume types without history of their own fall back to all types of the step.
+        for step, values in by_step.items():
+            self.estimates[(step, '-')] = percentile(values, quantile)
+
+    def step_seconds(self, step, volume=None):
+        volume_type = volume['VolumeType'] if volume else '-'
+        defaults = DEFAULT_SECONDS_PER_GB if step in SIZE_DEPENDENT_STEPS else DEFAULT_STEP_SECONDS
+        estimate = self.estimates.get((step, volume_type), self.estimates.get((step, '-'), defaults.get(step, 0.0)))
+        if step in SIZE_DEPENDENT_STEPS:
+            return estimate * volume['Size']
+        return estimate
+
+    def snapshot_seconds(self, volume, snapshot_mode):
+        if snapshot_mode == 'pre-stop' and (('incremental_snapshot', '-') in self.estimates):
+            seconds = self.step_seconds('incremental_snapshot', volume)
+        else:
+            seconds = self.step_seconds('snapshot', volume)
+        return seconds + self.copy_seconds(volume, snapshot_mode)
+
+    def copy_seconds(self, volume, snapshot_mode):
+        # The copy engine encrypts every snapshot with copy_snapshot before creating the volume.
+        if self.encryption_engine != 'copy':
+            return 0.0
+        if snapshot_mode == 'pre-stop' and (('incremental_copy', '-') in self.estimates):
+            return self.step_seconds('incremental_copy', volume)
+        return self.step_seconds('copy_snapshot', volume)
+
+    def downtime(self, volumes, snapshot_mode='serial'):
+        # Seconds between stopping and restarting the instance.
+        if snapshot_mode == 'baseline-only':
+            return 0.0
+        seconds = self.step_seconds('stop_instance') + self.step_seconds('start_instance')
+        if snapshot_mode == 'serial':
+            for volume in volumes:
+                seconds += self.snapshot_seconds(volume, snapshot_mode) + self.step_seconds('create_volume', volume)
+                seconds += self.step_seconds('detach_volume', volume) + self.step_seconds('attach_volume', volume)
+            return seconds
+        # Overlapped modes wait for the slowest volume, then swap all of them in one batch.
+        seconds += max(self.snapshot_seconds(volume, snapshot_mode) + self.step_seconds('create_volume', volume) for volume in volumes)
+        seconds += self.step_seconds('detach_volumes')
+        seconds += sum(self.step_seconds('attach_volume', volume) for volume in volumes)
+        return seconds
+
+    def lead_time(self, volumes, snapshot_mode='serial'):
+        # Work done while the instance is still running.
+        if snapshot_mode not in ('pre-stop', 'baseline-only'):
+            return 0.0
+        if self.encryption_engine == 'copy':
+            return max(self.step_seconds('baseline_snapshot', volume) + self.step_seconds('baseline_copy', volume) for volume in volumes)
+        return max(self.step_seconds('baseline_snapshot', volume) for volume in volumes)
+
+
+class Window:
+    # One maintenance window, run by a fixed number of worker lanes. Each lane processes
+    # its instances one after another; an AZ or account may only use as many lanes as its
+    # concurrency cap, which keeps the caps true at every moment of the window.
+    def __init__(self, index, seconds, lanes, max_per_az=None, max_per_account=None):
+        self.index = index
+        self.seconds = seconds
+        self.lane_used = [0.0] * lanes
+        self.lane_keys = [set() for _ in range(lanes)]
+        self.max_per_az = max_per_az
+        self.max_per_account = max_per_account
+        self.entries = []
+
+    def lanes_holding(self, key):
+        return sum(1 for keys in self.lane_keys if key in keys)
+
+    def fits_lane(self, lane, job, seconds):
+        if self.lane_used[lane] + seconds > self.seconds:
+            return False
+        az_key = ('az', job['account_id'], job['availability_zone'])
+        account_key = ('account', job['account_id'])
+        if self.max_per_az and az_key not in self.lane_keys[lane] and self.lanes_holding(az_key) >= self.max_per_az:
+            return False
+        if self.max_per_account and account_key not in self.lane_keys[lane] and self.lanes_holding(account_key) >= self.max_per_account:
+            return False
+        return True
+
+    def place(self, job, seconds):
+        # Best fit: the fullest lane that still has room, leaving long gaps for long instances.
+        lanes = [lane for lane in range(len(self.lane_used)) if self.fits_lane(lane, job, seconds)]
+        if not lanes:
+            return False
+        lane = max(lanes, key=lambda lane: self.lane_used[lane])
+        self.entries.append({
+            'instance_id': job['instance_id'],
+            'availability_zone': job['availability_zone'],
+            'account_id': job['account_id'],
+            'region': job['region'],
+            'volume_ids': [volume['VolumeId'] for volume in job['volumes']],
+            'lane': lane,
+            'offset_seconds': round(self.lane_used[lane]),
+            'estimated_seconds': round(seconds),
+        })
+        self.lane_used[lane] += seconds
+        self.lane_keys[lane].update({('az', job['account_id'], job['availability_zone']), ('account', job['account_id'])})
+        return True
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'estimated_seconds': round(max(self.lane_used)),
+            'instances': sorted(self.entries, key=lambda entry: (entry['lane'], entry['offset_seconds'])),
+        }
+
+
+def plan_windows(jobs, estimator, window_minutes, workers=1, max_per_az=None, max_per_account=None, max_windows=None, snapshot_mode='serial'):
+    # First fit decreasing: the longest instances are placed first, each into the earliest
+    # window with room, so every window is filled before the next one is opened.
+    window_seconds = window_minutes * 60
+    estimated = []
+    for job in jobs:
+        # Baseline snapshots of pre-stop mode run before the instance is stopped, but still
+        # have to finish inside the window.
+        seconds = estimator.lead_time(job['volumes'], snapshot_mode) + estimator.downtime(job['volumes'], snapshot_mode)
+        estimated.append((seconds, job))
+    estimated.sort(key=lambda item: item[0], reverse=True)
+
+    windows = []
+    unscheduled = []
+    for seconds, job in estimated:
+        if seconds > window_seconds:
+            unscheduled.append(unscheduled_entry(job, seconds, 'longer than a window'))
+            continue
+        if any(window.place(job, seconds) for window in windows):
+            continue
+        if max_windows and len(windows) >= max_windows:
+            unscheduled.append(unscheduled_entry(job, seconds, 'no room before the deadline'))
+            continue
+        window = Window(len(windows), window_seconds, workers, max_per_az, max_per_account)
+        window.place(job, seconds)
+        windows.append(window)
+
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'snapshot_mode': snapshot_mode,
+        'encryption_engine': estimator.encryption_engine,
+        'window_minutes': window_minutes,
+        'workers': workers,
+        'max_per_az': max_per_az,
+        'max_per_account': max_per_account,
+        'windows': [window.to_dict() for window in windows],
+        'unscheduled': unscheduled,
+    }
+
+
+def unscheduled_entry(job, seconds, reason):
+    return {
+        'instance_id': job['instance_id'],
+        'availability_zone': job['availability_zone'],
+        'account_id': job['account_id'],
+        'region': job['region'],
+        'estimated_seconds': round(seconds),
+        'reason': reason,
+    }
+
+
+# API calls each volume and instance needs, apart from the polling of their progress.
+MUTATING_CALLS_PER_VOLUME = {'serial': 4, 'overlap': 4, 'pre-stop': 5, 'baseline-only': 1}
+MUTATING_CALLS_PER_INSTANCE = {'serial': 2, 'overlap': 2, 'pre-stop': 2, 'baseline-only': 0}
+WAITS_PER_VOLUME = {'serial': 4, 'overlap': 2, 'pre-stop': 3, 'baseline-only': 0}
+WAITS_PER_INSTANCE = {'serial': 2, 'overlap': 3, 'pre-stop': 3, 'baseline-only': 1}
+# The copy engine adds one copy_snapshot per snapshot taken, and waits for the copies.
+COPIES_PER_VOLUME = {'serial': 1, 'overlap': 1, 'pre-stop': 2, 'baseline-only': 1}
+COPY_WAITS_PER_VOLUME = {'serial': 1, 'overlap': 0, 'pre-stop': 0, 'baseline-only': 0}
+COPY_WAITS_PER_INSTANCE = {'serial': 0, 'overlap': 1, 'pre-stop': 2, 'baseline-only': 1}
+BYTES_PER_GB = 1024 ** 3
+
+
+def build_change_plan(jobs, excluded, estimator, snapshot_mode='serial', regions=None, role_arns=None):
+    # The complete zone -> instance -> volume plan of a run, with what it will cost.
+    zones = {}
+    totals = {'instances': 0, 'volumes': 0, 'snapshot_bytes': 0, 'mutating_api_calls': 0, 'minimum_describe_calls': 0}
+    for job in sorted(jobs, key=lambda job: (job['account_id'], job['region'], job['availability_zone'], job['instance_id'])):
+        volume_count = len(job['volumes'])
+        snapshot_bytes = sum(volume['Size'] for volume in job['volumes']) * BYTES_PER_GB
+        if snapshot_mode == 'pre-stop':
+            # The baseline is a full copy; the snapshot taken after the stop is incremental.
+            snapshot_bytes *= 1 + DEFAULT_INCREMENTAL_FRACTION
+        if estimator.encryption_engine == 'copy':
+            # Encrypted copies are stored next to the plain snapshots until those are cleaned up.
+            snapshot_bytes *= 2
+        zone = zones.setdefault(f"{job['account_id']}/{job['region']}/{job['availability_zone']}", {})
+        zone[job['instance_id']] = {
+            'account_id': job['account_id'],
+            'region': job['region'],
+            'availability_zone': job['availability_zone'],
+            'estimated_downtime_seconds': round(estimator.downtime(job['volumes'], snapshot_mode)),
+            'volumes': job['volumes'],
+        }
+        totals['instances'] += 1
+        totals['volumes'] += volume_count
+        totals['snapshot_bytes'] += int(snapshot_bytes)
+        totals['mutating_api_calls'] += MUTATING_CALLS_PER_VOLUME[snapshot_mode] * volume_count + MUTATING_CALLS_PER_INSTANCE[snapshot_mode]
+        totals['minimum_describe_calls'] += WAITS_PER_VOLUME[snapshot_mode] * volume_count + WAITS_PER_INSTANCE[snapshot_mode]
+        if estimator.encryption_engine == 'copy':
+            totals['mutating_api_calls'] += COPIES_PER_VOLUME[snapshot_mode] * volume_count
+            totals['minimum_describe_calls'] += COPY_WAITS_PER_VOLUME[snapshot_mode] * volume_count + COPY_WAITS_PER_INSTANCE[snapshot_mode]
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'snapshot_mode': snapshot_mode,
+        'encryption_engine': estimator.encryption_engine,
+        'regions': regions,
+        'role_arns': role_arns,
+        'totals': totals,
+        'zones': zones,
+        'excluded': excluded,
+    }
+
+
+def plan_jobs(plan):
+    for zone in plan['zones'].values():
+        for instance_id, entry in zone.items():
+            yield {
+                'instance_id': instance_id,
+                'availability_zone': entry['availability_zone'],
+                'account_id': entry['account_id'],
+                'region': entry['region'],
+                'volumes': entry['volumes'],
+            }
+
+
+def log_change_plan(plan):
+    totals = plan['totals']
+    logger.info(f"Plan: {totals['instances']} instances and {totals['volumes']} volumes in {len(plan['zones'])} zones, "
+                f"{totals['snapshot_bytes'] / BYTES_PER_GB:.0f} GB to snapshot, {totals['mutating_api_calls']} mutating API calls "
+                f"and at least {totals['minimum_describe_calls']} describe calls; {len(plan['excluded'])} instances excluded")
+    for entry in plan['excluded']:
+        logger.info(f"Excluded instance {entry['instance_id']}: {entry['reason']}")
+
+
+def write_schedule(schedule, path):
+    with open(path, 'w') as file:
+        json.dump(schedule, file, indent=2, default=str)
+
+
+def load_schedule(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+# Change plans are JSON documents just like schedules.
+write_plan = write_schedule
+load_plan = load_schedule
+
+
+def window_instance_ids(schedule, window_index):
+    for window in schedule['windows']:
+        if window['index'] == window_index:
+            return {entry['instance_id'] for entry in window['instances']}
+    raise ValueError(f"Schedule has no window {window_index}; it has {len(schedule['windows'])} windows.")
+
+
+def schedule_table(schedule):
+    table = PrettyTable()
+    table.field_names = ["Window", "Instances", "Volumes", "Estimated (min)"]
+    for window in schedule['windows']:
+        volume_count = sum(len(entry['volume_ids']) for entry in window['instances'])
+        table.add_row([window['index'], len(window['instances']), volume_count, f"{window['estimated_seconds'] / 60:.1f}"])
+    return table
+
+
+def log_schedule(schedule):
+    logger.info(f"Schedule for {schedule['window_minutes']} minute windows with {schedule['workers']} workers:\n{schedule_table(schedule).get_string()}")
+    for entry in schedule['unscheduled']:
+        logger.warning(f"Instance {entry['instance_id']} not scheduled ({entry['reason']}): estimated {entry['estimated_seconds'] / 60:.1f} minutes")
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from prettytable import PrettyTable
+
+from ratelimit import throttle_summary
+
+logger = logging.getLogger()
+
+STATUS_INTERVAL = 5
+# Resource IDs recorded with a volume step, latest stage first; the snapshot whose Progress
+# is shown for the volume is the first one present.
+SNAPSHOT_ID_KEYS = ['copy_id', 'snapshot_id', 'baseline_copy_id', 'baseline_snapshot_id']
+CLEAR_SCREEN = '\x1b[H\x1b[2J'
+
+
+def initial_state():
+    return {
+        'started_at': time.monotonic(),
+        'discovering': True,
+        'queued_volumes': 0,
+        'queued_gb': 0,
+        'completed_volumes': 0,
+        'completed_gb': 0,
+        'completed_instances': 0,
+        'failed_instances': 0,
+    }
+
+
+STATE_LOCK = threading.Lock()
+STATE = initial_state()
+# Instance ID -> the instance being processed, with its volumes.
+IN_FLIGHT = {}
+# Returns the Progress percentage the resource poller last saw for a snapshot, so the view
+# costs no API calls of its own.
+SNAPSHOT_PROGRESS = None
+WRITER = None
+
+
+def configure(snapshot_progress=None):
+    global SNAPSHOT_PROGRESS
+    with STATE_LOCK:
+        STATE.clear()
+        STATE.update(initial_state())
+        IN_FLIGHT.clear()
+        SNAPSHOT_PROGRESS = snapshot_progress
+
+
+def job_queued(job):
+    with STATE_LOCK:
+        STATE['queued_volumes'] += len(job['volumes'])
+        STATE['queued_gb'] += sum(volume['Size'] for volume in job['volumes'])
+
+
+def discovery_finished():
+    with STATE_LOCK:
+        STATE['discovering'] = False
+
+
+def job_started(job):
+    with STATE_LOCK:
+        IN_FLIGHT[job['instance_id']] = {
+            'availability_zone': job['availability_zone'],
+            'region': job['region'],
+            'started_at': time.monotonic(),
+            'step': 'started',
+            'volumes': {volume['VolumeId']: {'size': volume['Size'], 'step': 'queued', 'snapshot_id': None} for volume in job['volumes']},
+        }
+
+
+def job_finished(job, failed=False):
+    with STATE_LOCK:
+        IN_FLIGHT.pop(job['instance_id'], None)
+        STATE['failed_instances' if failed else 'completed_instances'] += 1
+
+
+def instance_step(instance_id, step):
+    with STATE_LOCK:
+        if instance_id in IN_FLIGHT:
+            IN_FLIGHT[instance_id]['step'] = step
+
+
+def volume_step(volume_id, step, **resource_ids):
+    snapshot_id = next((resource_ids[key] for key in SNAPSHOT_ID_KEYS if resource_ids.get(key)), None)
+    with STATE_LOCK:
+        for instance in IN_FLIGHT.values():
+            volume = instance['volumes'].get(volume_id)
+            if volume is None:
+                continue
+            # A rolled back volume no longer counts as done.
+            done_change = (step == 'attached') - (volume['step'] == 'attached')
+            volume['step'] = step
+            if snapshot_id:
+                volume['snapshot_id'] = snapshot_id
+            STATE['completed_volumes'] += done_change
+            STATE['completed_gb'] += done_change * volume['size']
+            return
+
+
+def status():
+    with STATE_LOCK:
+        state = dict(STATE)
+        in_flight = {instance_id: {**instance, 'volumes': {volume_id: dict(volume) for volume_id, volume in instance['volumes'].items()}}
+                     for instance_id, instance in IN_FLIGHT.items()}
+    now = time.monotonic()
+    elapsed = now - state['started_at']
+    throughput = state['completed_gb'] / (elapsed / 3600) if elapsed > 0 else 0.0
+    remaining_gb = state['queued_gb'] - state['completed_gb']
+    throttle_counts, _ = throttle_summary()
+
+    instances = []
+    for instance_id, instance in sorted(in_flight.items(), key=lambda item: item[1]['started_at']):
+        volumes = []
+        for volume_id, volume in instance['volumes'].items():
+            progress = SNAPSHOT_PROGRESS(volume['snapshot_id']) if SNAPSHOT_PROGRESS and volume['snapshot_id'] else None
+            volumes.append({'volume_id': volume_id, 'size_gb': volume['size'], 'step': volume['step'],
+                            'snapshot_id': volume['snapshot_id'], 'snapshot_progress': progress})
+        instances.append({'instance_id': instance_id, 'availability_zone': instance['availability_zone'], 'region': instance['region'],
+                          'step': instance['step'], 'elapsed_seconds': round(now - instance['started_at']), 'volumes': volumes})
+
+    return {
+        'updated_at': datetime.now().isoformat(timespec='seconds'),
+        'elapsed_seconds': round(elapsed),
+        'discovering': state['discovering'],
+        'queued_volumes': state['queued_volumes'],
+        'queued_gb': state['queued_gb'],
+        'completed_volumes': state['completed_volumes'],
+        'completed_gb': state['completed_gb'],
+        'completed_instances': state['completed_instances'],
+        'failed_instances': state['failed_instances'],
+        'throughput_gb_per_hour': round(throughput, 1),
+        # While discovery runs, more work may still be found, so the ETA is a lower bound.
+        'eta_seconds': round(remaining_gb / throughput * 3600) if throughput else None,
+        'throttled_calls': sum(throttle_counts.values()),
+        'in_flight': instances,
+    }
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else str(timedelta(seconds=int(seconds)))
+
+
+def render(current):
+    eta = format_seconds(current['eta_seconds'])
+    if current['discovering'] and current['eta_seconds'] is not None:
+        eta = f">{eta}"
+    header = (f"Elapsed {format_seconds(current['elapsed_seconds'])} | "
+              f"{current['completed_volumes']}/{current['queued_volumes']} volumes, {current['completed_gb']}/{current['queued_gb']} GB"
+              f"{' (discovering)' if current['discovering'] else ''} | {current['throughput_gb_per_hour']} GB/h | ETA {eta} | "
+              f"{len(current['in_flight'])} in flight, {current['completed_instances']} done, {current['failed_instances']} failed | "
+              f"{current['throttled_calls']} throttled")
+    table = PrettyTable()
+    table.field_names = ["Instance ID", "Availability Zone", "Instance Step", "Elapsed", "Volume ID", "Size (GB)", "Volume Step", "Snapshot"]
+    for instance in current['in_flight']:
+        for volume in instance['volumes']:
+            progress = f"{volume['snapshot_progress']:.0f}%" if volume['snapshot_progress'] is not None else ''
+            table.add_row([instance['instance_id'], instance['availability_zone'], instance['step'], format_seconds(instance['elapsed_seconds']),
+                           volume['volume_id'], volume['size_gb'], volume['step'], progress])
+    return f"{header}\n{table.get_string()}"
+
+
+def write_status_file(path, current):
+    # Written to a temporary file and renamed so readers never see a partial file.
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as file:
+        json.dump(current, file, indent=2)
+    os.replace(temporary_path, path)
+
+
+def refresh(status_file=None, terminal=False):
+    current = status()
+    if status_file:
+        try:
+            write_status_file(status_file, current)
+        except OSError as e:
+            logger.error(f"Could not write the status to {status_file}. Error: {str(e)}")
+    if terminal:
+        sys.stderr.write(CLEAR_SCREEN + render(current) + '\n')
+        sys.stderr.flush()
+
+
+def start(status_file=None, terminal=False, interval=STATUS_INTERVAL):
+    global WRITER
+    stopped = threading.Event()
+
+    def refresh_periodically():
+        while not stopped.wait(interval):
+            refresh(status_file, terminal)
+
+    thread = threading.Thread(target=refresh_periodically, name='progress', daemon=True)
+    WRITER = (thread, stopped, status_file, terminal)
+    thread.start()
+
+
+def stop():
+    # One last refresh, so the status file shows the end state of the run.
+    global WRITER
+    if WRITER:
+        thread, stopped, status_file, terminal = WRITER
+        stopped.set()
+        thread.join()
+        refresh(status_file, terminal)
+        WRITER = None
@@ -0,0 +1,154 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+logger = logging.getLogger()
+
+THROTTLING_ERROR_CODES = {
+    'RequestLimitExceeded',
+    'SnapshotCreationPerVolumeRateExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+}
+
+MAX_THROTTLE_ATTEMPTS = 10
+BASE_BACKOFF = 1
+MAX_BACKOFF = 60
+
+# (bucket size, refill per second) of the EC2 request token bucket categories. Every
+# action gets its own bucket of its category's size, as EC2 does.
+NON_MUTATING_BUCKET = (100, 20)
+MUTATING_BUCKET = (200, 5)
+RESOURCE_INTENSIVE_BUCKET = (50, 5)
+DEFAULT_BUCKET = (50, 10)
+
+RESOURCE_INTENSIVE_ACTIONS = {
+    'AttachVolume', 'CopySnapshot', 'CreateSnapshot', 'CreateVolume', 'DeleteSnapshot', 'DeleteVolume', 'DetachVolume',
+}
+
+API_CALL_COUNTS = Counter()
+THROTTLE_COUNTS = Counter()
+COUNTS_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.refill_rate
+            time.sleep(wait_time)
+
+
+def bucket_size(service, action):
+    if service != 'ec2':
+        return DEFAULT_BUCKET
+    if action in RESOURCE_INTENSIVE_ACTIONS:
+        return RESOURCE_INTENSIVE_BUCKET
+    if action.startswith(('Describe', 'Get', 'List')):
+        return NON_MUTATING_BUCKET
+    return MUTATING_BUCKET
+
+
+def backoff_delay(attempts):
+    # Full jitter: a random delay up to an exponentially growing cap.
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempts))
+
+
+def record_throttle(service, action):
+    with COUNTS_LOCK:
+        THROTTLE_COUNTS[(service, action)] += 1
+
+
+def record_api_call(service, action):
+    with COUNTS_LOCK:
+        API_CALL_COUNTS[(service, action)] += 1
+
+
+class RateLimiter:
+    # Client side token buckets for one region and account. Every request, retries
+    # included, takes a token of its action's bucket before it is sent, and throttling
+    # errors are retried with jittered exponential backoff instead of failing the run.
+    def __init__(self, name):
+        self.name = name
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, service, action):
+        with self.lock:
+            if (service, action) not in self.buckets:
+                self.buckets[(service, action)] = TokenBucket(*bucket_size(service, action))
+            return self.buckets[(service, action)]
+
+    def install(self, client):
+        # botocore registers its own retry handler on the service's needs-retry event, which
+        # runs before any handler of the generic event; registering first on the service's
+        # event makes the throttling backoff below the one that is used.
+        service = client.meta.service_model.service_name
+        client.meta.events.register_first('before-send', self.before_send)
+        client.meta.events.register_first(f"needs-retry.{service}", self.needs_retry)
+
+    def before_send(self, event_name, **kwargs):
+        _, service, action = event_name.split('.', 2)
+        self.bucket(service, action).acquire()
+        record_api_call(service, action)
+
+    def needs_retry(self, event_name, response=None, attempts=None, **kwargs):
+        if response is None:
+            return None
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code not in THROTTLING_ERROR_CODES:
+            return None
+        _, service, action = event_name.split('.', 2)
+        record_throttle(service, action)
+        metrics.record_event('throttle', service=service, action=action, error_code=error_code, attempt=attempts, limiter=self.name)
+        if attempts >= MAX_THROTTLE_ATTEMPTS:
+            logger.error(f"{action} in {self.name} still throttled ({error_code}) after {attempts} attempts.")
+            return None
+        delay = backoff_delay(attempts)
+        logger.warning(f"{action} in {self.name} throttled ({error_code}). Retrying in {delay:.1f} seconds (attempt {attempts}).")
+        return delay
+
+
+def reset_counts():
+    with COUNTS_LOCK:
+        API_CALL_COUNTS.clear()
+        THROTTLE_COUNTS.clear()
+
+
+def throttle_summary():
+    with COUNTS_LOCK:
+        return dict(THROTTLE_COUNTS), dict(API_CALL_COUNTS)
+
+
+def api_call_counts():
+    with COUNTS_LOCK:
+        return dict(API_CALL_COUNTS)
+
+
+def throttle_counts():
+    with COUNTS_LOCK:
+        return dict(THROTTLE_COUNTS)
+
+
+metrics.COUNTER_SOURCES['api_calls_total'] = api_call_counts
+metrics.COUNTER_SOURCES['throttles_total'] = throttle_counts
@@ -0,0 +1,205 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+
+from prettytable import PrettyTable
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger()
+
+# Column key -> table title, in report order.
+VOLUME_REPORT_FIELDS = {
+    'account_id': 'Account ID',
+    'region': 'Region',
+    'old_volume_id': 'Old Volume ID',
+    'new_volume_id': 'New Volume ID',
+    'instance_id': 'Instance ID',
+    'instance_name': 'Instance Name',
+    'device_name': 'Device Name',
+    'disk_size': 'Disk Size',
+    'snapshot_id': 'Snapshot ID',
+    'baseline_snapshot_id': 'Baseline Snapshot ID',
+    'encrypted_snapshot_id': 'Encrypted Snapshot ID',
+    'baseline_encrypted_snapshot_id': 'Baseline Encrypted Snapshot ID',
+    'availability_zone': 'Availability Zone',
+    # 'swapped', or 'rolled_back' when the original volume was put back.
+    'status': 'Status',
+    'completed_at': 'Completed At',
+}
+
+# Rows are flushed to disk within this many seconds of being written, by a timer thread,
+# so a crash loses at most a few seconds.
+FLUSH_INTERVAL = 5
+# Parquet rows are buffered and written as one row group per this many rows.
+PARQUET_ROW_GROUP_SIZE = 1000
+REPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.parquet': 'parquet'}
+
+
+class ReportSink:
+    # Appends one row per finished volume to a single buffered file handle, shared by
+    # every worker thread, so memory stays flat however many volumes a run touches.
+    periodic_flush = True
+
+    def __init__(self, path, fields=VOLUME_REPORT_FIELDS):
+        self.path = path
+        self.fields = list(fields)
+        self.titles = dict(fields)
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.unflushed = False
+        self.closed = threading.Event()
+        self.open()
+        self.flusher = None
+        if self.periodic_flush:
+            self.flusher = threading.Thread(target=self.flush_periodically, name='report-flush', daemon=True)
+            self.flusher.start()
+
+    def open(self):
+        raise NotImplementedError
+
+    def write_row(self, row):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def write(self, row):
+        with self.lock:
+            self.write_row({field: row.get(field) for field in self.fields})
+            self.rows += 1
+            self.unflushed = True
+
+    def flush_periodically(self):
+        # Swaps can be hours apart, so rows are not left waiting for the next write.
+        while not self.closed.wait(FLUSH_INTERVAL):
+            with self.lock:
+                if self.unflushed:
+                    self.flush()
+                    self.unflushed = False
+
+    def close(self):
+        self.closed.set()
+        if self.flusher:
+            self.flusher.join()
+        with self.lock:
+            self.flush()
+            self.file.close()
+
+
+class CsvReportSink(ReportSink):
+    def open(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fields)
+        if new_file:
+            # Column titles, as the reports always had; read_report maps them back.
+            self.writer.writerow(self.titles)
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+
+
+class JsonLinesReportSink(ReportSink):
+    def open(self):
+        self.file = open(self.path, 'a')
+
+    def write_row(self, row):
+        self.file.write(json.dumps(row, default=str) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+
+class ParquetReportSink(ReportSink):
+    # Needs the optional pyarrow package. Rows are kept until a row group is full; a
+    # Parquet file is only readable once closed, so flushing it early would not help.
+    periodic_flush = False
+
+    def open(self):
+        if pyarrow is None:
+            raise RuntimeError("Parquet reports need the pyarrow package: pip install pyarrow")
+        self.schema = pyarrow.schema([(field, pyarrow.int64() if field == 'disk_size' else pyarrow.string()) for field in self.fields])
+        self.file = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        self.buffer = []
+
+    def write_row(self, row):
+        self.buffer.append({field: value if field == 'disk_size' or value is None else str(value) for field, value in row.items()})
+        if len(self.buffer) >= PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write_table(pyarrow.Table.from_pylist(self.buffer, schema=self.schema))
+            self.buffer = []
+
+
+REPORT_SINKS = {'csv': CsvReportSink, 'jsonl': JsonLinesReportSink, 'parquet': ParquetReportSink}
+
+
+def report_format(path, output_format=None):
+    if output_format:
+        return output_format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in REPORT_FORMATS:
+        raise ValueError(f"Cannot tell the report format of {path}; use one of {sorted(REPORT_FORMATS)}.")
+    return REPORT_FORMATS[extension]
+
+
+def open_report(path, output_format=None, fields=VOLUME_REPORT_FIELDS):
+    return REPORT_SINKS[report_format(path, output_format)](path, fields)
+
+
+def read_report(path, output_format=None, fields=VOLUME_REPORT_FIELDS):
+    # Streams the rows of a report back, one at a time.
+    output_format = report_format(path, output_format)
+    if output_format == 'csv':
+        field_of_title = {title: field for field, title in fields.items()}
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                yield {field_of_title.get(title, title): value for title, value in row.items()}
+    elif output_format == 'jsonl':
+        with open(path) as file:
+            for line in file:
+                yield json.loads(line)
+    else:
+        if pyarrow is None:
+            raise RuntimeError("Parquet reports need the pyarrow package: pip install pyarrow")
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches():
+            yield from batch.to_pylist()
+
+
+def render_table(path, output_format=None, fields=VOLUME_REPORT_FIELDS):
+    table = PrettyTable()
+    table.field_names = [fields[field] for field in fields]
+    for row in read_report(path, output_format, fields):
+        table.add_row(['' if row.get(field) is None else row[field] for field in fields])
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render a volume report as a table.')
+    parser.add_argument('path', help='CSV, JSON lines or Parquet report written by encryption.py.')
+    parser.add_argument('--output', default=None, help='Write the table to this file instead of printing it.')
+    args = parser.parse_args(argv)
+    table = render_table(args.path).get_string()
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(table)
+    else:
+        print(table)
+
+
+if __name__ == '__main__':
+    main()
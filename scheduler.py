@@ -0,0 +1,63 @@
+import heapq
+import itertools
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger()
+
+# 'largest-first' starts the longest instances first, which keeps the last workers from
+# finishing long after the others; 'smallest-first' finishes the most instances early.
+JOB_ORDERS = ['largest-first', 'smallest-first', 'discovery']
+DEFAULT_CRITICALITY = 0
+
+
+def az_key(job):
+    return (job['account_id'], job['availability_zone'])
+
+
+class JobQueue:
+    # Pending instance jobs in one heap per account and AZ. Each heap is ordered by
+    # criticality, then by estimated duration; the next job is taken from the AZ with the
+    # fewest instances in flight, so the EBS load is spread over the zones. The choice is
+    # made again every time a worker frees up, from the load of that moment.
+    def __init__(self, order='largest-first', estimate=None, criticality=None):
+        if order not in JOB_ORDERS:
+            raise ValueError(f"Unknown job order {order}; use one of {JOB_ORDERS}.")
+        self.order = order
+        self.estimate = estimate or (lambda job: sum(volume['Size'] for volume in job['volumes']))
+        self.criticality = criticality or (lambda job: DEFAULT_CRITICALITY)
+        self.heaps = defaultdict(list)
+        self.counter = itertools.count()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def priority(self, job):
+        # Lower sorts first. Instances left half done by an interrupted run go before
+        # everything else, since they may still be stopped.
+        if self.order == 'largest-first':
+            size = -self.estimate(job)
+        elif self.order == 'smallest-first':
+            size = self.estimate(job)
+        else:
+            size = 0
+        return (0 if job.get('resumed') else 1, self.criticality(job), size, next(self.counter))
+
+    def push(self, job):
+        heapq.heappush(self.heaps[az_key(job)], (self.priority(job), job))
+        self.length += 1
+
+    def pop(self, fits, az_in_flight):
+        # The most urgent job whose AZ and account have room, from the least loaded AZ
+        # among the jobs of equal criticality; None when no job can start now.
+        candidates = [(heap[0][0][:2], az_in_flight[key], heap[0][0], key)
+                      for key, heap in self.heaps.items() if heap and fits(heap[0][1])]
+        if not candidates:
+            return None
+        key = min(candidates)[3]
+        _, job = heapq.heappop(self.heaps[key])
+        if not self.heaps[key]:
+            del self.heaps[key]
+        self.length -= 1
+        return job
@@ -0,0 +1,580 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter, first_non_none_response
+
+import ratelimit
+import waiters
+
+logger = logging.getLogger()
+
+DEFAULT_ACCOUNT_ID = '111111111111'
+
+# Simulated seconds each operation takes. Snapshots and encrypted snapshot copies move every
+# block the first time and only the changed blocks afterwards; volumes restored from a snapshot become available
+# quickly because their blocks are loaded lazily.
+LATENCY = {
+    'snapshot_seconds_per_gb': 6.0,
+    'incremental_fraction': 0.1,
+    'copy_seconds_per_gb': 3.0,
+    'volume_seconds': 5.0,
+    'volume_seconds_per_gb': 0.1,
+    'attach_seconds': 5.0,
+    'detach_seconds': 10.0,
+    'stop_seconds': 60.0,
+    'start_seconds': 45.0,
+    'status_check_seconds': 60.0,
+}
+
+VOLUME_TYPES = ['gp2', 'gp3', 'io1', 'st1']
+VOLUME_SIZES = [8, 20, 50, 100, 200, 500, 1000]
+DEFAULT_PAGE_SIZE = 1000
+# Attempts botocore's legacy retry mode makes for EC2 before giving up.
+BOTOCORE_MAX_ATTEMPTS = 5
+
+
+def operation_name(method_name):
+    return ''.join(part.title() for part in method_name.split('_'))
+
+
+def client_error(operation, code, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}}, operation)
+
+
+class SimulatedCloud:
+    # In-process stand-in for EC2, KMS and STS in any number of accounts and regions.
+    # Resources change state after a latency proportional to their size, divided by
+    # time_scale so that hours of simulated work finish in seconds. Throttling and
+    # failures are injected at the configured rates.
+    def __init__(self, time_scale=1.0, throttle_rate=0.0, api_failure_rate=0.0, snapshot_failure_rate=0.0, latency=None, seed=None):
+        self.time_scale = time_scale
+        self.throttle_rate = throttle_rate
+        self.api_failure_rate = api_failure_rate
+        self.snapshot_failure_rate = snapshot_failure_rate
+        self.latency = {**LATENCY, **(latency or {})}
+        self.random = random.Random(seed)
+        self.regions = {}
+        self.lock = threading.RLock()
+        self.call_counts = Counter()
+        self.throttle_counts = Counter()
+
+    def region(self, account_id, region_name):
+        with self.lock:
+            if (account_id, region_name) not in self.regions:
+                self.regions[(account_id, region_name)] = SimulatedRegion(self, account_id, region_name)
+            return self.regions[(account_id, region_name)]
+
+    def session(self, region_name=None, role_arn=None):
+        account_id = role_arn.split(':')[4] if role_arn else DEFAULT_ACCOUNT_ID
+        return SimulatedSession(self, account_id, region_name or 'us-east-1')
+
+    def delay(self, simulated_seconds):
+        return simulated_seconds / self.time_scale
+
+    def chance(self, rate):
+        with self.lock:
+            return rate and self.random.random() < rate
+
+    def generate_fleet(self, volume_count, volumes_per_instance=(1, 4), region_name='us-east-1', account_id=DEFAULT_ACCOUNT_ID,
+                       availability_zones=None, volume_sizes=None, volume_types=None, encrypted_fraction=0.0):
+        # Synthetic instances with attached volumes of random sizes and types.
+        region = self.region(account_id, region_name)
+        availability_zones = availability_zones or [f"{region_name}{zone}" for zone in 'abc']
+        volume_sizes = volume_sizes or VOLUME_SIZES
+        volume_types = volume_types or VOLUME_TYPES
+        created = 0
+        while created < volume_count:
+            count = min(self.random.randint(*volumes_per_instance), volume_count - created)
+            instance = region.add_instance(self.random.choice(availability_zones), {'Name': f"sim-{len(region.instances)}"})
+            for index in range(count):
+                device = '/dev/xvda' if index == 0 else f"/dev/sd{chr(ord('f') + index - 1)}"
+                volume = region.add_volume(instance['Placement']['AvailabilityZone'], self.random.choice(volume_sizes),
+                                           self.random.choice(volume_types), self.random.random() < encrypted_fraction)
+                region.attach(volume, instance, device)
+            created += count
+        return region
+
+
+class SimulatedRegion:
+    def __init__(self, cloud, account_id, region_name):
+        self.cloud = cloud
+        self.account_id = account_id
+        self.region_name = region_name
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.lock = threading.RLock()
+        self.sequence = 0
+
+    def new_id(self, prefix):
+        with self.lock:
+            self.sequence += 1
+            return f"{prefix}-{self.account_id[-4:]}{self.sequence:013x}"
+
+    def add_instance(self, availability_zone, tags):
+        instance = {
+            'InstanceId': self.new_id('i'),
+            'State': {'Name': 'running'},
+            'Placement': {'AvailabilityZone': availability_zone},
+            'RootDeviceName': '/dev/xvda',
+            'BlockDeviceMappings': [],
+            'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()],
+        }
+        self.instances[instance['InstanceId']] = {'resource': instance, 'target': None, 'ready_at': 0}
+        return instance
+
+    def add_volume(self, availability_zone, size, volume_type, encrypted=False, snapshot_id='', kms_key_id=None):
+        volume = {
+            'VolumeId': self.new_id('vol'),
+            'AvailabilityZone': availability_zone,
+            'Size': size,
+            'VolumeType': volume_type,
+            'Encrypted': encrypted,
+            'SnapshotId': snapshot_id,
+            'State': 'available',
+            'Attachments': [],
+            'Tags': [],
+            'CreateTime': datetime.now(timezone.utc),
+        }
+        if kms_key_id:
+            volume['KmsKeyId'] = kms_key_id
+        self.volumes[volume['VolumeId']] = {'resource': volume, 'target': None, 'ready_at': 0, 'snapshotted': False, 'copied': False}
+        return volume
+
+    def attach(self, volume, instance, device):
+        volume['State'] = 'in-use'
+        volume['Attachments'] = [{'VolumeId': volume['VolumeId'], 'InstanceId': instance['InstanceId'], 'Device': device, 'State': 'attached'}]
+        instance['BlockDeviceMappings'].append({'DeviceName': device, 'Ebs': {'VolumeId': volume['VolumeId'], 'Status': 'attached'}})
+
+    def transition(self, entry, state, simulated_seconds):
+        entry['target'] = state
+        entry['ready_at'] = time.monotonic() + self.cloud.delay(simulated_seconds)
+
+    def settle(self, entry, state_key=None):
+        # Moves a resource to its target state once its latency has passed.
+        if entry['target'] and time.monotonic() >= entry['ready_at']:
+            resource = entry['resource']
+            if state_key == 'instance':
+                resource['State'] = {'Name': entry['target']}
+            else:
+                resource['State'] = entry['target']
+            if 'on_ready' in entry:
+                entry.pop('on_ready')()
+            entry['target'] = None
+
+    def snapshot_progress(self, entry):
+        if not entry['target']:
+            return '100%'
+        remaining = max(entry['ready_at'] - time.monotonic(), 0)
+        total = max(entry['ready_at'] - entry['started_at'], 1e-9)
+        return f"{int(100 * (1 - remaining / total))}%"
+
+
+def matches_filters(resource, filters, attribute_names):
+    for resource_filter in filters or []:
+        name, values = resource_filter['Name'], [str(value) for value in resource_filter['Values']]
+        if name.startswith('tag:'):
+            tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
+            if tags.get(name[4:]) not in values:
+                return False
+        elif name in attribute_names:
+            value = attribute_names[name](resource)
+            if str(value).lower() not in [value.lower() for value in values]:
+                return False
+        else:
+            raise ValueError(f"Filter {name} is not supported by the simulation.")
+    return True
+
+
+VOLUME_FILTERS = {
+    'volume-id': lambda volume: volume['VolumeId'],
+    'encrypted': lambda volume: volume['Encrypted'],
+    'status': lambda volume: volume['State'],
+    'availability-zone': lambda volume: volume['AvailabilityZone'],
+}
+SNAPSHOT_FILTERS = {
+    'snapshot-id': lambda snapshot: snapshot['SnapshotId'],
+    'volume-id': lambda snapshot: snapshot['VolumeId'],
+    'status': lambda snapshot: snapshot['State'],
+}
+INSTANCE_FILTERS = {
+    'instance-id': lambda instance: instance['InstanceId'],
+    'instance-state-name': lambda instance: instance['State']['Name'],
+    'availability-zone': lambda instance: instance['Placement']['AvailabilityZone'],
+}
+
+
+def paginate_results(items, max_results, next_token):
+    start = int(next_token or 0)
+    end = start + (max_results or DEFAULT_PAGE_SIZE)
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class ClientMeta:
+    def __init__(self, service, region_name):
+        self.service_model = type('ServiceModel', (), {'service_name': service})()
+        self.region_name = region_name
+        self.events = HierarchicalEmitter()
+
+
+class SimulatedClient:
+    # Emits the same before-send and needs-retry events as a botocore client, so the
+    # rate limiter and its throttling retries run unchanged against the simulation. Like
+    # botocore, the client has its own retry handler for throttling errors, registered on
+    # the service's needs-retry event.
+    def __init__(self, cloud, region, service):
+        self.cloud = cloud
+        self.region = region
+        self.service = service
+        self.meta = ClientMeta(service, region.region_name)
+        self.meta.events.register(f"needs-retry.{service}", self.default_retry)
+        self.exceptions = type('Exceptions', (), {'NotFoundException': ClientError, 'ClientError': ClientError})
+
+    def default_retry(self, response=None, attempts=None, **kwargs):
+        # botocore's exponential backoff: a random delay up to 2 ** (attempts - 1) seconds.
+        if response is None or attempts >= BOTOCORE_MAX_ATTEMPTS:
+            return None
+        if response[1].get('Error', {}).get('Code') not in ratelimit.THROTTLING_ERROR_CODES:
+            return None
+        with self.cloud.lock:
+            jitter = self.cloud.random.random()
+        return self.cloud.delay(jitter * 2 ** (attempts - 1))
+
+    def call(self, method_name, handler, **kwargs):
+        operation = operation_name(method_name)
+        attempts = 1
+        while True:
+            self.meta.events.emit(f"before-send.{self.service}.{operation}", request=None)
+            with self.cloud.lock:
+                self.cloud.call_counts[(self.service, operation)] += 1
+            error = None
+            if self.cloud.chance(self.cloud.throttle_rate):
+                error = {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}
+                with self.cloud.lock:
+                    self.cloud.throttle_counts[(self.service, operation)] += 1
+            elif not operation.startswith('Describe') and self.cloud.chance(self.cloud.api_failure_rate):
+                error = {'Code': 'InternalError', 'Message': 'An internal error has occurred.'}
+            if error is None:
+                with self.region.lock:
+                    return handler(**kwargs)
+            parsed = {'Error': error, 'ResponseMetadata': {'HTTPStatusCode': 503}}
+            delay = first_non_none_response(self.meta.events.emit(
+                f"needs-retry.{self.service}.{operation}", response=(None, parsed), endpoint=None, operation=None,
+                attempts=attempts, caught_exception=None, request_dict={}))
+            if delay is None:
+                raise ClientError(parsed, operation)
+            time.sleep(delay)
+            attempts += 1
+
+    def get_paginator(self, method_name):
+        return SimulatedPaginator(self, method_name)
+
+
+class SimulatedPaginator:
+    def __init__(self, client, method_name):
+        self.client = client
+        self.method_name = method_name
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize')
+        next_token = None
+        while True:
+            page = getattr(self.client, self.method_name)(MaxResults=page_size, NextToken=next_token, **kwargs)
+            yield page
+            next_token = page.get('NextToken')
+            if not next_token:
+                return
+
+
+class SimulatedEC2(SimulatedClient):
+    def describe_volumes(self, VolumeIds=None, Filters=None, MaxResults=None, NextToken=None):
+        def handler():
+            if VolumeIds:
+                missing = [volume_id for volume_id in VolumeIds if volume_id not in self.region.volumes]
+                if missing:
+                    raise client_error('DescribeVolumes', 'InvalidVolume.NotFound', f"The volume '{missing[0]}' does not exist.")
+            volumes = []
+            for volume_id, entry in self.region.volumes.items():
+                self.region.settle(entry)
+                volume = entry['resource']
+                if VolumeIds and volume_id not in VolumeIds:
+                    continue
+                if volume['State'] != 'deleted' and matches_filters(volume, Filters, VOLUME_FILTERS):
+                    volumes.append(copy_resource(volume))
+            page, token = paginate_results(volumes, MaxResults, NextToken)
+            return with_token({'Volumes': page}, token)
+        return self.call('describe_volumes', handler)
+
+    def describe_snapshots(self, SnapshotIds=None, Filters=None, MaxResults=None, NextToken=None, OwnerIds=None):
+        def handler():
+            snapshots = []
+            for snapshot_id, entry in self.region.snapshots.items():
+                self.region.settle(entry)
+                snapshot = entry['resource']
+                snapshot['Progress'] = self.region.snapshot_progress(entry)
+                if SnapshotIds and snapshot_id not in SnapshotIds:
+                    continue
+                if snapshot['State'] != 'deleted' and matches_filters(snapshot, Filters, SNAPSHOT_FILTERS):
+                    snapshots.append(copy_resource(snapshot))
+            page, token = paginate_results(snapshots, MaxResults, NextToken)
+            return with_token({'Snapshots': page}, token)
+        return self.call('describe_snapshots', handler)
+
+    def describe_instances(self, InstanceIds=None, Filters=None, MaxResults=None, NextToken=None):
+        def handler():
+            instances = []
+            for instance_id, entry in self.region.instances.items():
+                self.region.settle(entry, 'instance')
+                if InstanceIds and instance_id not in InstanceIds:
+                    continue
+                if matches_filters(entry['resource'], Filters, INSTANCE_FILTERS):
+                    instances.append(copy_resource(entry['resource']))
+            page, token = paginate_results(instances, MaxResults, NextToken)
+            return with_token({'Reservations': [{'Instances': [instance]} for instance in page]}, token)
+        return self.call('describe_instances', handler)
+
+    def describe_instance_status(self, InstanceIds=None, MaxResults=None, NextToken=None):
+        # Running instances pass both status checks a while after they have started.
+        def handler():
+            statuses = []
+            for instance_id, entry in self.region.instances.items():
+                self.region.settle(entry, 'instance')
+                if InstanceIds and instance_id not in InstanceIds or entry['resource']['State']['Name'] != 'running':
+                    continue
+                passed = time.monotonic() >= entry['ready_at'] + self.cloud.delay(self.cloud.latency['status_check_seconds'])
+                status = {'Status': 'ok' if passed else 'initializing'}
+                statuses.append({'InstanceId': instance_id, 'InstanceState': entry['resource']['State'],
+                                 'InstanceStatus': dict(status), 'SystemStatus': dict(status)})
+            page, token = paginate_results(statuses, MaxResults, NextToken)
+            return with_token({'InstanceStatuses': page}, token)
+        return self.call('describe_instance_status', handler)
+
+    def create_snapshot(self, VolumeId, Description=''):
+        def handler():
+            volume_entry = self.region.volumes.get(VolumeId)
+            if not volume_entry:
+                raise client_error('CreateSnapshot', 'InvalidVolume.NotFound', f"The volume '{VolumeId}' does not exist.")
+            volume = volume_entry['resource']
+            latency = self.cloud.latency
+            seconds = volume['Size'] * latency['snapshot_seconds_per_gb']
+            if volume_entry['snapshotted']:
+                seconds *= latency['incremental_fraction']
+            volume_entry['snapshotted'] = True
+            snapshot = {
+                'SnapshotId': self.region.new_id('snap'),
+                'VolumeId': VolumeId,
+                'VolumeSize': volume['Size'],
+                'Description': Description,
+                'Encrypted': volume['Encrypted'],
+                'State': 'pending',
+                'Progress': '0%',
+                'StartTime': datetime.now(timezone.utc),
+                'OwnerId': self.region.account_id,
+                'Tags': [],
+            }
+            entry = {'resource': snapshot, 'target': None, 'ready_at': 0, 'started_at': time.monotonic()}
+            failed = self.cloud.chance(self.cloud.snapshot_failure_rate)
+            self.region.transition(entry, 'error' if failed else 'completed', seconds)
+            self.region.snapshots[snapshot['SnapshotId']] = entry
+            return copy_resource(snapshot)
+        return self.call('create_snapshot', handler)
+
+    def copy_snapshot(self, SourceSnapshotId, SourceRegion, Encrypted=False, KmsKeyId=None, Description=''):
+        def handler():
+            source_entry = self.region.snapshots.get(SourceSnapshotId)
+            if source_entry:
+                self.region.settle(source_entry)
+            if not source_entry or source_entry['resource']['State'] != 'completed':
+                raise client_error('CopySnapshot', 'IncorrectState', f"Snapshot '{SourceSnapshotId}' is not completed.")
+            source = source_entry['resource']
+            volume_entry = self.region.volumes.get(source['VolumeId'], {})
+            latency = self.cloud.latency
+            seconds = source['VolumeSize'] * latency['copy_seconds_per_gb']
+            if volume_entry.get('copied'):
+                seconds *= latency['incremental_fraction']
+            if volume_entry:
+                volume_entry['copied'] = True
+            snapshot = {
+                **source,
+                'SnapshotId': self.region.new_id('snap'),
+                'Description': Description,
+                'Encrypted': Encrypted or source['Encrypted'],
+                'State': 'pending',
+                'Progress': '0%',
+                'StartTime': datetime.now(timezone.utc),
+                'Tags': [],
+            }
+            if KmsKeyId:
+                snapshot['KmsKeyId'] = KmsKeyId
+            entry = {'resource': snapshot, 'target': None, 'ready_at': 0, 'started_at': time.monotonic()}
+            failed = self.cloud.chance(self.cloud.snapshot_failure_rate)
+            self.region.transition(entry, 'error' if failed else 'completed', seconds)
+            self.region.snapshots[snapshot['SnapshotId']] = entry
+            return {'SnapshotId': snapshot['SnapshotId']}
+        return self.call('copy_snapshot', handler)
+
+    def create_volume(self, AvailabilityZone, SnapshotId=None, Size=None, VolumeType='gp2', Encrypted=False, KmsKeyId=None, **kwargs):
+        def handler():
+            snapshot_entry = self.region.snapshots.get(SnapshotId) if SnapshotId else None
+            if SnapshotId and (not snapshot_entry or snapshot_entry['resource']['State'] != 'completed'):
+                raise client_error('CreateVolume', 'IncorrectState', f"Snapshot '{SnapshotId}' is not completed.")
+            size = Size or snapshot_entry['resource']['VolumeSize']
+            volume = self.region.add_volume(AvailabilityZone, size, VolumeType, Encrypted, SnapshotId or '', KmsKeyId)
+            entry = self.region.volumes[volume['VolumeId']]
+            volume['State'] = 'creating'
+            latency = self.cloud.latency
+            self.region.transition(entry, 'available', latency['volume_seconds'] + size * latency['volume_seconds_per_gb'])
+            return copy_resource(volume)
+        return self.call('create_volume', handler)
+
+    def delete_volume(self, VolumeId):
+        def handler():
+            entry = self.region.volumes.get(VolumeId)
+            if not entry:
+                raise client_error('DeleteVolume', 'InvalidVolume.NotFound', f"The volume '{VolumeId}' does not exist.")
+            self.region.settle(entry)
+            if entry['resource']['State'] != 'available':
+                raise client_error('DeleteVolume', 'VolumeInUse', f"Volume {VolumeId} is currently attached.")
+            del self.region.volumes[VolumeId]
+            return {}
+        return self.call('delete_volume', handler)
+
+    def delete_snapshot(self, SnapshotId):
+        def handler():
+            entry = self.region.snapshots.get(SnapshotId)
+            if not entry or entry['resource']['State'] == 'deleted':
+                raise client_error('DeleteSnapshot', 'InvalidSnapshot.NotFound', f"The snapshot '{SnapshotId}' does not exist.")
+            entry['target'] = None
+            entry['resource']['State'] = 'deleted'
+            return {}
+        return self.call('delete_snapshot', handler)
+
+    def attach_volume(self, VolumeId, InstanceId, Device):
+        def handler():
+            entry = self.region.volumes.get(VolumeId)
+            instance_entry = self.region.instances.get(InstanceId)
+            if not entry or not instance_entry:
+                raise client_error('AttachVolume', 'InvalidParameterValue', f"Unknown volume {VolumeId} or instance {InstanceId}.")
+            self.region.settle(entry)
+            volume, instance = entry['resource'], instance_entry['resource']
+            if volume['State'] != 'available':
+                raise client_error('AttachVolume', 'IncorrectState', f"vol '{VolumeId}' is not 'available'.")
+            if volume['AvailabilityZone'] != instance['Placement']['AvailabilityZone']:
+                raise client_error('AttachVolume', 'InvalidVolume.ZoneMismatch', f"Volume {VolumeId} is not in the instance's availability zone.")
+            if any(mapping['DeviceName'] == Device for mapping in instance['BlockDeviceMappings']):
+                raise client_error('AttachVolume', 'InvalidParameterValue', f"Device {Device} is already in use on {InstanceId}.")
+            self.region.attach(volume, instance, Device)
+            volume['Attachments'][0]['State'] = 'attaching'
+            volume['State'] = 'in-use'
+            entry['on_ready'] = lambda: volume['Attachments'] and volume['Attachments'][0].update(State='attached')
+            self.region.transition(entry, 'in-use', self.cloud.latency['attach_seconds'])
+            return dict(volume['Attachments'][0])
+        return self.call('attach_volume', handler)
+
+    def detach_volume(self, VolumeId, InstanceId=None, Force=False):
+        def handler():
+            entry = self.region.volumes.get(VolumeId)
+            if not entry or not entry['resource']['Attachments']:
+                raise client_error('DetachVolume', 'IncorrectState', f"Volume '{VolumeId}' is not attached.")
+            volume = entry['resource']
+            attachment = volume['Attachments'][0]
+            instance = self.region.instances[attachment['InstanceId']]
+            self.region.settle(instance, 'instance')
+            if attachment['Device'] == instance['resource']['RootDeviceName'] and instance['resource']['State']['Name'] != 'stopped':
+                raise client_error('DetachVolume', 'IncorrectState', f"Unable to detach root volume '{VolumeId}' from instance '{attachment['InstanceId']}'")
+            attachment['State'] = 'detaching'
+            instance['resource']['BlockDeviceMappings'] = [
+                mapping for mapping in instance['resource']['BlockDeviceMappings'] if mapping['Ebs']['VolumeId'] != VolumeId]
+
+            def detached():
+                volume['Attachments'] = []
+            entry['on_ready'] = detached
+            self.region.transition(entry, 'available', self.cloud.latency['detach_seconds'])
+            return dict(attachment)
+        return self.call('detach_volume', handler)
+
+    def stop_instances(self, InstanceIds):
+        return self.call('stop_instances', lambda: self.change_instances(InstanceIds, 'stopping', 'stopped', 'stop_seconds'))
+
+    def start_instances(self, InstanceIds):
+        return self.call('start_instances', lambda: self.change_instances(InstanceIds, 'pending', 'running', 'start_seconds'))
+
+    def change_instances(self, instance_ids, interim_state, state, latency_key):
+        changes = []
+        for instance_id in instance_ids:
+            entry = self.region.instances.get(instance_id)
+            if not entry:
+                raise client_error('StopInstances', 'InvalidInstanceID.NotFound', f"The instance ID '{instance_id}' does not exist")
+            self.region.settle(entry, 'instance')
+            previous_state = entry['resource']['State']['Name']
+            if previous_state != state:
+                entry['resource']['State'] = {'Name': interim_state}
+                self.region.transition(entry, state, self.cloud.latency[latency_key])
+            changes.append({'InstanceId': instance_id, 'PreviousState': {'Name': previous_state}, 'CurrentState': {'Name': interim_state}})
+        return {'StoppingInstances' if state == 'stopped' else 'StartingInstances': changes}
+
+
+class SimulatedKMS(SimulatedClient):
+    def describe_key(self, KeyId):
+        def handler():
+            return {'KeyMetadata': {'KeyId': 'sim-ebs-key', 'Arn': f"arn:aws:kms:{self.region.region_name}:{self.region.account_id}:key/sim-ebs-key"}}
+        return self.call('describe_key', handler)
+
+
+class SimulatedSTS(SimulatedClient):
+    def get_caller_identity(self):
+        return self.call('get_caller_identity', lambda: {'Account': self.region.account_id})
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        def handler():
+            return {'Credentials': {
+                'AccessKeyId': 'SIMULATED', 'SecretAccessKey': 'SIMULATED', 'SessionToken': 'SIMULATED',
+                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+            }}
+        return self.call('assume_role', handler)
+
+
+SIMULATED_CLIENTS = {'ec2': SimulatedEC2, 'kms': SimulatedKMS, 'sts': SimulatedSTS}
+
+
+class SimulatedSession:
+    def __init__(self, cloud, account_id, region_name):
+        self.cloud = cloud
+        self.account_id = account_id
+        self.region_name = region_name
+
+    def client(self, service):
+        return SIMULATED_CLIENTS[service](self.cloud, self.cloud.region(self.account_id, self.region_name), service)
+
+
+def copy_resource(resource):
+    copied = dict(resource)
+    for key, value in copied.items():
+        if isinstance(value, list):
+            copied[key] = [dict(item) if isinstance(item, dict) else item for item in value]
+        elif isinstance(value, dict):
+            copied[key] = dict(value)
+    return copied
+
+
+def with_token(response, token):
+    if token:
+        response['NextToken'] = token
+    return response
+
+
+def compress_time(time_scale):
+    # Scales the client side delays (poll intervals, rate limiter refills and backoff) by
+    # the same factor as the simulated latencies, so a sped-up run behaves like a real one.
+    waiters.INITIAL_DELAY /= time_scale
+    waiters.MAX_DELAY /= time_scale
+    ratelimit.BASE_BACKOFF /= time_scale
+    ratelimit.MAX_BACKOFF /= time_scale
+    for name in ('NON_MUTATING_BUCKET', 'MUTATING_BUCKET', 'RESOURCE_INTENSIVE_BUCKET', 'DEFAULT_BUCKET'):
+        capacity, refill_rate = getattr(ratelimit, name)
+        setattr(ratelimit, name, (capacity, refill_rate * time_scale))
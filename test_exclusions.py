@@ -0,0 +1,174 @@
+import logging
+
+import pytest
+
+import exclusions
+from exclusions import ExclusionRules, load_rules
+
+# The production instances the original script hard-coded; exclusions.json must keep
+# every one of them.
+PROTECTED_INSTANCE_IDS = [
+    'i-0c9b0f3c9ef20844f', 'i-06614e6c32fdd91a4', 'i-0c040c4f7a132269b', 'i-03edef24bacf66c0e', 'i-0c99f03e0ce758a3f',
+    'i-084a5839268954c72', 'i-0c7a7804f2ee94fac', 'i-005da6ce8b73bad9b', 'i-03a5f91f8f2b99144', 'i-042c3ec4ce01d91ea',
+    'i-06a2f96f7b4696efc', 'i-0ae79b01a1edef960', 'i-09d47988275275e19', 'i-0a99fc64280ce6855', 'i-0d9ea070d2dd5cd13',
+    'i-0e6cbe5ecd5f92fa3', 'i-02402fa59c575b43f', 'i-0e54c9a4b7dfbf4bb', 'i-0176c49c07fd241df', 'i-0f75bec77eb76e2d1',
+    'i-0f655ee2cb3b86e32', 'i-024dadf0a0e130fbf', 'i-00ac08a74aa3c3e6b', 'i-0bbdcf3745257459b', 'i-0a23b1a941f26b90b',
+    'i-0cd082c492824b31a', 'i-067e83f83906c1f27', 'i-0187e7c24f64c3231', 'i-0feb7555ef36ccde9', 'i-04808f96962a4d58a',
+    'i-0d67c67ccc37df029', 'i-0c83e18d59f52617f', 'i-034c88f2f1a30177b',
+]
+INSTANCE_ID = 'i-0123456789abcdef0'
+
+
+def volume(size=8, tags=None, volume_id='vol-1'):
+    return {'VolumeId': volume_id, 'Size': size, 'Tags': [{'Key': key, 'Value': value} for key, value in (tags or {}).items()]}
+
+
+def instance(tags=None):
+    return {'InstanceId': INSTANCE_ID, 'Tags': [{'Key': key, 'Value': value} for key, value in (tags or {}).items()]}
+
+
+def test_rules_file_protects_every_listed_instance():
+    rules = load_rules()
+
+    assert len(PROTECTED_INSTANCE_IDS) == 33
+    assert rules.instance_ids == set(PROTECTED_INSTANCE_IDS)
+    for instance_id in PROTECTED_INSTANCE_IDS:
+        assert rules.reason(instance_id, [volume()], instance()) == "instance ID is excluded"
+    assert rules.reason(INSTANCE_ID, [volume()], instance()) is None
+
+
+def test_rules_file_is_found_outside_the_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert load_rules().instance_ids == set(PROTECTED_INSTANCE_IDS)
+
+
+def test_missing_rules_file_warns_and_falls_back_to_the_defaults(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(exclusions, 'DEFAULT_RULES_FILE', str(tmp_path / 'exclusions.json'))
+
+    with caplog.at_level(logging.WARNING):
+        rules = load_rules()
+
+    assert 'not found' in caplog.text
+    assert rules.instance_ids == set()
+    assert rules.max_volume_size_gb == 250
+    assert rules.eks_clusters == {exclusions.ANY}
+
+
+def test_explicit_rules_file_must_exist(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_rules(str(tmp_path / 'missing.json'))
+
+
+@pytest.mark.parametrize('size, excluded', [(250, False), (251, True)])
+def test_volumes_over_the_size_limit_are_excluded(size, excluded):
+    rules = ExclusionRules.from_dict({})
+
+    reason = rules.reason(INSTANCE_ID, [volume(8, volume_id='vol-small'), volume(size, volume_id='vol-large')], instance())
+
+    assert (reason == "volumes ['vol-large'] are larger than 250 GB") is excluded
+    assert (reason is None) is not excluded
+
+
+@pytest.mark.parametrize('max_volume_size_gb', [None, 0])
+def test_size_limit_can_be_lifted(max_volume_size_gb):
+    rules = ExclusionRules.from_dict({'max_volume_size_gb': max_volume_size_gb})
+
+    assert rules.reason(INSTANCE_ID, [volume(16000)], instance()) is None
+
+
+@pytest.mark.parametrize('selector', [
+    {'key': 'Environment', 'value': 'production'},
+    {'key': 'Environment', 'values': ['staging', 'production']},
+])
+def test_tag_selectors_with_values_match_only_those_values(selector):
+    rules = ExclusionRules.from_dict({'tags': [selector]})
+
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'Environment': 'production'})) == "instance tag Environment=production is excluded"
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'Environment': 'development'})) is None
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'Owner': 'production'})) is None
+
+
+def test_tag_selector_without_values_matches_any_value():
+    rules = ExclusionRules.from_dict({'tags': [{'key': 'DoNotEncrypt'}]})
+
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'DoNotEncrypt': ''})) == "instance tag DoNotEncrypt= is excluded"
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'DoNotEncrypt': 'anything'})) is not None
+    assert rules.reason(INSTANCE_ID, [volume()], instance()) is None
+
+
+@pytest.mark.parametrize('tags', [
+    [{'key': 'Environment'}, {'key': 'Environment', 'value': 'production'}],
+    [{'key': 'Environment', 'value': 'production'}, {'key': 'Environment'}],
+])
+def test_selector_without_values_wins_over_one_with_values(tags):
+    rules = ExclusionRules.from_dict({'tags': tags})
+
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'Environment': 'development'})) is not None
+
+
+def test_volume_tags_are_matched_too():
+    rules = ExclusionRules.from_dict({'tags': [{'key': 'Backup', 'value': 'legal-hold'}]})
+
+    reason = rules.reason(INSTANCE_ID, [volume(), volume(tags={'Backup': 'legal-hold'}, volume_id='vol-2')], instance())
+
+    assert reason == "volume vol-2 tag Backup=legal-hold is excluded"
+
+
+@pytest.mark.parametrize('tags', [
+    {'eks:cluster-name': 'payments'},
+    {'aws:eks:cluster-name': 'payments'},
+    {'kubernetes.io/cluster/payments': 'owned'},
+])
+def test_eks_nodes_are_excluded_by_default(tags):
+    rules = ExclusionRules.from_dict({})
+
+    reason = rules.reason(INSTANCE_ID, [volume()], instance(tags))
+
+    assert reason == "EKS node of cluster payments; encrypt it through its node group's launch template"
+
+
+def test_eks_exclusion_can_name_clusters():
+    rules = ExclusionRules.from_dict({'eks_clusters': ['payments']})
+
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'eks:cluster-name': 'payments'})) is not None
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'eks:cluster-name': 'batch'})) is None
+
+
+def test_eks_nodes_are_included_without_clusters():
+    rules = ExclusionRules.from_dict({'eks_clusters': []})
+
+    assert rules.reason(INSTANCE_ID, [volume()], instance({'eks:cluster-name': 'payments'})) is None
+
+
+def test_eks_nodes_found_through_their_node_groups_need_no_tags():
+    rules = ExclusionRules.from_dict({})
+    rules.eks_nodes[INSTANCE_ID] = 'payments'
+
+    assert rules.reason(INSTANCE_ID, [volume()]) == "EKS node of cluster payments; encrypt it through its node group's launch template"
+    assert rules.reason('i-0fedcba9876543210', [volume()]) is None
+
+
+@pytest.mark.parametrize('auto_scaling_groups, excluded', [
+    ([], False),
+    (['web'], True),
+    (['batch'], False),
+    ([exclusions.ANY], True),
+])
+def test_auto_scaling_group_members(auto_scaling_groups, excluded):
+    rules = ExclusionRules.from_dict({'auto_scaling_groups': auto_scaling_groups})
+
+    reason = rules.reason(INSTANCE_ID, [volume()], instance({'aws:autoscaling:groupName': 'web'}))
+
+    assert (reason == "member of Auto Scaling group web; replace its instances from an encrypted launch template") is excluded
+    assert (reason is None) is not excluded
+
+
+@pytest.mark.parametrize('rules, needs_instance', [
+    ({'eks_clusters': []}, False),
+    ({}, True),
+    ({'eks_clusters': [], 'tags': [{'key': 'DoNotEncrypt'}]}, True),
+    ({'eks_clusters': [], 'auto_scaling_groups': ['web']}, True),
+])
+def test_needs_instance_only_when_a_rule_reads_its_tags(rules, needs_instance):
+    assert ExclusionRules.from_dict(rules).needs_instance is needs_instance
@@ -0,0 +1,307 @@
+import json
+import os
+from collections import Counter
+
+import pytest
+from botocore.exceptions import ClientError
+
+# End-to-end runs of encryption.main() against the simulated cloud of simulation.py, with
+# latencies divided by TIME_SCALE so every run takes a few seconds.
+TIME_SCALE = 5000
+SEED = 7
+VOLUME_SIZES = [8, 100, 500]
+
+
+class Crash(BaseException):
+    # Stands in for the process dying: not caught by the handlers for Exception.
+    pass
+
+
+@pytest.fixture(scope='module')
+def modules(tmp_path_factory):
+    # encryption.py opens its log file in the working directory when it is imported.
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('logs'))
+    try:
+        import encryption
+        import simulation
+        import waiters
+        simulation.compress_time(TIME_SCALE)
+    finally:
+        os.chdir(cwd)
+    return encryption, simulation, waiters
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def make_fleet(modules, volume_count=12, **failures):
+    encryption, simulation, _ = modules
+    cloud = simulation.SimulatedCloud(TIME_SCALE, seed=SEED, **failures)
+    region = cloud.generate_fleet(volume_count, volume_sizes=VOLUME_SIZES)
+    encryption.use_simulation(cloud)
+    return cloud, region
+
+
+def run_encryption(modules, region, *args):
+    encryption = modules[0]
+    encryption.main(['--regions', region.region_name, '--state-file', 'state.db', '--report', 'report.csv',
+                     '--workers', '4', '--max-volume-size', '0', *args])
+
+
+def report_rows():
+    import report
+    return list(report.read_report('report.csv'))
+
+
+def attached_volumes(region, instance_id):
+    # Device -> volume attached to it.
+    return {volume['Attachments'][0]['Device']: volume for volume in (entry['resource'] for entry in region.volumes.values())
+            if volume['Attachments'] and volume['Attachments'][0]['InstanceId'] == instance_id}
+
+
+def devices(region):
+    return {instance_id: sorted(attached_volumes(region, instance_id)) for instance_id in region.instances}
+
+
+def instance_states(region):
+    for entry in region.instances.values():
+        region.settle(entry, 'instance')
+    return Counter(entry['resource']['State']['Name'] for entry in region.instances.values())
+
+
+def encrypted_counts(region):
+    volumes = [entry['resource'] for entry in region.volumes.values() if entry['resource']['State'] == 'in-use']
+    return sum(volume['Encrypted'] for volume in volumes), sum(not volume['Encrypted'] for volume in volumes)
+
+
+@pytest.mark.parametrize('snapshot_mode', ['serial', 'overlap', 'pre-stop'])
+def test_encrypts_every_volume(modules, snapshot_mode):
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+
+    run_encryption(modules, region, '--snapshot-mode', snapshot_mode)
+
+    assert encrypted_counts(region) == (12, 0)
+    assert devices(region) == layout
+    assert instance_states(region) == {'running': len(region.instances)}
+    rows = report_rows()
+    assert len(rows) == 12
+    assert {row['status'] for row in rows} == {'swapped'}
+
+
+def test_excluded_instances_are_left_alone(modules, work_dir):
+    cloud, region = make_fleet(modules)
+    instance_ids = sorted(region.instances)
+    (work_dir / 'rules.json').write_text(json.dumps({'instance_ids': [instance_ids[0]], 'tags': [{'key': 'Name', 'value': 'sim-1'}]}))
+    large = {instance_id for instance_id in instance_ids if any(volume['Size'] > 250 for volume in attached_volumes(region, instance_id).values())}
+    excluded = {instance_ids[0], instance_ids[1]} | large
+    assert large and len(excluded) < len(instance_ids)
+
+    run_encryption(modules, region, '--snapshot-mode', 'overlap', '--exclusions', 'rules.json', '--max-volume-size', '250')
+
+    for instance_id in instance_ids:
+        encrypted = {volume['Encrypted'] for volume in attached_volumes(region, instance_id).values()}
+        assert encrypted == ({False} if instance_id in excluded else {True})
+    assert {row['instance_id'] for row in report_rows()} == set(instance_ids) - excluded
+
+
+@pytest.mark.parametrize('snapshot_mode', ['serial', 'overlap'])
+def test_api_failures_never_leave_an_instance_stopped(modules, snapshot_mode):
+    cloud, region = make_fleet(modules, volume_count=40, api_failure_rate=0.02)
+    layout = devices(region)
+
+    run_encryption(modules, region, '--snapshot-mode', snapshot_mode)
+
+    assert instance_states(region) == {'running': len(region.instances)}
+    assert devices(region) == layout
+
+
+def test_throttles_are_retried_with_the_rate_limiter_backoff(modules, monkeypatch):
+    import ratelimit
+    encryption, simulation, _ = modules
+    cloud, region = make_fleet(modules, throttle_rate=0.2)
+    backoff_delay = ratelimit.backoff_delay
+    first_non_none_response = simulation.first_non_none_response
+    limiter_delays = []
+    used_delays = []
+
+    def recorded_backoff_delay(attempts):
+        limiter_delays.append(backoff_delay(attempts))
+        return limiter_delays[-1]
+
+    def recorded_response(responses):
+        used_delays.append(first_non_none_response(responses))
+        return used_delays[-1]
+
+    monkeypatch.setattr(ratelimit, 'backoff_delay', recorded_backoff_delay)
+    monkeypatch.setattr(simulation, 'first_non_none_response', recorded_response)
+    run_encryption(modules, region, '--snapshot-mode', 'overlap')
+
+    assert encrypted_counts(region) == (12, 0)
+    # botocore's own retry handler runs first unless the limiter registers on the service's event.
+    assert len(used_delays) == sum(cloud.throttle_counts.values()) > 0
+    assert sorted(used_delays) == sorted(limiter_delays)
+
+
+def test_rollback_reattaches_originals_still_detaching(modules, monkeypatch):
+    encryption, simulation, _ = modules
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+    detach_volume = simulation.SimulatedEC2.detach_volume
+    calls = Counter()
+
+    def failing_second_detach(self, VolumeId, InstanceId=None, Force=False):
+        # The first detach of the batch is still in progress when the rollback starts.
+        calls['detach'] += 1
+        if calls['detach'] == 2:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'Injected failure.'}}, 'DetachVolume')
+        return detach_volume(self, VolumeId, InstanceId, Force)
+
+    monkeypatch.setattr(simulation.SimulatedEC2, 'detach_volume', failing_second_detach)
+    run_encryption(modules, region, '--snapshot-mode', 'overlap', '--workers', '1')
+
+    assert instance_states(region) == {'running': len(region.instances)}
+    assert devices(region) == layout
+    rolled_back = [row for row in report_rows() if row['status'] == 'rolled_back']
+    assert rolled_back
+    for row in rolled_back:
+        assert not attached_volumes(region, row['instance_id'])[row['device_name']]['Encrypted']
+
+
+def test_an_instance_left_stopped_is_not_verified(modules, monkeypatch):
+    encryption, simulation, _ = modules
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+    stranded = sorted(instance_id for instance_id, attached in layout.items() if len(attached) >= 2)[0]
+    attach_volume = simulation.SimulatedEC2.attach_volume
+    calls = Counter()
+
+    def failing_attaches(self, VolumeId, InstanceId, Device):
+        # The second volume fails to attach, and so does its original on the rollback.
+        if InstanceId == stranded:
+            calls['attach'] += 1
+            if calls['attach'] in (2, 3):
+                raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'Injected failure.'}}, 'AttachVolume')
+        return attach_volume(self, VolumeId, InstanceId, Device)
+
+    monkeypatch.setattr(simulation.SimulatedEC2, 'attach_volume', failing_attaches)
+    run_encryption(modules, region, '--snapshot-mode', 'serial')
+
+    region.settle(region.instances[stranded], 'instance')
+    assert region.instances[stranded]['resource']['State']['Name'] == 'stopped'
+    attached = attached_volumes(region, stranded)
+    assert len(set(layout[stranded]) - set(attached)) == 1
+    rows = [row for row in report_rows() if row['instance_id'] == stranded]
+    assert [row['status'] for row in rows] == ['swapped']
+    assert attached[rows[0]['device_name']]['Encrypted']
+
+
+def test_failed_status_checks_roll_back_and_leave_the_encrypted_volumes_to_cleanup(modules, monkeypatch):
+    encryption, simulation, _ = modules
+    import cleanup
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+    impaired = sorted(instance_id for instance_id, attached in layout.items() if attached)[0]
+    describe_instance_status = simulation.SimulatedEC2.describe_instance_status
+
+    def impaired_status(self, **kwargs):
+        response = describe_instance_status(self, **kwargs)
+        for status in response['InstanceStatuses']:
+            if status['InstanceId'] == impaired:
+                status['InstanceStatus'] = {'Status': 'impaired'}
+        return response
+
+    monkeypatch.setattr(simulation.SimulatedEC2, 'describe_instance_status', impaired_status)
+    run_encryption(modules, region, '--snapshot-mode', 'overlap')
+
+    assert devices(region) == layout
+    assert not any(volume['Encrypted'] for volume in attached_volumes(region, impaired).values())
+    rows = report_rows()
+    assert {row['status'] for row in rows if row['instance_id'] == impaired} == {'rolled_back'}
+    assert {row['status'] for row in rows if row['instance_id'] != impaired} == {'swapped'}
+
+    cleanup.main(['report.csv', '--retention-hours', '0', '--cleanup-log', 'cleanup.csv'])
+    assert devices(region) == layout
+    available = [entry['resource'] for entry in region.volumes.values() if entry['resource']['State'] == 'available']
+    assert available == []
+
+
+def test_unreadable_status_checks_keep_the_encrypted_volumes(modules, monkeypatch):
+    encryption, simulation, _ = modules
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+
+    def denied(self, **kwargs):
+        raise ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'Injected denial.'}}, 'DescribeInstanceStatus')
+
+    monkeypatch.setattr(simulation.SimulatedEC2, 'describe_instance_status', denied)
+    run_encryption(modules, region, '--snapshot-mode', 'overlap')
+
+    assert encrypted_counts(region) == (12, 0)
+    assert devices(region) == layout
+    assert instance_states(region) == {'running': len(region.instances)}
+    assert {row['status'] for row in report_rows()} == {'swapped'}
+
+
+def test_resume_after_a_crash_reuses_the_snapshots(modules, monkeypatch):
+    encryption, simulation, _ = modules
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+    create_volume = simulation.SimulatedEC2.create_volume
+    calls = Counter()
+
+    def crashing_create_volume(self, **kwargs):
+        calls['create_volume'] += 1
+        if calls['create_volume'] == 4:
+            raise Crash()
+        return create_volume(self, **kwargs)
+
+    monkeypatch.setattr(simulation.SimulatedEC2, 'create_volume', crashing_create_volume)
+    with pytest.raises(Crash):
+        run_encryption(modules, region, '--snapshot-mode', 'overlap')
+    monkeypatch.setattr(simulation.SimulatedEC2, 'create_volume', create_volume)
+
+    run_encryption(modules, region, '--snapshot-mode', 'overlap', '--resume')
+
+    assert encrypted_counts(region) == (12, 0)
+    assert devices(region) == layout
+    assert instance_states(region) == {'running': len(region.instances)}
+    assert cloud.call_counts[('ec2', 'CreateSnapshot')] == 12
+
+
+@pytest.mark.parametrize('snapshot_mode', ['serial', 'overlap'])
+def test_stalled_snapshots_are_resumed_without_being_retaken(modules, monkeypatch, caplog, snapshot_mode):
+    encryption, simulation, waiters = modules
+    cloud, region = make_fleet(modules)
+    layout = devices(region)
+    # Waits give up after 0.3 seconds, well before a 500 GB snapshot is done.
+    for method in (waiters.ResourcePoller.wait, waiters.ResourcePoller.wait_each):
+        monkeypatch.setattr(method, '__defaults__', (0.3,))
+    monkeypatch.setattr(encryption, 'PENDING_POLL_DELAY', 0.05)
+    monkeypatch.setattr(encryption, 'PENDING_MAX_DELAY', 0.5)
+
+    run_encryption(modules, region, '--snapshot-mode', snapshot_mode)
+
+    assert encrypted_counts(region) == (12, 0)
+    assert devices(region) == layout
+    assert 'Adding to pending snapshots list' in caplog.text
+    assert encryption.FAILED_SNAPSHOTS == []
+    assert cloud.call_counts[('ec2', 'CreateSnapshot')] == 12
+
+
+def test_failed_snapshots_keep_the_original_volumes(modules):
+    encryption = modules[0]
+    cloud, region = make_fleet(modules, volume_count=30, snapshot_failure_rate=0.2)
+    layout = devices(region)
+
+    run_encryption(modules, region, '--snapshot-mode', 'overlap')
+
+    encrypted, unencrypted = encrypted_counts(region)
+    assert unencrypted == len(encryption.FAILED_SNAPSHOTS) > 0
+    assert encrypted + unencrypted == 30
+    assert devices(region) == layout
+    assert instance_states(region) == {'running': len(region.instances)}
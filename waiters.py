@@ -0,0 +1,245 @@
+import logging
+import queue
+import threading
+import time
+
+import botocore.exceptions
+
+logger = logging.getLogger()
+
+INITIAL_DELAY = 2
+MAX_DELAY = 60
+BACKOFF_FACTOR = 1.5
+DEFAULT_TIMEOUT = 120 * 60
+# Filter values are capped per describe call, so large batches are split.
+DESCRIBE_BATCH_SIZE = 200
+
+# 'label' and 'plural' name the resources in log messages and waiter errors.
+RESOURCE_KINDS = {
+    'snapshot': {'operation': 'describe_snapshots', 'filter': 'snapshot-id', 'id_key': 'SnapshotId',
+                 'label': 'snapshot', 'plural': 'snapshots'},
+    'volume': {'operation': 'describe_volumes', 'filter': 'volume-id', 'id_key': 'VolumeId',
+               'label': 'volume', 'plural': 'volumes'},
+    'instance': {'operation': 'describe_instances', 'filter': 'instance-id', 'id_key': 'InstanceId',
+                 'label': 'instance', 'plural': 'instances'},
+    # Status checks are looked up by ID; the call takes at most 100 IDs. They take a minute or
+    # more to pass after a start, so the first poll is held back accordingly.
+    'instance_status': {'operation': 'describe_instance_status', 'ids_param': 'InstanceIds', 'id_key': 'InstanceId', 'batch_size': 100,
+                        'first_poll_delays': 15, 'label': 'status checks of instance', 'plural': 'status checks of instances'},
+}
+
+# Errors that no retry will fix; waits of the kind fail on the first one.
+PERMANENT_ERROR_CODES = {'UnauthorizedOperation', 'AccessDenied', 'AccessDeniedException'}
+
+FAILURE_STATES = {
+    'snapshot': {'error'},
+    'volume': {'error', 'deleted'},
+    'instance': {'terminated', 'shutting-down'},
+    'instance_status': {'impaired'},
+}
+
+
+def describe_resources(ec2_client, kind, resource_ids):
+    spec = RESOURCE_KINDS[kind]
+    paginator = ec2_client.get_paginator(spec['operation'])
+    resources = []
+    if 'ids_param' in spec:
+        pages = paginator.paginate(**{spec['ids_param']: resource_ids})
+    else:
+        pages = paginator.paginate(Filters=[{'Name': spec['filter'], 'Values': resource_ids}])
+    for page in pages:
+        if kind == 'snapshot':
+            resources.extend(page['Snapshots'])
+        elif kind == 'volume':
+            resources.extend(page['Volumes'])
+        elif kind == 'instance_status':
+            resources.extend(page['InstanceStatuses'])
+        else:
+            for reservation in page['Reservations']:
+                resources.extend(reservation['Instances'])
+    return resources
+
+
+def resource_state(kind, resource):
+    if kind == 'instance':
+        return resource['State']['Name']
+    if kind == 'instance_status':
+        # 'ok' once both the instance and the system status checks pass.
+        checks = {resource['InstanceStatus']['Status'], resource['SystemStatus']['Status']}
+        if 'impaired' in checks:
+            return 'impaired'
+        return 'ok' if checks == {'ok'} else 'initializing'
+    return resource['State']
+
+
+class ResourcesNotDescribed(botocore.exceptions.WaiterError):
+    # The resources could not be described, so their state is unknown rather than wrong.
+    pass
+
+
+def permanent_error(error):
+    return isinstance(error, botocore.exceptions.ClientError) and error.response.get('Error', {}).get('Code') in PERMANENT_ERROR_CODES
+
+
+def parse_progress(progress):
+    try:
+        return float(str(progress).rstrip('%'))
+    except ValueError:
+        return 0.0
+
+
+class Wait:
+    def __init__(self, kind, resource_ids, state, timeout):
+        self.kind = kind
+        self.remaining = set(resource_ids)
+        self.state = state
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.delay = INITIAL_DELAY
+        self.next_poll = self.started + INITIAL_DELAY * RESOURCE_KINDS[kind].get('first_poll_delays', 0)
+        self.results = queue.Queue()
+
+    def next_delay(self, progress):
+        # Snapshots report a completion percentage, so the next poll is placed halfway
+        # to the estimated finish; everything else backs off geometrically.
+        if progress:
+            elapsed = time.monotonic() - self.started
+            estimated_remaining = elapsed * (100 - progress) / progress
+            self.delay = min(max(estimated_remaining / 2, INITIAL_DELAY), MAX_DELAY)
+        else:
+            self.delay = min(self.delay * BACKOFF_FACTOR, MAX_DELAY)
+        return self.delay
+
+
+class ResourcePoller:
+    # One background thread per EC2 client. Every outstanding wait is served by a single
+    # batched describe call per resource kind instead of one waiter per resource.
+    def __init__(self, ec2_client):
+        self.ec2_client = ec2_client
+        self.waits = []
+        self.snapshot_progress = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='resource-poller', daemon=True)
+            self.thread.start()
+
+    def wait_each(self, kind, resource_ids, state, timeout=DEFAULT_TIMEOUT):
+        resource_ids = list(resource_ids)
+        if not resource_ids:
+            return
+        wait = Wait(kind, resource_ids, state, timeout)
+        with self.condition:
+            self.waits.append(wait)
+            self.start()
+            self.condition.notify()
+        try:
+            for _ in resource_ids:
+                result = wait.results.get()
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            # A caller that stops iterating early must not leave the wait being polled.
+            self.finish(wait)
+
+    def wait(self, kind, resource_ids, state, timeout=DEFAULT_TIMEOUT):
+        for _ in self.wait_each(kind, resource_ids, state, timeout):
+            pass
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.waits:
+                    self.condition.wait()
+                now = time.monotonic()
+                next_poll = min(wait.next_poll for wait in self.waits)
+                if next_poll > now:
+                    self.condition.wait(next_poll - now)
+                    continue
+                due = [wait for wait in self.waits if wait.next_poll <= now]
+            try:
+                self.poll(due)
+            except Exception as e:
+                # Describe errors are handled per kind in poll(); this covers anything else.
+                logger.error(f"Resource poller failed. Error: {str(e)}")
+                now = time.monotonic()
+                for wait in due:
+                    if now >= wait.deadline:
+                        self.fail(wait, f"{RESOURCE_KINDS[wait.kind]['plural']} {sorted(wait.remaining)} could not be checked. "
+                                        f"Error: {str(e)}", None)
+                    else:
+                        wait.next_poll = now + wait.next_delay(None)
+
+    def poll(self, due):
+        ids_by_kind = {}
+        for wait in due:
+            ids_by_kind.setdefault(wait.kind, set()).update(wait.remaining)
+
+        # A kind that fails to be described only holds up its own waits.
+        resources_by_kind = {}
+        errors_by_kind = {}
+        for kind, resource_ids in ids_by_kind.items():
+            resource_ids = sorted(resource_ids)
+            resources = {}
+            batch_size = RESOURCE_KINDS[kind].get('batch_size', DESCRIBE_BATCH_SIZE)
+            try:
+                for i in range(0, len(resource_ids), batch_size):
+                    batch = resource_ids[i:i + batch_size]
+                    for resource in describe_resources(self.ec2_client, kind, batch):
+                        resources[resource[RESOURCE_KINDS[kind]['id_key']]] = resource
+            except Exception as e:
+                logger.error(f"Resource poller failed to describe {RESOURCE_KINDS[kind]['plural']}. Error: {str(e)}")
+                errors_by_kind[kind] = e
+                continue
+            resources_by_kind[kind] = resources
+            if kind == 'snapshot':
+                for snapshot_id, snapshot in resources.items():
+                    self.snapshot_progress[snapshot_id] = parse_progress(snapshot.get('Progress', '0%'))
+
+        now = time.monotonic()
+        for wait in due:
+            error = errors_by_kind.get(wait.kind)
+            if error is not None:
+                if permanent_error(error) or now >= wait.deadline:
+                    self.fail(wait, f"{RESOURCE_KINDS[wait.kind]['plural']} {sorted(wait.remaining)} could not be described. "
+                                    f"Error: {str(error)}", None, ResourcesNotDescribed)
+                else:
+                    wait.next_poll = now + wait.next_delay(None)
+                continue
+            resources = resources_by_kind[wait.kind]
+            for resource_id in sorted(wait.remaining):
+                # Freshly created resources may not be visible yet; they simply stay pending.
+                resource = resources.get(resource_id)
+                if resource is None:
+                    continue
+                state = resource_state(wait.kind, resource)
+                if state == wait.state:
+                    wait.remaining.discard(resource_id)
+                    wait.results.put(resource_id)
+                elif state in FAILURE_STATES[wait.kind]:
+                    self.fail(wait, f"{RESOURCE_KINDS[wait.kind]['label']} {resource_id} entered state {state}", resource)
+                    break
+
+            if wait.remaining and wait in self.waits and now >= wait.deadline:
+                self.fail(wait, f"{RESOURCE_KINDS[wait.kind]['plural']} {sorted(wait.remaining)} did not reach state {wait.state} in time", None)
+            elif not wait.remaining:
+                self.finish(wait)
+            elif wait in self.waits:
+                progress = None
+                if wait.kind == 'snapshot':
+                    progress = min(self.snapshot_progress.get(resource_id, 0.0) for resource_id in wait.remaining)
+                wait.next_poll = now + wait.next_delay(progress)
+
+    def finish(self, wait):
+        with self.condition:
+            if wait in self.waits:
+                self.waits.remove(wait)
+
+    def fail(self, wait, reason, last_response, error_class=botocore.exceptions.WaiterError):
+        logger.error(f"Waiter failed: {reason}")
+        self.finish(wait)
+        wait.remaining.clear()
+        wait.results.put(error_class(name=f"{wait.kind}_{wait.state}", reason=reason, last_response=last_response or {}))